@@ -0,0 +1,112 @@
+# benchmark the graph or the timeline crawler offline against a local mock
+# twitter server
+import os
+from time import time
+from argparse import ArgumentParser
+
+from tweegraph.mock_server import MockTwitterServer, SyntheticTwitter
+from tweegraph.traverser import TwitterGraphTraverser, crawl_timelines
+from tweegraph.event_loop import EventLoopTraverser
+from tweegraph.db import get_client, get_number_of_collections
+
+
+def benchmark_timelines(args, server):
+    get_client().drop_database(args.db_name)
+    started = time()
+    stranded = crawl_timelines(args.db_name, range(1, args.users + 1),
+                               server.credentials(args.tokens),
+                               concurrency=args.concurrency,
+                               layout=args.layout, wait=True)
+    elapsed = time() - started
+    timelines = get_number_of_collections(args.db_name, args.layout)
+    get_client().drop_database(args.db_name)
+
+    print 'elapsed          : %.1f sec' % elapsed
+    print 'timelines / hour : %.1f' % (timelines / elapsed * 3600)
+    print 'stranded users   : %d' % len(stranded)
+
+
+def benchmark_graph(args, server):
+    engine = EventLoopTraverser if args.event_loop else TwitterGraphTraverser
+    traverser = engine(starting_ids=range(1, 11),
+                       credentials=server.credentials(args.tokens),
+                       graph_size=args.edges * 10,
+                       breadth=args.breadth,
+                       export_name=os.devnull,
+                       prefilter=args.prefilter,
+                       concurrency=args.concurrency)
+    started = time()
+    traverser.start()
+    traverser.wait(args.duration)
+
+    elapsed = time() - started
+    nodes = len(traverser.explored_nodes) - len(traverser.in_progress)
+    edges = traverser.get_size() - traverser.seed_count
+    sleeps = [sum(scheduler.sleep_time for scheduler in schedulers.values())
+              for schedulers in traverser.schedulers]
+    traverser.stop()
+
+    print 'elapsed        : %.1f sec' % elapsed
+    print 'nodes / hour   : %.1f' % (nodes / elapsed * 3600)
+    print 'edges / hour   : %.1f' % (edges / elapsed * 3600)
+    for idx, sleep_time in enumerate(sleeps):
+        print 'token %-2d sleep : %.1f sec' % (idx, sleep_time)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='benchmark crawler throughput')
+
+    parser.add_argument('-u', '--users', dest='users', type=int,
+                        default=10000, help='users of the synthetic graph')
+    parser.add_argument('-e', '--edges', dest='edges', type=int,
+                        default=500000, help='edges of the synthetic graph')
+    parser.add_argument('-t', '--tokens', dest='tokens', type=int, default=5,
+                        help='number of api tokens')
+    parser.add_argument('-d', '--duration', dest='duration', type=float,
+                        default=60, help='seconds to crawl the graph for')
+    parser.add_argument('-w', '--window', dest='window', type=float,
+                        default=15 * 60,
+                        help='rate limit window of the server in seconds')
+    parser.add_argument('-l', '--latency', dest='latency', type=float,
+                        default=0.05, help='mean latency of the server')
+    parser.add_argument('-f', '--failure_rate', dest='failure_rate',
+                        type=float, default=0.01,
+                        help='fraction of dropped connections')
+    parser.add_argument('-b', '--breadth', dest='breadth', type=int,
+                        default=None)
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int,
+                        default=1, help='crawlers per api token')
+    parser.add_argument('-p', '--prefilter', dest='prefilter',
+                        action='store_true')
+    parser.add_argument('--event_loop', dest='event_loop',
+                        action='store_true',
+                        help='crawl with EventLoopTraverser')
+    parser.add_argument('--timelines', dest='timelines', action='store_true',
+                        help='crawl the timelines of every user with '
+                             'crawl_timelines instead of the graph. '
+                             'Requires MongoDB')
+    parser.add_argument('--db_name', dest='db_name',
+                        default='tweegraph_benchmark',
+                        help='database of the timelines. It is dropped '
+                             'before and after the benchmark')
+    parser.add_argument('--layout', dest='layout', default='collections',
+                        choices=['collections', 'single'],
+                        help='storage layout of the timelines')
+
+    args = parser.parse_args()
+
+    graph = SyntheticTwitter(users=args.users, edges=args.edges)
+    server = MockTwitterServer(graph, window=args.window,
+                               latency=args.latency,
+                               failure_rate=args.failure_rate)
+    server.start()
+    os.environ['REQUESTS_CA_BUNDLE'] = server.ca_bundle
+
+    try:
+        if args.timelines:
+            benchmark_timelines(args, server)
+        else:
+            benchmark_graph(args, server)
+    finally:
+        server.stop()
+    print 'server         : %s' % server.stats
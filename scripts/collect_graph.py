@@ -1,6 +1,5 @@
 # script to collect a graph with 10000 twitter relations
 import json
-from time import sleep
 
 from tweegraph.traverser import TwitterGraphTraverser
 
@@ -32,10 +31,13 @@ if __name__ == "__main__":
                                       starting_ids=starting_ids,
                                       directions=['following'],
                                       credentials=credentials)
+    # export collected relations every 1000 explored nodes
+    traverser.on_progress(lambda crawler: crawler.export_data(), every=1000)
     # start exploring graph
     traverser.start()
 
-    while True:
-        if traverser.get_size() > 0:
-            traverser.export_data()
-            sleep(5)
+    try:
+        traverser.join()
+    except KeyboardInterrupt:
+        traverser.stop()
+    traverser.export_data()
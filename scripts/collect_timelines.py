@@ -13,6 +13,14 @@ if __name__ == "__main__":
                         help='csv file that describes edges of the graph')
     parser.add_argument('-d', '--db_name', dest='db', type=str,
                         default='twitter_users')
+    parser.add_argument('-i', '--incremental', dest='incremental',
+                        action='store_true',
+                        help='only collect tweets newer than the stored ones')
+    parser.add_argument('-l', '--layout', dest='layout', type=str,
+                        default='collections',
+                        choices=['collections', 'single'],
+                        help='store a collection per user or a single '
+                             'collection of statuses')
 
     args = parser.parse_args()
     file_name = args.input_file
@@ -23,4 +31,8 @@ if __name__ == "__main__":
         credentials = json.load(credentials_file)
 
     nodes = unique_nodes(file_name)
-    crawl_timelines(db_name, nodes, credentials)
+    stranded = crawl_timelines(db_name, nodes, credentials,
+                               incremental=args.incremental,
+                               layout=args.layout, wait=True)
+    for user in stranded:
+        print user
@@ -2,32 +2,85 @@ import numpy as np
 import pandas as pd
 import networkx as nx
 from argparse import ArgumentParser
+from collections import defaultdict
+from multiprocessing import Pool
 
 
-def get_shortest_distance(pair_id):
-    global graph
-    id_1 = int(pair_id.split('_')[0])
-    id_2 = int(pair_id.split('_')[1])
-    try:
-        return len(nx.shortest_path(graph, source=id_1, target=id_2)) - 1
-    except:
-        return -1
+def get_pair_ids(data_set):
+    """returns the two id columns of the data set. Data sets written with
+    create_dataset.py --stream have them, otherwise the string pair ids of
+    the form 'id1_id2' are parsed once
+    """
+    if 'id_1' in data_set and 'id_2' in data_set:
+        return (np.asarray(data_set['id_1'], dtype=np.int64),
+                np.asarray(data_set['id_2'], dtype=np.int64))
+    ids = data_set['pair_id'].str.split('_', expand=True).astype(np.int64)
+    return np.asarray(ids[0]), np.asarray(ids[1])
 
 
-def get_clustering_index(pair_id):
-    global graph
-    id_1 = int(pair_id.split('_')[0])
-    id_2 = int(pair_id.split('_')[1])
-    
-    return nx.clustering(graph, id_1) + nx.clustering(graph, id_2)
+def get_shortest_distances((source, targets)):
+    """runs a single BFS from source and returns the distance to each of the
+    targets, or -1 if a target is not reachable (within max_depth). The
+    search stops as soon as all targets have been reached
+    """
+    global graph, max_depth
+    if source not in graph:
+        return [-1] * len(targets)
 
+    remaining = set(targets)
+    distances = {}
+    if source in remaining:
+        distances[source] = 0
+        remaining.discard(source)
 
-def get_neighbors(pair_id):
-    global graph
-    id_1 = int(pair_id.split('_')[0])
-    id_2 = int(pair_id.split('_')[1])
-    
-    return len(nx.neighbors(graph, id_1)) + len(nx.neighbors(graph, id_2))
+    seen = {source}
+    frontier = [source]
+    depth = 0
+    while frontier and remaining and (max_depth is None or depth < max_depth):
+        depth += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor in graph.adj[node]:
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    next_frontier.append(neighbor)
+                    if neighbor in remaining:
+                        distances[neighbor] = depth
+                        remaining.discard(neighbor)
+        frontier = next_frontier
+
+    return [distances.get(target, -1) for target in targets]
+
+
+def get_path_lengths(ids_1, ids_2, processes=None):
+    """shortest path length of every pair. Pairs are grouped by source so that
+    one BFS per distinct source answers all of its targets. Sources are
+    spread across a pool of processes
+    """
+    groups = defaultdict(list)
+    for idx, (source, target) in enumerate(zip(ids_1.tolist(),
+                                               ids_2.tolist())):
+        groups[source].append((target, idx))
+
+    sources = groups.keys()
+    tasks = [(source, [target for target, _ in groups[source]])
+             for source in sources]
+    if processes:
+        pool = Pool(processes)
+        try:
+            results = pool.map(get_shortest_distances, tasks,
+                               chunksize=max(1, len(tasks) // (processes * 8)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(get_shortest_distances, tasks)
+
+    lengths = np.empty(len(ids_1), dtype=np.int64)
+    for source, distances in zip(sources, results):
+        for (_, idx), distance in zip(groups[source], distances):
+            lengths[idx] = distance
+    return lengths
 
 
 if __name__ == '__main__':
@@ -40,21 +93,34 @@ if __name__ == '__main__':
     parser.add_argument('data_set',
                         metavar='data_set', type=str,
                         help='csv file that describes all pairs of nodes')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+                        default=None, help='processes that run the BFSs')
+    parser.add_argument('-m', '--max_depth', dest='max_depth', type=int,
+                        default=None,
+                        help='pairs further apart than max_depth get -1')
 
     args = parser.parse_args()
     edges = args.edges_file
     data_set = args.data_set
+    max_depth = args.max_depth
 
     edges = pd.read_csv(edges, names=['node_1', 'node_2'])
     data_set = pd.read_csv(data_set)
-    
+
     graph = nx.Graph()
     graph.add_edges_from(np.asarray(edges))
 
-    data_set['path'] = data_set['pair_id'].apply(get_shortest_distance, 1)
-    data_set['clustering'] = data_set['pair_id'].apply(get_clustering_index, 1)
-    data_set['neighbors'] = data_set['pair_id'].apply(get_neighbors, 1)
-        
+    ids_1, ids_2 = get_pair_ids(data_set)
+    nodes = list(set(ids_1.tolist()) | set(ids_2.tolist()))
+    clustering = nx.clustering(graph, nodes)
+    neighbors = dict((node, len(graph.adj[node])) for node in nodes)
+
+    data_set['path'] = get_path_lengths(ids_1, ids_2, args.processes)
+    data_set['clustering'] = [clustering[id_1] + clustering[id_2]
+                              for id_1, id_2 in zip(ids_1, ids_2)]
+    data_set['neighbors'] = [neighbors[id_1] + neighbors[id_2]
+                             for id_1, id_2 in zip(ids_1, ids_2)]
+
     print data_set
 
     data_set.to_csv('topological_features.csv', index=False)
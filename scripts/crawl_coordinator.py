@@ -0,0 +1,45 @@
+# coordinate a crawl among workers of several machines (see crawl_worker.py)
+from argparse import ArgumentParser
+
+from tweegraph.distributed import CrawlCoordinator
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='coordinate a distributed crawl')
+
+    parser.add_argument('starting_ids', metavar='starting_ids', type=int,
+                        nargs='+', help='twitter ids to start crawling from')
+    parser.add_argument('-s', '--graph_size', dest='graph_size', type=int,
+                        default=400000)
+    parser.add_argument('-b', '--breadth', dest='breadth', type=int,
+                        default=None)
+    parser.add_argument('-d', '--directions', dest='directions', nargs='+',
+                        default=['followers', 'following'])
+    parser.add_argument('--host', dest='host', type=str, default='0.0.0.0')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=9200)
+    parser.add_argument('--batch_size', dest='batch_size', type=int,
+                        default=10)
+    parser.add_argument('--lease_timeout', dest='lease_timeout', type=float,
+                        default=300)
+    parser.add_argument('--secret', dest='secret', type=str, default=None)
+    parser.add_argument('-e', '--export_interval', dest='export_interval',
+                        type=float, default=60,
+                        help='seconds between two exports')
+
+    args = parser.parse_args()
+
+    coordinator = CrawlCoordinator(args.starting_ids,
+                                   graph_size=args.graph_size,
+                                   breadth=args.breadth,
+                                   directions=args.directions,
+                                   host=args.host, port=args.port,
+                                   batch_size=args.batch_size,
+                                   lease_timeout=args.lease_timeout,
+                                   secret=args.secret)
+    coordinator.start()
+    print 'coordinating at %s:%d' % coordinator.address
+
+    while not coordinator.wait(args.export_interval):
+        coordinator.export_data()
+    coordinator.export_data()
+    coordinator.stop()
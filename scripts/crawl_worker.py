@@ -0,0 +1,33 @@
+# explore the nodes handed out by a coordinator (see crawl_coordinator.py)
+import json
+from threading import Thread
+from argparse import ArgumentParser
+
+from tweegraph.distributed import crawl_worker
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='worker of a distributed crawl')
+
+    parser.add_argument('coordinator', metavar='coordinator', type=str,
+                        help='host:port of the coordinator')
+    parser.add_argument('-c', '--credentials', dest='credentials', type=str,
+                        default='credentials.json',
+                        help='json file with a list of api tokens, each '
+                             'optionally with its own proxy')
+    parser.add_argument('--secret', dest='secret', type=str, default=None)
+
+    args = parser.parse_args()
+    host, port = args.coordinator.rsplit(':', 1)
+
+    with open(args.credentials) as credentials_file:
+        credentials = json.load(credentials_file)
+
+    # one worker per api key
+    workers = [Thread(target=crawl_worker, args=((host, int(port)),),
+                      kwargs={'api': tokens, 'secret': args.secret})
+               for tokens in credentials]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -1,6 +1,7 @@
 # create dataset from edges file
 from argparse import ArgumentParser
 from itertools import combinations
+import numpy as np
 import pandas as pd
 
 from tweegraph.data import get_unique_nodes_from_file as unique_nodes
@@ -23,28 +24,134 @@ def get_pair_labels(id_1, id_2):
     return (friends_or_not)
 
 
+def get_edge_index(edges, nodes):
+    """encode the undirected edges as sorted unique integer keys
+    index_1 * len(nodes) + index_2 with index_1 < index_2, where index is the
+    position of a node in the sorted nodes array
+    """
+    index_1 = np.searchsorted(nodes, edges[:, 0])
+    index_2 = np.searchsorted(nodes, edges[:, 1])
+    low, high = np.minimum(index_1, index_2), np.maximum(index_1, index_2)
+    keys = low * len(nodes) + high
+    return np.unique(keys[low != high])
+
+
+def is_edge(edge_index, keys):
+    positions = np.searchsorted(edge_index, keys)
+    positions[positions == len(edge_index)] = 0
+    return edge_index[positions] == keys if len(edge_index) else \
+        np.zeros(len(keys), dtype=bool)
+
+
+def generate_pairs(size, chunk_size):
+    """yield the keys of all the pairs of size nodes in chunks of at most
+    chunk_size keys, without materializing all the pairs
+    """
+    chunk = []
+    chunk_len = 0
+    for index_1 in range(size - 1):
+        start = index_1 + 1
+        while start < size:
+            stop = min(size, start + chunk_size - chunk_len)
+            chunk.append(index_1 * size + np.arange(start, stop,
+                                                    dtype=np.int64))
+            chunk_len += stop - start
+            start = stop
+            if chunk_len == chunk_size:
+                yield np.concatenate(chunk)
+                chunk = []
+                chunk_len = 0
+    if chunk:
+        yield np.concatenate(chunk)
+
+
+def sample_pairs(edge_index, size, ratio, chunk_size, seed=None):
+    """yield the keys of all the edges followed by ratio times as many keys of
+    uniformly sampled pairs that are not edges, in chunks
+    """
+    for start in range(0, len(edge_index), chunk_size):
+        yield edge_index[start:start + chunk_size]
+
+    available = size * (size - 1) // 2 - len(edge_index)
+    wanted = min(int(round(ratio * len(edge_index))), available)
+    random = np.random.RandomState(seed)
+    negatives = np.zeros(0, dtype=np.int64)
+    while len(negatives) < wanted:
+        count = 2 * (wanted - len(negatives)) + 16
+        index_1 = random.randint(0, size, count).astype(np.int64)
+        index_2 = random.randint(0, size, count).astype(np.int64)
+        low, high = np.minimum(index_1, index_2), np.maximum(index_1, index_2)
+        keys = (low * size + high)[low != high]
+        keys = keys[~is_edge(edge_index, keys)]
+        negatives = np.unique(np.concatenate([negatives, keys]))
+    negatives = random.permutation(negatives)[:wanted]
+
+    for start in range(0, wanted, chunk_size):
+        yield np.sort(negatives[start:start + chunk_size])
+
+
+def write_pairs(file_name, nodes, edge_index, chunks):
+    """write the labeled pairs of every chunk of keys to a csv file with the
+    columns pair_id, id_1, id_2 and friends. pair_id is the integer key
+    """
+    size = len(nodes)
+    with open(file_name, 'w') as output:
+        output.write('pair_id,id_1,id_2,friends\n')
+        for keys in chunks:
+            chunk = pd.DataFrame({'pair_id': keys,
+                                  'id_1': nodes[keys // size],
+                                  'id_2': nodes[keys % size],
+                                  'friends': is_edge(edge_index,
+                                                     keys).astype(int)})
+            chunk.to_csv(output, header=False, index=False,
+                         columns=['pair_id', 'id_1', 'id_2', 'friends'])
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description='create_dataset')
 
     parser.add_argument('input_file',
                         metavar='input_file', type=str,
                         help='csv file that describes edges of the graph')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true',
+                        help='write pairs in chunks with integer pair ids')
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', type=int,
+                        default=1000000, help='pairs per chunk')
+    parser.add_argument('-n', '--negative_ratio', dest='negative_ratio',
+                        type=float, default=None,
+                        help='keep all edges and sample this many non edges '
+                             'per edge instead of writing all pairs')
+    parser.add_argument('--seed', dest='seed', type=int, default=None)
 
     args = parser.parse_args()
     file_name = args.input_file
 
-    # taking the list of the unique nodes and creating all the pairs
-    nodes = unique_nodes(file_name)
-    pairs = list(combinations(nodes, 2))
+    if args.stream or args.negative_ratio is not None:
+        edges = np.asarray(pd.read_csv(file_name, names=['id_1', 'id_2']),
+                           dtype=np.int64).reshape(-1, 2)
+        nodes = np.unique(edges)
+        edge_index = get_edge_index(edges, nodes)
+
+        if args.negative_ratio is None:
+            chunks = generate_pairs(len(nodes), args.chunk_size)
+        else:
+            chunks = sample_pairs(edge_index, len(nodes), args.negative_ratio,
+                                  args.chunk_size, args.seed)
+        write_pairs('labeled_pairs.csv', nodes, edge_index, chunks)
+    else:
+        # taking the list of the unique nodes and creating all the pairs
+        nodes = unique_nodes(file_name)
+        pairs = list(combinations(nodes, 2))
 
-    # turning edges to dict for fast look up
-    edges = pd.read_csv(file_name, names=['id_1', 'id_2'])
-    edges['label'] = 1
-    edges = edges.set_index(['id_1', 'id_2']).to_dict()['label']
+        # turning edges to dict for fast look up
+        edges = pd.read_csv(file_name, names=['id_1', 'id_2'])
+        edges['label'] = 1
+        edges = edges.set_index(['id_1', 'id_2']).to_dict()['label']
 
-    data_set = pd.DataFrame(columns=['id_1', 'id_2', 'friends'])
-    data_set['pair_id'] = map(lambda x: get_pair_id(x[0], x[1]), pairs)
-    data_set['friends'] = map(lambda x: get_pair_labels(x[0], x[1]), pairs)
+        data_set = pd.DataFrame(columns=['id_1', 'id_2', 'friends'])
+        data_set['pair_id'] = map(lambda x: get_pair_id(x[0], x[1]), pairs)
+        data_set['friends'] = map(lambda x: get_pair_labels(x[0], x[1]),
+                                  pairs)
 
-    data_set.to_csv('labeled_pairs.csv', names=True, index=False,
-                    columns=['pair_id', 'friends'])
+        data_set.to_csv('labeled_pairs.csv', names=True, index=False,
+                        columns=['pair_id', 'friends'])
@@ -0,0 +1,26 @@
+from argparse import ArgumentParser
+
+from tweegraph.db import migrate_to_single_collection
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='migrate timelines from a collection '
+                                        'per user to a single collection')
+
+    parser.add_argument('-d', '--db_name', dest='db', type=str,
+                        default='twitter_users')
+    parser.add_argument('-t', '--target_db', dest='target_db', type=str,
+                        default=None,
+                        help='database to migrate to. Defaults to db_name, '
+                             'next to the user collections')
+    parser.add_argument('-b', '--batch_size', dest='batch_size', type=int,
+                        default=1000)
+    parser.add_argument('--drop', dest='drop', action='store_true',
+                        help='drop user collections once they are migrated')
+
+    args = parser.parse_args()
+
+    count = migrate_to_single_collection(args.db, target_db=args.target_db,
+                                         batch_size=args.batch_size,
+                                         drop=args.drop)
+    print 'migrated %d statuses' % count
@@ -4,6 +4,7 @@ import pandas as pd
 from argparse import ArgumentParser
 
 from tweegraph.data import get_mutual_following_edges as mutual_edges
+from tweegraph.data import get_mutual_following_dict as mutual_dict
 
 
 if __name__ == "__main__":
@@ -12,6 +13,9 @@ if __name__ == "__main__":
     parser.add_argument('input_file',
                         metavar='input_file', type=str,
                         help='csv file that describes edges of the graph')
+    parser.add_argument('-j', '--json', dest='json', action='store_true',
+                        help='also write the mutual relations dictionary to '
+                             'mutual_following.json')
 
     args = parser.parse_args()
     file_name = args.input_file
@@ -25,3 +29,7 @@ if __name__ == "__main__":
 
     m_edges.to_csv('mutual_following.csv', columns=['follower', 'node'],
                    names=False, index=False)
+
+    if args.json:
+        with open('mutual_following.json', 'w') as json_file:
+            json.dump(mutual_dict(relations_dict), json_file)
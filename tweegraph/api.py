@@ -1,5 +1,6 @@
 import tweepy
-from time import sleep
+from time import sleep, time
+from threading import Lock as thread_lock
 
 
 def create_api_instance(tokens):
@@ -11,31 +12,251 @@ def create_api_instance(tokens):
     ----------
     tokens : dict{'api_key': <api_key>, 'api_secret': <api_secret>,
                   'access': <access>, 'access_secret': <secret_access>}
+        optionally with the keys 'proxy' and 'host'. 'host' replaces
+        api.twitter.com, e.g. for pointing the crawler to a
+        tweegraph.mock_server.MockTwitterServer
     """
     auth = tweepy.OAuthHandler(tokens['api_key'], tokens['api_secret'])
     auth.set_access_token(tokens['access'], tokens['access_secret'])
+    kwargs = {}
     if 'proxy' in tokens:
-        api = tweepy.API(auth, proxy=tokens['proxy'])
-    else:
-        api = tweepy.API(auth)
+        kwargs['proxy'] = tokens['proxy']
+    if 'host' in tokens:
+        kwargs['host'] = tokens['host']
+    api = tweepy.API(auth, **kwargs)
     return api
 
 
-def request_handler(cursor, logger):
+class RateLimitScheduler(object):
     """
-    handle requests. If limit reached halt for 15 min
+    RateLimitScheduler class. Paces the requests made with a single api token
+    against a single endpoint using the x-rate-limit-remaining and
+    x-rate-limit-reset headers that twitter returns with every response. The
+    remaining calls of the window are spread evenly until the reset time and
+    once the budget is spent the scheduler sleeps only until the real reset.
+    A scheduler can be shared among threads that use the same token, each
+    thread with its own api instance (see share).
+
+    Parameters
+    ----------
+    api    : tweepy.api instance whose last_response is used for reading the
+        rate limit headers
+    pace   : bool
+        set to False to spend the remaining budget without pacing and only
+        sleep once it is exhausted. Defaults to True
+    margin : seconds to wait after the reported reset time. Defaults to 1
+    interrupt : threading.Event that, once set, cuts the sleeps short and
+        makes request_handler stop requesting. Defaults to None
+
+    Methods
+    -------
+    update       : reads the rate limit headers of a response
+    delay        : returns the seconds to wait before the next request
+    reserve      : reserves the next request slot and returns the seconds
+        until it
+    wait         : reserves the next request slot and sleeps until it
+    record_sleep : records sleep time without sleeping
+    halt         : sleeps for the given seconds and records the sleep time
+    interrupted  : returns True once the interrupt event is set
+    share        : returns a scheduler for another api instance of the same
+        token
+    """
+    def __init__(self, api=None, pace=True, margin=1, interrupt=None):
+        self.api = api
+        self.pace = pace
+        self.margin = margin
+        self.interrupt = interrupt
+        self.remaining = None
+        self.reset = None
+        self.last_request = None
+        self.sleep_time = 0
+        self.requests = 0
+        self.lock = thread_lock()
+
+    def update(self, response=None):
+        """
+        read the rate limit headers of the response. If no response is given
+        the last response of the api instance is used. Responses of
+        concurrent requests arrive out of order, so within the same window
+        only a lower remaining budget is applied and headers of an older
+        window are ignored
+        """
+        if response is None and self.api is not None:
+            response = getattr(self.api, 'last_response', None)
+        headers = getattr(response, 'headers', None) or {}
+
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        remaining = int(remaining) if remaining is not None else None
+        reset = int(reset) if reset is not None else None
+        self.lock.acquire()
+        try:
+            if reset is not None and self.reset is not None and \
+                    reset < self.reset:
+                return
+            if reset is not None and reset != self.reset:
+                self.reset = reset
+                if remaining is not None:
+                    self.remaining = remaining
+            elif remaining is not None:
+                if self.remaining is None:
+                    self.remaining = remaining
+                else:
+                    self.remaining = min(self.remaining, remaining)
+        finally:
+            self.lock.release()
+
+    def delay(self, now=None):
+        """
+        return the number of seconds to wait before issuing the next request
+        """
+        if now is None:
+            now = time()
+        if self.reset is None or self.remaining is None:
+            return 0
+        until_reset = self.reset - now
+        if until_reset <= 0:
+            return 0
+        if self.remaining <= 0:
+            return until_reset + self.margin
+        if not self.pace or self.last_request is None:
+            return 0
+        interval = (until_reset + self.margin) / float(self.remaining)
+        return max(0, self.last_request + interval - now)
+
+    def reserve(self):
+        """
+        reserve the next request slot, so that concurrent requests are spread
+        as well, and return the seconds until it
+        """
+        self.lock.acquire()
+        try:
+            now = time()
+            delay = self.delay(now)
+            self.last_request = now + delay
+            self.requests += 1
+            # the reserved request is spent from the current window
+            if self.remaining and now + delay < self.reset:
+                self.remaining -= 1
+        finally:
+            self.lock.release()
+        return delay
+
+    def wait(self):
+        """
+        reserve the next request slot and sleep until it
+        """
+        self.halt(self.reserve())
+
+    def record_sleep(self, delay):
+        """
+        add delay seconds to the recorded sleep time
+        """
+        self.lock.acquire()
+        try:
+            self.sleep_time += delay
+        finally:
+            self.lock.release()
+
+    def halt(self, delay):
+        """
+        sleep for delay seconds and add them to the recorded sleep time
+        """
+        if delay <= 0:
+            return
+        self.record_sleep(delay)
+        if self.interrupt is not None:
+            self.interrupt.wait(delay)
+        else:
+            sleep(delay)
+
+    def interrupted(self):
+        return self.interrupt is not None and self.interrupt.is_set()
+
+    def share(self, api):
+        """
+        return a scheduler that reads the responses of api but paces its
+        requests with the budget of this scheduler
+        """
+        return SharedRateLimitScheduler(self, api)
+
+
+class SharedRateLimitScheduler(object):
+    """
+    view of a RateLimitScheduler for a different api instance of the same
+    token. Used when several threads make requests with the same token
+    """
+    def __init__(self, scheduler, api):
+        self.scheduler = scheduler
+        self.api = api
+
+    def update(self, response=None):
+        if response is None:
+            response = getattr(self.api, 'last_response', None)
+        self.scheduler.update(response)
+
+    def delay(self, now=None):
+        return self.scheduler.delay(now)
+
+    def reserve(self):
+        return self.scheduler.reserve()
+
+    def wait(self):
+        self.scheduler.wait()
+
+    def halt(self, delay):
+        self.scheduler.halt(delay)
+
+    def interrupted(self):
+        return self.scheduler.interrupted()
+
+
+def is_rate_limit_error(error):
+    """
+    return True if the tweepy error was caused by reaching the rate limit
+    """
+    if isinstance(error, tweepy.RateLimitError):
+        return True
+    return 'code' in error.message[0] and error.message[0]['code'] == 88 or \
+        str(error.response) == '<Response [429]>'
+
+
+def halt_on_rate_limit(logger, scheduler=None, log_msg=''):
+    """
+    halt until the rate limit window resets. When no scheduler is provided,
+    or the reset time is unknown, halt for 15 min
+    """
+    delay = scheduler.delay() if scheduler else 0
+    if not delay:
+        delay = 15 * 60
+    logger.info('Limit reached. Halting for %d sec. ' % delay + log_msg)
+    if scheduler:
+        scheduler.halt(delay)
+    else:
+        sleep(delay)
+    logger.info('Worker is active again')
+
+
+def request_handler(cursor, logger, scheduler=None):
+    """
+    handle requests. If limit reached halt until the window resets. When no
+    scheduler is provided, or the reset time is unknown, halt for 15 min.
+    Stops once the scheduler is interrupted
     """
     retries = 0
     while True:
+        if scheduler:
+            scheduler.wait()
+            if scheduler.interrupted():
+                return
         try:
-            yield cursor.next()
+            response = cursor.next()
         except tweepy.TweepError as e:
             LOG_MSG = 'exploring node: ' + str(cursor.__dict__['kargs']['id'])
-            if 'code' in e.message[0] and e.message[0]['code'] == 88 or \
-                    str(e.response) == '<Response [429]>':
-                logger.info('Limit reached. Halting for 15 min. ' + LOG_MSG)
-                sleep(15 * 60)
-                logger.info('Worker is active again')
+            if scheduler:
+                scheduler.update(e.response)
+            if is_rate_limit_error(e):
+                halt_on_rate_limit(logger, scheduler, LOG_MSG)
             else:
                 if e[0][:22] == 'Failed to send request':
                     if retries == 100:
@@ -48,9 +269,14 @@ def request_handler(cursor, logger):
                 else:
                     logger.warning(str(e) + ' ' + LOG_MSG)
                     yield None
+        else:
+            if scheduler:
+                scheduler.update()
+            yield response
 
 
-def request_data(query, node, size=None, logger=None):
+def request_data(query, node, size=None, logger=None, scheduler=None,
+                 since_id=None, strict=False):
     """request data from twitter
 
     Parameters
@@ -60,6 +286,13 @@ def request_data(query, node, size=None, logger=None):
         size   : amount of requested items (optional)
             used when specific amount of items is required.
         logger : logger instance to be used for logging events
+        scheduler : RateLimitScheduler instance used for pacing the requests
+            of the query (optional)
+        since_id : request only statuses newer than this id (optional)
+            used with timeline queries
+        strict : set to True to get None instead of an empty list when a
+            request fails, so that failures can be told apart from queries
+            without data (optional)
     Returns
     -------
         data : a list with the requested data, if data are available
@@ -80,14 +313,71 @@ def request_data(query, node, size=None, logger=None):
     """
     data = []
     handler = request_handler
-    if not size:
-        for page in handler(tweepy.Cursor(query, id=node).pages(), logger):
-            if not page:
-                return []
-            data.extend(page)
-    else:
-        for item in handler(tweepy.Cursor(query, id=node).items(size), logger):
-            if not item:
-                return []
-            data.append(item)
+    kwargs = {'id': node}
+    if since_id:
+        kwargs['since_id'] = since_id
+    # items are collected page by page so that the scheduler paces actual
+    # requests and not every single item
+    for page in handler(tweepy.Cursor(query, **kwargs).pages(), logger,
+                        scheduler):
+        if page is None and strict:
+            return None
+        if not page:
+            return []
+        data.extend(page)
+        if size and len(data) >= size:
+            return data[:size]
     return data
+
+
+def lookup_users(api, user_ids, logger, scheduler=None):
+    """resolve user ids to user objects with users/lookup, up to 100 ids per
+    request. Deleted and suspended users are not returned by twitter.
+
+    Parameters
+    ----------
+        api       : tweepy.api instance
+        user_ids  : list of twitter ids
+        logger    : logger instance to be used for logging events
+        scheduler : RateLimitScheduler instance used for pacing the requests
+            of users/lookup (optional)
+    Returns
+    -------
+        users : dict{user_id: tweepy.models.User} or None if a request failed
+            or the scheduler was interrupted
+    """
+    users = {}
+    for idx in range(0, len(user_ids), 100):
+        batch = user_ids[idx: idx + 100]
+        retries = 0
+        while True:
+            if scheduler:
+                scheduler.wait()
+                if scheduler.interrupted():
+                    return None
+            try:
+                result = api.lookup_users(user_ids=batch)
+            except tweepy.TweepError as e:
+                LOG_MSG = 'looking up %d users' % len(batch)
+                if scheduler:
+                    scheduler.update(e.response)
+                if is_rate_limit_error(e):
+                    halt_on_rate_limit(logger, scheduler, LOG_MSG)
+                elif e[0][:22] == 'Failed to send request' and retries < 100:
+                    retries += 1
+                    sleep(0.5)
+                elif str(e.response) == '<Response [404]>':
+                    # none of the ids matches an existing user
+                    result = []
+                    break
+                else:
+                    logger.warning(str(e) + ' ' + LOG_MSG)
+                    return None
+            else:
+                if scheduler:
+                    scheduler.update()
+                break
+        for user in result:
+            users[user.id] = user
+
+    return users
@@ -0,0 +1,62 @@
+"""memory bounded set membership for twitter ids
+"""
+
+from __future__ import division
+import math
+import numpy as np
+
+_MASK = (1 << 64) - 1
+
+
+def _mix(value):
+    """64 bit mixing function (splitmix64 finalizer)"""
+    value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9 & _MASK
+    value = (value ^ (value >> 27)) * 0x94d049bb133111eb & _MASK
+    return value ^ (value >> 31)
+
+
+class BloomFilter(object):
+    """
+    BloomFilter class. Keeps track of a set of integer ids in a fixed size
+    bit array. Membership tests can return false positives with the given
+    rate, but never false negatives.
+
+    Parameters
+    ----------
+    capacity   : expected number of ids to be added
+    error_rate : false positive rate when capacity ids have been added.
+        Defaults to 0.001
+
+    Methods
+    -------
+    add          : adds an id to the filter
+    __contains__ : tests whether an id has been added
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, node):
+        # double hashing: h_i = h_1 + i * h_2
+        h_1 = _mix(int(node) & _MASK)
+        h_2 = _mix(h_1) | 1
+        return [(h_1 + i * h_2) % self.size for i in range(self.hashes)]
+
+    def add(self, node):
+        for position in self._positions(node):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, node):
+        for position in self._positions(node):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
@@ -1,8 +1,16 @@
 # helper functions to manipulate the data
 
+import os
+import json
+import struct
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 
+# binary array files: magic, header length, json header, aligned arrays
+_ARRAYS_MAGIC = 'TWGRAPH1'
+_ARRAYS_ALIGNMENT = 64
+
 
 def get_unique_nodes_from_file(file_name):
     """Returns all the unique nodes contained in a file that describes edges
@@ -23,6 +31,36 @@ def get_unique_nodes_from_file(file_name):
     return list(nodes)
 
 
+def get_relations_from_log(file_name):
+    """Produce the relations dictionary from a log file written by
+    TwitterGraphTraverser in 'log' export mode. The result has the same form
+    as the json file written in 'json' export mode.
+
+    Parameters
+    ----------
+    file_name : str
+        log file with one json record {'id', 'followers', 'following'} per line
+
+    Returns
+    -------
+    relations : dictionary of dictionaries
+        A dictionary that contains a dictionary with the keys 'following' and
+        'followers' for each key (id)
+    """
+    relations = {}
+    with open(file_name) as log:
+        for line in log:
+            # skip a partially written last line
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            relations[str(record['id'])] = {'followers': record['followers'],
+                                            'following': record['following']}
+
+    return relations
+
+
 def get_unique_nodes_from_dict(relations):
     """Produce list on unique nodes in the dictionary
 
@@ -75,7 +113,8 @@ def get_edges_from_dict(relations):
 def get_mutual_following_edges(relations, edges=None):
     """Produce the list mutual following edges. By using the following list of
     each node and the relations dictionay it determines which edges are
-    birected
+    birected. Edges are encoded as int64 keys and matched against the
+    reversed following edges with a sorted join, in O(n log n)
 
     Parameters
     ----------
@@ -91,17 +130,15 @@ def get_mutual_following_edges(relations, edges=None):
     mutual_edges : list of tuples nodes in the form (follower, node)
         list of bidirectional edges
     """
-    bi_edges = []
-    if not edges:
-        edges = get_edges_from_dict(relations)
+    if edges is None or not len(edges):
+        edges = _get_edge_arrays(relations)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    nodes, friends = _get_following_arrays(relations)
 
-    relations = {str(key): value for key, value in relations.items()}
-    for follower, node in edges:
-        if str(node) in relations and \
-                follower in relations[str(node)]['following']:
-            bi_edges.append((follower, node))
+    # (follower, node) is mutual if node follows follower
+    mutual = _pairs_in(edges[:, 1], edges[:, 0], nodes, friends)
 
-    return bi_edges
+    return [tuple(edge) for edge in edges[mutual].tolist()]
 
 
 def get_mutual_following_dict(relations, edges=None):
@@ -122,14 +159,316 @@ def get_mutual_following_dict(relations, edges=None):
     """
     mu_dict = defaultdict(dict)
 
-    relations = {str(key): value for key, value in relations.items()}
-    for node_id in relations:
-        following = []
-        for friend in relations[node_id]['following']:
-            if str(friend) in relations: # and \
-                if node_id in relations[str(friend)]['following']:
-                    following.append(friend)
+    keys = list(relations)
+    nodes, friends = _get_following_arrays(relations, keys)
+    # the friend follows the node back
+    mutual = _pairs_in(friends, nodes, nodes, friends)
+
+    offset = 0
+    friends = friends.tolist()
+    for key in keys:
+        size = len(relations[key]['following'])
+        following = [friend for friend, is_mutual in
+                     zip(friends[offset:offset + size],
+                         mutual[offset:offset + size]) if is_mutual]
+        offset += size
         if following:
-            mu_dict[node_id] = {'following': following}
+            mu_dict[str(key)] = {'following': following}
 
     return mu_dict
+
+
+def _get_edge_arrays(relations):
+    """array of shape (n, 2) of the edges returned by get_edges_from_dict, in
+    the same order
+    """
+    blocks = [np.zeros((0, 2), dtype=np.int64)]
+    for key in relations:
+        node = int(key)
+        followers = np.array(relations[key]['followers'], dtype=np.int64)
+        following = np.array(relations[key]['following'], dtype=np.int64)
+        block = np.empty((len(followers) + len(following), 2), dtype=np.int64)
+        block[:len(followers), 0] = followers
+        block[:len(followers), 1] = node
+        block[len(followers):, 0] = node
+        block[len(followers):, 1] = following
+        blocks.append(block)
+    return np.concatenate(blocks)
+
+
+def _get_following_arrays(relations, keys=None):
+    """returns two int64 arrays with a (node, friend) pair for every entry of
+    the following lists of the relations dictionary, in order
+    """
+    keys = list(relations) if keys is None else keys
+    sizes = [len(relations[key]['following']) for key in keys]
+    nodes = np.repeat(np.array([int(key) for key in keys], dtype=np.int64),
+                      sizes)
+    friends = np.fromiter((friend for key in keys
+                           for friend in relations[key]['following']),
+                          dtype=np.int64, count=sum(sizes))
+    return nodes, friends
+
+
+def _pairs_in(sources, targets, index_sources, index_targets):
+    """returns a boolean array telling which (source, target) pairs are among
+    the (index_source, index_target) pairs. Ids are remapped to dense ids so
+    that every pair fits in a single int64 key
+    """
+    ids, dense = np.unique(np.concatenate([sources, targets, index_sources,
+                                           index_targets]),
+                           return_inverse=True)
+    size = len(ids)
+    dense = dense.astype(np.int64)
+    count, index_count = len(sources), len(index_sources)
+    keys = dense[:count] * size + dense[count:2 * count]
+    index_keys = dense[2 * count:2 * count + index_count] * size + \
+        dense[2 * count + index_count:]
+    return np.in1d(keys, index_keys)
+
+
+def save_arrays(file_name, arrays, meta=None):
+    """Store numpy arrays in a single binary file that can be memory mapped
+    by load_arrays. Arrays are written raw, aligned to 64 bytes, after a json
+    header that describes their dtype, shape and offset.
+
+    Parameters
+    ----------
+    file_name : str
+        file to write to
+    arrays    : dict of numpy arrays
+    meta      : (optional) json serializable value stored in the header
+    """
+    def align(offset):
+        return -(-offset // _ARRAYS_ALIGNMENT) * _ARRAYS_ALIGNMENT
+
+    arrays = dict((name, np.ascontiguousarray(array))
+                  for name, array in arrays.items())
+    specs = {}
+    offset = 0
+    for name in sorted(arrays):
+        specs[name] = {'dtype': arrays[name].dtype.str,
+                       'shape': list(arrays[name].shape),
+                       'offset': offset}
+        offset = align(offset + arrays[name].nbytes)
+    header = json.dumps({'meta': meta, 'arrays': specs})
+    data_start = align(len(_ARRAYS_MAGIC) + 8 + len(header))
+
+    with open(file_name, 'wb') as array_file:
+        array_file.write(_ARRAYS_MAGIC)
+        array_file.write(struct.pack('<Q', len(header)))
+        array_file.write(header)
+        for name in sorted(arrays):
+            array_file.seek(data_start + specs[name]['offset'])
+            array_file.write(arrays[name].tobytes())
+        array_file.truncate(data_start + offset)
+
+
+def load_arrays(file_name, mmap=True):
+    """Load the arrays stored by save_arrays
+
+    Parameters
+    ----------
+    file_name : str
+        file written by save_arrays
+    mmap      : bool
+        memory map the arrays read only instead of reading them in memory.
+        Defaults to True
+
+    Returns
+    -------
+    arrays : dict of numpy arrays
+    meta   : the meta value given to save_arrays
+    """
+    with open(file_name, 'rb') as array_file:
+        if array_file.read(len(_ARRAYS_MAGIC)) != _ARRAYS_MAGIC:
+            raise ValueError('%s is not an array file' % file_name)
+        header_size, = struct.unpack('<Q', array_file.read(8))
+        header = json.loads(array_file.read(header_size))
+        data_start = -(-(len(_ARRAYS_MAGIC) + 8 + header_size) //
+                       _ARRAYS_ALIGNMENT) * _ARRAYS_ALIGNMENT
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(str(spec['dtype']))
+            shape = tuple(spec['shape'])
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(file_name, dtype=dtype, mode='r',
+                                         offset=data_start + spec['offset'],
+                                         shape=shape)
+            else:
+                array_file.seek(data_start + spec['offset'])
+                arrays[name] = np.fromfile(array_file, dtype=dtype,
+                                           count=count).reshape(shape)
+
+    return arrays, header['meta']
+
+
+class CSRGraph(object):
+    """
+    CSRGraph class. Adjacency of a graph in compressed sparse row arrays over
+    dense node ids 0..n-1. nodes holds the twitter id of every dense id, in
+    ascending order, so it doubles as the table of unique nodes and ids are
+    remapped with a binary search. Directed graphs keep the adjacency of both
+    directions, following (out) and followers (in). The arrays can be saved
+    to a binary file and memory mapped from it.
+
+    Parameters
+    ----------
+    arrays   : dict of numpy arrays as built by from_edges or read by load
+    directed : whether the graph is directed
+
+    Methods
+    -------
+    from_edges   : builds the graph from an array of (follower, node) edges
+    from_csv     : builds the graph from an edges csv file such as links.csv
+    save         : writes the graph to a binary file
+    load         : reads or memory maps a graph written by save
+    index        : returns the dense ids of twitter ids
+    successors   : returns the twitter ids a node points to
+    predecessors : returns the twitter ids that point to a node
+    out_degree   : returns the out degree of every node
+    in_degree    : returns the in degree of every node
+    """
+    def __init__(self, arrays, directed=True):
+        self.directed = directed
+        self.nodes = arrays['nodes']
+        self.out_indptr = arrays['out_indptr']
+        self.out_indices = arrays['out_indices']
+        self.in_indptr = arrays.get('in_indptr', self.out_indptr)
+        self.in_indices = arrays.get('in_indices', self.out_indices)
+
+    @classmethod
+    def from_edges(cls, edges, directed=True):
+        """build the graph from an array of shape (n, 2) of (follower, node)
+        edges. Duplicate edges are dropped. For undirected graphs every edge
+        is stored in both directions
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        nodes = np.unique(edges)
+        sources = np.searchsorted(nodes, edges[:, 0])
+        targets = np.searchsorted(nodes, edges[:, 1])
+        if not directed:
+            sources, targets = (np.concatenate([sources, targets]),
+                                np.concatenate([targets, sources]))
+
+        arrays = {'nodes': nodes}
+        arrays['out_indptr'], arrays['out_indices'] = \
+            cls._compress(sources, targets, len(nodes))
+        if directed:
+            arrays['in_indptr'], arrays['in_indices'] = \
+                cls._compress(targets, sources, len(nodes))
+        return cls(arrays, directed)
+
+    @staticmethod
+    def _compress(sources, targets, size):
+        keys = np.unique(sources * size + targets)
+        sources, targets = keys // size, keys % size
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=size))
+        return indptr, targets
+
+    @classmethod
+    def from_csv(cls, file_name, directed=True):
+        """build the graph from a csv file with two columns of node ids"""
+        edges = pd.read_csv(file_name, names=['follower', 'node'],
+                            dtype=np.int64)
+        return cls.from_edges(edges.values, directed)
+
+    def save(self, file_name):
+        arrays = {'nodes': self.nodes,
+                  'out_indptr': self.out_indptr,
+                  'out_indices': self.out_indices}
+        if self.directed:
+            arrays['in_indptr'] = self.in_indptr
+            arrays['in_indices'] = self.in_indices
+        save_arrays(file_name, arrays,
+                    meta={'type': 'csr_graph', 'directed': self.directed})
+
+    @classmethod
+    def load(cls, file_name, mmap=True):
+        """read a graph written by save. With mmap the arrays are memory
+        mapped read only instead of read in memory
+        """
+        arrays, meta = load_arrays(file_name, mmap)
+        if not meta or meta.get('type') != 'csr_graph':
+            raise ValueError('%s is not a csr graph' % file_name)
+        return cls(arrays, meta['directed'])
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        edges = len(self.out_indices)
+        return edges if self.directed else edges // 2
+
+    def index(self, node_ids):
+        """returns the dense ids of the given twitter ids. Raises KeyError for
+        unknown ids
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        flat = node_ids.reshape(-1)
+        dense = np.searchsorted(self.nodes, flat)
+        found = dense < len(self.nodes)
+        found[found] = self.nodes[dense[found]] == flat[found]
+        if not found.all():
+            raise KeyError(str(flat[~found][0]))
+        return dense.reshape(node_ids.shape) if node_ids.ndim else dense[0]
+
+    def successors(self, node, dense=False):
+        """twitter ids of the nodes that node points to (its following). With
+        dense the dense ids are returned as a view of the adjacency
+        """
+        idx = self.index(node)
+        neighbors = self.out_indices[self.out_indptr[idx]:
+                                     self.out_indptr[idx + 1]]
+        return neighbors if dense else self.nodes[neighbors]
+
+    def predecessors(self, node, dense=False):
+        """twitter ids of the nodes that point to node (its followers)"""
+        idx = self.index(node)
+        neighbors = self.in_indices[self.in_indptr[idx]:
+                                    self.in_indptr[idx + 1]]
+        return neighbors if dense else self.nodes[neighbors]
+
+    neighbors = successors
+
+    def out_degree(self):
+        return np.diff(self.out_indptr)
+
+    def in_degree(self):
+        return np.diff(self.in_indptr)
+
+
+def load_graph(file_name, directed=True, cache=True):
+    """Load the graph of an edges csv file as a CSRGraph. The graph is cached
+    in a binary file next to the csv file (file_name.directed.csr or
+    file_name.undirected.csr) and the cache is memory mapped by later calls,
+    unless the csv file has been modified since
+
+    Parameters
+    ----------
+    file_name : str
+        csv file with two columns that both contain node ids
+    directed  : bool
+        treat the edges as directed. Defaults to True
+    cache     : bool
+        read and write the binary cache. Defaults to True
+
+    Returns
+    -------
+    graph : CSRGraph
+    """
+    cache_name = '%s.%s.csr' % (file_name,
+                                'directed' if directed else 'undirected')
+    if cache and os.path.exists(cache_name) and \
+            os.path.getmtime(cache_name) >= os.path.getmtime(file_name):
+        return CSRGraph.load(cache_name)
+
+    graph = CSRGraph.from_csv(file_name, directed)
+    if cache:
+        graph.save(cache_name)
+    return graph
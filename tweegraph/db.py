@@ -1,52 +1,469 @@
 # MongoDB queries
+import Queue
+import logging
+from itertools import groupby
 from collections import defaultdict
-from pymongo import MongoClient
+from multiprocessing import Pool
+from threading import Thread, Lock as thread_lock
+from bson import BSON
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from pymongo.errors import DocumentTooLarge as DocumentTooLargeError
-from pymongo.errors import WriteError
+from pymongo.errors import WriteError, BulkWriteError
 
-from tweegraph.sentiment_analyzer import get_tweet_score, determine_polarity
+from tweegraph.sentiment_analyzer import get_tweet_scores, determine_polarity
 
+_CLIENT = None
+_CLIENT_LOCK = thread_lock()
 
-def store_timeline(db_name, user_id, timeline):
+# timelines are split in chunk documents well below the 16MB BSON limit
+_MAX_CHUNK_SIZE = 15 * 1024 * 1024
+
+# Timelines are stored in one of two layouts:
+#   'collections' : one collection per user, db_name[str(user_id)], with the
+#                   statuses in (chunk) documents under the key 'content'
+#   'single'      : one collection, db_name['timelines'], with a document per
+#                   status that has the status id as _id and the key user_id
+_TIMELINES = 'timelines'
+# suffix of the collection a merged timeline is written to before it
+# replaces the stored one
+_MERGED_SUFFIX = '_merged'
+_INDEXED = set()
+
+
+def get_client():
+    """returns the MongoClient shared by all the queries of the module. The
+    client is created on first use and keeps its own connection pool, so it
+    is safe to use from multiple threads
+    """
+    global _CLIENT
+    _CLIENT_LOCK.acquire()
+    try:
+        if _CLIENT is None:
+            _CLIENT = MongoClient()
+        return _CLIENT
+    finally:
+        _CLIENT_LOCK.release()
+
+
+def store_timeline(db_name, user_id, timeline, layout='collections'):
     """stores the timeline as a list of json formated statuses in
-    db -> db_name[user_id] under the key 'content'
+    db -> db_name[user_id] under the key 'content'. Timelines larger than the
+    BSON document limit are split in multiple chunk documents, which the
+    readers of this module reassemble transparently. With the 'single' layout
+    every status is stored as a document of db -> db_name['timelines']
 
     db_name  : name of the database
     user_id  : twitter id of user
     timeline : user timeline entity as returned by the twitter api
+    layout   : 'collections' or 'single'. Defaults to 'collections'
+    """
+    db_client = get_client()
+    timeline = [status._json for status in timeline]
+
+    if not timeline:
+        return
+    if layout == 'single':
+        _insert_statuses(db_client, db_name,
+                         _status_documents(user_id, timeline))
+    else:
+        _insert_timeline(db_client[db_name][str(user_id)], user_id, timeline)
+
+
+def ensure_indexes(db_name):
+    """creates the indexes of the 'single' layout timelines collection: user
+    id with tweet id (newest first) and hashtag. The tweet id is the _id of
+    each document
+    """
+    db_client = get_client()
+    collection = db_client[db_name][_TIMELINES]
+    collection.create_index([('user_id', ASCENDING), ('_id', DESCENDING)])
+    collection.create_index('entities.hashtags.text')
+    _INDEXED.add(db_name)
+
+
+def _status_documents(user_id, timeline):
+    """turn statuses in documents of the 'single' layout"""
+    documents = []
+    for status in timeline:
+        document = dict(status)
+        document['_id'] = status['id']
+        document['user_id'] = int(user_id)
+        documents.append(document)
+    return documents
+
+
+def _insert_statuses(db_client, db_name, documents):
+    """insert status documents in the 'single' layout collection, skipping
+    the statuses that are already stored
+    """
+    if db_name not in _INDEXED:
+        ensure_indexes(db_name)
+    _insert_documents(db_client[db_name][_TIMELINES], documents)
+
+
+def _insert_documents(collection, documents):
+    """insert the documents with an unordered insert_many, skipping the ones
+    that are already stored. Returns the number of inserted documents
+    """
+    try:
+        return len(collection.insert_many(documents,
+                                          ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != 11000 for error in errors):
+            raise
+        return e.details.get('nInserted', 0)
+
+
+def _timeline_documents(user_id, timeline):
+    """split the list of statuses, newest first, in chunk documents that fit
+    in the BSON size limit. The size of every status is computed once. The
+    first chunk has user_id as _id and keeps the id of the newest status
+    under the key 'newest_id'
+    """
+    chunks = [[]]
+    size = 0
+    for status in timeline:
+        # encoded status plus the overhead of its array key
+        status_size = len(BSON.encode(status)) + 16
+        if chunks[-1] and size + status_size > _MAX_CHUNK_SIZE:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(status)
+        size += status_size
+
+    documents = []
+    for idx, chunk in enumerate(chunks):
+        document = {'_id': user_id if idx == 0 else '%s_%d' % (user_id, idx),
+                    'chunk': idx, 'content': chunk}
+        documents.append(document)
+    documents[0]['newest_id'] = max(status['id'] for status in timeline)
+    documents[0]['chunks'] = len(chunks)
+
+    return documents
+
+
+def _insert_timeline(collection, user_id, timeline):
+    """insert the list of statuses, newest first, as one or more chunk
+    documents
+    """
+    collection.insert_many(_timeline_documents(user_id, timeline))
+
+
+def _get_statuses(collection, projection=None):
+    """yield the stored statuses of a user's collection, newest first,
+    reassembling chunked timelines
+    """
+    for timeline in collection.find({}, projection).sort('chunk', ASCENDING):
+        for status in timeline['content']:
+            yield status
+
+
+def _user_collections(db_name):
+    """returns the names of the user collections of a db with the
+    'collections' layout. Other collections, e.g. the 'single' layout
+    collection of a db that was migrated in place, are skipped
+    """
+    return [name for name in get_client()[db_name].collection_names()
+            if name.isdigit()]
+
+
+def _get_user_ids(db_name, layout='collections'):
+    """returns the str ids of the users stored in the db"""
+    db_client = get_client()
+    if layout == 'single':
+        users = db_client[db_name][_TIMELINES].distinct('user_id')
+        return [str(user) for user in sorted(users)]
+    return _user_collections(db_name)
+
+
+def _iter_user_statuses(db_name, layout='collections', projection=None,
+                        users=None):
+    """yield (user_id, statuses) pairs for every user stored in the db, or for
+    the given users only, where user_id is a str and statuses an iterator over
+    the user's statuses, newest first. The projection selects the fields of
+    the statuses that are fetched. The 'single' layout is read with one cursor
+    sorted by user, so timelines are streamed instead of being loaded whole.
+    """
+    db_client = get_client()
+    if layout == 'single':
+        query = {}
+        if users is not None:
+            query = {'user_id': {'$in': [int(user) for user in users]}}
+        if projection:
+            projection = dict(projection, user_id=1)
+        cursor = db_client[db_name][_TIMELINES].find(
+            query, projection,
+            sort=[('user_id', ASCENDING), ('_id', DESCENDING)])
+        for user_id, statuses in groupby(cursor, lambda s: s['user_id']):
+            yield str(user_id), statuses
+    else:
+        if projection:
+            projection = dict(('content.' + field, value)
+                              for field, value in projection.items())
+        if users is None:
+            users = _user_collections(db_name)
+        for user in users:
+            yield user, _get_statuses(db_client[db_name][user], projection)
+
+
+def migrate_to_single_collection(db_name, target_db=None, batch_size=1000,
+                                 drop=False):
+    """copies the timelines of a db with the 'collections' layout to the
+    'single' layout
+
+    Parameters
+    ----------
+    db_name    : str
+        name of the database with a collection per user
+    target_db  : str
+        name of the database to write to. Defaults to db_name, where the
+        'timelines' collection is created next to the user collections. The
+        readers of the 'collections' layout skip it
+    batch_size : int
+        number of statuses inserted with one request. Defaults to 1000
+    drop       : bool
+        drop every user collection once it has been copied. Defaults to False
+
+    Returns
+    -------
+    count : number of migrated statuses
+    """
+    target_db = target_db or db_name
+    db_client = get_client()
+    ensure_indexes(target_db)
+
+    count = 0
+    for user in _user_collections(db_name):
+        documents = []
+        for status in _get_statuses(db_client[db_name][user]):
+            documents.extend(_status_documents(int(user), [status]))
+            if len(documents) >= batch_size:
+                _insert_statuses(db_client, target_db, documents)
+                count += len(documents)
+                documents = []
+        if documents:
+            _insert_statuses(db_client, target_db, documents)
+            count += len(documents)
+        if drop:
+            db_client[db_name].drop_collection(user)
+
+    return count
+
+
+def get_newest_tweet_id(db_name, user_id, layout='collections'):
+    """returns the id of the newest stored status of the user or None if no
+    timeline is stored for the user
+
+    Parameters
+    ----------
+    db_name : str
+        name of the database
+    user_id : id of twitter user
+    layout  : 'collections' or 'single'. Defaults to 'collections'
+
+    Returns
+    -------
+    newest_id : int or None
+    """
+    db_client = get_client()
+    if layout == 'single':
+        status = db_client[db_name][_TIMELINES].find_one(
+            {'user_id': int(user_id)}, {'_id': 1},
+            sort=[('_id', DESCENDING)])
+        return status['_id'] if status else None
+
+    timeline = db_client[db_name][str(user_id)].find_one(
+        {'_id': user_id}, {'newest_id': 1, 'content.id': 1})
+    if not timeline:
+        return None
+    if 'newest_id' in timeline:
+        return timeline['newest_id']
+    # timelines stored before newest_id was recorded
+    ids = [status['id'] for status in timeline.get('content', [])]
+    return max(ids) if ids else None
+
+
+def merge_timeline(db_name, user_id, timeline, layout='collections'):
+    """merges newer statuses into the timeline stored in
+    db -> db_name[user_id]. The statuses are put in front of the stored ones
+    and the newest stored tweet id is updated. If the first chunk becomes too
+    large the merged timeline is stored in new chunks. With the 'single'
+    layout the statuses are simply added to db -> db_name['timelines'].
+
+    db_name  : name of the database
+    user_id  : twitter id of user
+    timeline : statuses newer than the stored ones, as returned by the
+        twitter api
+    layout   : 'collections' or 'single'. Defaults to 'collections'
     """
-    db_client = MongoClient()
+    if layout == 'single':
+        return store_timeline(db_name, user_id, timeline, layout)
+
+    db_client = get_client()
     timeline = [status._json for status in timeline]
 
     if timeline:
+        _merge_timeline(db_client[db_name][str(user_id)], user_id, timeline)
+
+
+def _merge_timeline(collection, user_id, timeline):
+    """put the list of statuses in front of the stored ones"""
+    newest_id = max(status['id'] for status in timeline)
+    try:
+        result = collection.update_one(
+            {'_id': user_id},
+            {'$push': {'content': {'$each': timeline, '$position': 0}},
+             '$max': {'newest_id': newest_id}})
+        if not result.matched_count:
+            _insert_timeline(collection, user_id, timeline)
+    except (DocumentTooLargeError, WriteError):
+        # the first chunk is full, store the merged timeline in new chunks.
+        # They are written to another collection that then replaces the
+        # stored one, so that a failed write keeps the stored timeline
+        timeline = timeline + list(_get_statuses(collection))
+        merged = collection.database[collection.name + _MERGED_SUFFIX]
+        merged.drop()
+        try:
+            _insert_timeline(merged, user_id, timeline)
+        except Exception:
+            merged.drop()
+            raise
+        merged.rename(collection.name, dropTarget=True)
+
+
+def _write_operations(collection, operations):
+    """write the store and merge operations of a user's collection in order.
+    Consecutive stores are written with a single insert
+    """
+    documents = []
+    for operation, user_id, timeline in operations:
+        if operation == 'merge':
+            if documents:
+                _insert_documents(collection, documents)
+                documents = []
+            _merge_timeline(collection, user_id, timeline)
+        else:
+            documents.extend(_timeline_documents(user_id, timeline))
+    if documents:
+        _insert_documents(collection, documents)
+
+
+class TimelineWriter(object):
+    """
+    TimelineWriter class. Writes timelines to MongoDB from a background
+    thread so that crawlers do not wait for database round trips. Batching
+    only applies to the 'single' layout, where the timelines of a batch of
+    users are written with a single insert_many. With the 'collections'
+    layout every user has a collection of its own, so each timeline still
+    takes a request of its own. At most max_pending timelines are queued;
+    when the database falls behind, crawlers block until there is room. The
+    ids of the users whose timelines could not be written are kept in the
+    list failed.
+
+    Parameters
+    ----------
+    batch_size  : maximum number of timelines written with one request.
+        Defaults to 100
+    layout      : 'collections' or 'single'. Defaults to 'collections'
+    max_pending : maximum number of queued timelines. Defaults to 1000
+
+    Methods
+    -------
+    store_timeline : queues a timeline, same as tweegraph.db.store_timeline
+    merge_timeline : queues newer statuses, same as tweegraph.db.merge_timeline
+    flush          : waits until all queued timelines are written
+    """
+    def __init__(self, batch_size=100, layout='collections',
+                 max_pending=1000):
+        self.batch_size = batch_size
+        self.layout = layout
+        self.pending = Queue.Queue(max_pending)
+        self.failed = []
+        self.logger = logging.getLogger('tweegraph.db.writer')
+        writer = Thread(target=self._write)
+        writer.daemon = True
+        writer.start()
+
+    def store_timeline(self, db_name, user_id, timeline):
+        timeline = [status._json for status in timeline]
+        if timeline:
+            self.pending.put(('store', db_name, user_id, timeline))
+
+    def merge_timeline(self, db_name, user_id, timeline):
+        timeline = [status._json for status in timeline]
+        if timeline:
+            self.pending.put(('merge', db_name, user_id, timeline))
+
+    def flush(self):
+        self.pending.join()
+
+    def _write(self):
         while True:
+            batch = [self.pending.get(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(False))
+                except Queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.logger.warning('failed to write %d timelines: %s' %
+                                    (len(batch), e))
+                self.failed.extend(user_id for _, _, user_id, _ in batch)
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    def _write_batch(self, batch):
+        db_client = get_client()
+        if self.layout == 'single':
+            statuses = defaultdict(list)
+            for operation, db_name, user_id, timeline in batch:
+                statuses[db_name].extend(_status_documents(user_id, timeline))
+            for db_name, documents in statuses.items():
+                _insert_statuses(db_client, db_name, documents)
+            return
+
+        # the operations of a user are written in the order they were queued
+        operations = defaultdict(list)
+        for operation, db_name, user_id, timeline in batch:
+            operations[(db_name, str(user_id))].append(
+                (operation, user_id, timeline))
+
+        # a failed collection does not keep the rest of the batch from being
+        # written
+        for (db_name, name), user_operations in operations.items():
             try:
-                db_client[db_name][str(user_id)].insert_one(
-                        {'_id': user_id, 'content': timeline})
-                break
-            except DocumentTooLargeError as e:
-                timeline = timeline[:-1]
-            except WriteError as e:
-                timeline = timeline[:-1]
+                _write_operations(db_client[db_name][name], user_operations)
+            except Exception as e:
+                self.logger.warning('failed to write the timeline of %s in '
+                                    '%s: %s' % (name, db_name, e))
+                self.failed.append(user_operations[0][1])
 
 
-def get_number_of_collections(db_name):
-    """returns the number of collections stored in the db specified by
-    db_name
+def get_number_of_collections(db_name, layout='collections'):
+    """returns the number of user collections stored in the db specified by
+    db_name. With the 'single' layout, where all timelines share one
+    collection, the number of users with stored statuses is returned instead
 
     Parameters
     ----------
     db_name : str
         name of the database
+    layout  : 'collections' or 'single'. Defaults to 'collections'
     Returns
     -------
-    count : number of collections in the db
+    count : number of collections, or users, in the db
     """
-    db_client = MongoClient()
-    return len(db_client[db_name].collection_names())
+    db_client = get_client()
+    if layout == 'single':
+        return len(db_client[db_name][_TIMELINES].distinct('user_id'))
+    return len(_user_collections(db_name))
 
 
-def get_tweets(db_name, user_id):
+def get_tweets(db_name, user_id, layout='collections'):
     """returns a list of the specified user's tweets. Collections in the db
     for each user must contain a list of the timelines under the key 'content'.
 
@@ -55,82 +472,134 @@ def get_tweets(db_name, user_id):
     db_name : str
         name of the database
     user_id : id of twitter user
+    layout  : 'collections' or 'single'. Defaults to 'collections'
 
     Returns
     -------
     tweets : list of collected tweets for the specified user
     """
     tweets = []
-    db_client = MongoClient()
+    db_client = get_client()
 
-    for timeline in db_client[db_name][user_id].find():
-        for status in timeline['content']:
-            tweets.append(status['text'])
+    if layout == 'single':
+        statuses = db_client[db_name][_TIMELINES].find(
+            {'user_id': int(user_id)}, {'text': 1},
+            sort=[('_id', DESCENDING)])
+    else:
+        statuses = _get_statuses(db_client[db_name][str(user_id)])
+
+    for status in statuses:
+        tweets.append(status['text'])
 
     return tweets
 
 
-def get_user_topic_affiliation_dict(db_name):
+def get_user_topic_affiliation_dict(db_name, layout='collections',
+                                    processes=None):
     """returns the user-topic affilication dictionary proposed by Yuan et al.
     in their study 'Exploiting Sentiment Homophily for Link Prediction'
 
     Parameters
     ----------
-    db_name : str
+    db_name   : str
         name of the database. Database is supposed to contain a collection for
         each user. Each collection is supposed to contain a list of retrieved
         statuses under the key 'content'
+    layout    : 'collections' or 'single'. Defaults to 'collections'
+    processes : number of processes that score the users in parallel. Users
+        are split in shards that are processed by a pool of workers, each
+        with its own connection to the db. Defaults to None (serial)
 
     Returns
     -------
     user_topic : dict in the for dict{user_id: {topic: sentiment_score}}
     """
-    user_topic = defaultdict(dict)
+    if not processes:
+        return _user_topic_shard((db_name, layout, None))
 
-    db_client = MongoClient()
+    users = _get_user_ids(db_name, layout)
+    # a few shards per process so that slow shards do not stall the pool
+    shard_size = max(1, len(users) // (processes * 4) + 1)
+    shards = [(db_name, layout, users[idx:idx + shard_size])
+              for idx in range(0, len(users), shard_size)]
 
-    for user in db_client[db_name].collection_names():
-        timeline = db_client[db_name][user].find().next()
-        for status in timeline['content']:
-            tweet_score = get_tweet_score(status['text'])
-            polarity = determine_polarity(tweet_score)
-            for topic in status['entities']['hashtags']:
-                topic = topic['text'].lower()
-                if not topic in user_topic[user]:
-                    # tweet score accompanied by the pos neg and obj count
-                    user_topic[user][topic] = [tweet_score, 0, 0, 0]
-                else:
-                    previous_score = user_topic[user][topic][0]
-
-                    new_score = tuple(sum(i) for i in zip(tweet_score,
-                                                          previous_score))
-                    user_topic[user][topic][0] = new_score
-                if polarity == 1:
-                    user_topic[user][topic][1] += 1
-                elif polarity == -1:
-                    user_topic[user][topic][2] += 1
-                else:
-                    user_topic[user][topic][3] += 1
-    # average scores
-    for user in user_topic:
-        for topic, scores in user_topic[user].iteritems():
-            freq = sum(scores[1:])
-            if freq > 1:
-                #print scores
-                pos = scores[0][0] / freq
-                neg = scores[0][1] / freq
-
-                user_topic[user][topic] = (pos, neg, round(1 - (pos + neg), 7),
-                                           scores[1], scores[2], scores[3])
+    user_topic = {}
+    pool = Pool(processes, initializer=_reset_client)
+    try:
+        for shard in pool.imap_unordered(_user_topic_shard, shards):
+            user_topic.update(shard)
+    finally:
+        pool.close()
+        pool.join()
+
+    return user_topic
+
+
+def _reset_client():
+    """drop the client inherited from the parent process. MongoClient is not
+    fork safe
+    """
+    global _CLIENT
+    _CLIENT = None
+
+
+def _user_topic_shard((db_name, layout, users)):
+    """user-topic affiliation dict of the given users, or of all the users if
+    users is None
+    """
+    user_topic = {}
+    projection = {'text': 1, 'entities.hashtags': 1}
+    for user, statuses in _iter_user_statuses(db_name, layout, projection,
+                                              users):
+        topics = _user_topic_scores(statuses)
+        if topics:
+            user_topic[user] = topics
+    return user_topic
+
+
+def _user_topic_scores(statuses):
+    """returns dict{topic: sentiment_score} for the statuses of a user"""
+    user_topic = {}
+    statuses = list(statuses)
+    pos, neg, obj = get_tweet_scores(status['text'] for status in statuses)
+    tweet_scores = zip(pos.tolist(), neg.tolist(), obj.tolist())
+    for status, tweet_score in zip(statuses, tweet_scores):
+        polarity = determine_polarity(tweet_score)
+        for topic in status['entities']['hashtags']:
+            topic = topic['text'].lower()
+            if not topic in user_topic:
+                # tweet score accompanied by the pos neg and obj count
+                user_topic[topic] = [tweet_score, 0, 0, 0]
+            else:
+                previous_score = user_topic[topic][0]
+
+                new_score = tuple(sum(i) for i in zip(tweet_score,
+                                                      previous_score))
+                user_topic[topic][0] = new_score
+            if polarity == 1:
+                user_topic[topic][1] += 1
+            elif polarity == -1:
+                user_topic[topic][2] += 1
             else:
-                user_topic[user][topic] = (scores[0][0], scores[0][1],
-                                           scores[0][2], scores[1], scores[2],
-                                           scores[3])
+                user_topic[topic][3] += 1
+    # average scores
+    for topic, scores in user_topic.iteritems():
+        freq = sum(scores[1:])
+        if freq > 1:
+            #print scores
+            pos = scores[0][0] / freq
+            neg = scores[0][1] / freq
 
-    return dict(user_topic)
+            user_topic[topic] = (pos, neg, round(1 - (pos + neg), 7),
+                                 scores[1], scores[2], scores[3])
+        else:
+            user_topic[topic] = (scores[0][0], scores[0][1], scores[0][2],
+                                 scores[1], scores[2], scores[3])
 
+    return user_topic
 
-def get_topic_user_dict(db_name):
+
+def get_topic_user_dict(db_name, layout='collections'):
     """returns a topic to list of users dictionary
 
     Parameters
@@ -139,6 +608,7 @@ def get_topic_user_dict(db_name):
         name of the database. Database is supposed to contain a collection for
         each user. Each collection is supposed to contain a list of retrieved
         statuses under the key 'content'
+    layout  : 'collections' or 'single'. Defaults to 'collections'
 
     Returns
     -------
@@ -146,12 +616,10 @@ def get_topic_user_dict(db_name):
     """
     topic_user_dict = defaultdict(list)
 
-    db_client = MongoClient()
-
-    for user in db_client[db_name].collection_names():
-        timeline = db_client[db_name][user].find().next()
+    projection = {'entities.hashtags': 1}
+    for user, statuses in _iter_user_statuses(db_name, layout, projection):
         hashtags = []
-        for status in timeline['content']:
+        for status in statuses:
             for hashtag in status['entities']['hashtags']:
                 hashtags.append(hashtag['text'])
         for hashtag in set(hashtags):
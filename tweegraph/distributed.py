@@ -0,0 +1,320 @@
+"""distributed crawling. A coordinator owns the frontier and the explored
+nodes and leases batches of nodes to workers over tcp. Workers, each with
+their own api tokens and proxies, explore the nodes and report the relations
+back. Every request and response is a json object on a single line.
+"""
+
+import json
+import socket
+from time import sleep, time
+from threading import Thread, Event, Lock as thread_lock
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+from tweegraph.api import RateLimitScheduler, request_data
+from tweegraph.traverser import TwitterGraphTraverser, api_caller
+
+
+class _CoordinatorServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _CoordinatorHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                reply = self.server.coordinator.handle(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': repr(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+
+
+class CrawlCoordinator(TwitterGraphTraverser):
+    """
+    CrawlCoordinator class. Crawls like TwitterGraphTraverser, but instead of
+    exploring nodes itself it leases batches of frontier nodes to workers
+    (see crawl_worker) that connect over tcp. A lease that is not renewed or
+    reported within lease_timeout seconds expires and its unexplored nodes
+    are returned to the frontier, so the nodes of a crashed worker are handed
+    to the others. Exports, checkpoints and metrics work as in
+    TwitterGraphTraverser.
+
+    Parameters
+    ----------
+    starting_ids  : list of twitter ids to start the traversing from
+    host          : interface to listen to. Defaults to 127.0.0.1, use
+        0.0.0.0 to accept workers of other machines
+    port          : port to listen to. Defaults to 0 (any free port)
+    batch_size    : number of nodes in a lease. Defaults to 10
+    lease_timeout : seconds after which an idle lease expires. Defaults to 300
+    secret        : when set, requests that do not carry it are refused.
+        Defaults to None
+
+    The rest of the keyword arguments are passed to TwitterGraphTraverser
+    >>> help(tweegraph.traverser.TwitterGraphTraverser)
+
+    Methods
+    -------
+    start  : starts serving workers
+    handle : handles a request of a worker
+    wait   : waits, up to a timeout, for the crawl to finish
+    join   : waits for the crawl to finish
+    stop   : stops serving workers
+    """
+    def __init__(self, starting_ids, host='127.0.0.1', port=0, batch_size=10,
+                 lease_timeout=300, secret=None, **kwargs):
+        kwargs.setdefault('credentials', [])
+        super(CrawlCoordinator, self).__init__(starting_ids, **kwargs)
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.lease_timeout = lease_timeout
+        self.secret = secret
+        self.leases = {}
+        self.lease_count = 0
+        self.expired_leases = 0
+        self.lease_lock = thread_lock()
+        self.server = None
+
+    @property
+    def address(self):
+        return self.server.server_address if self.server else None
+
+    def _config(self):
+        # the secret is not written to the checkpoint
+        config = super(CrawlCoordinator, self)._config()
+        config.update({'host': self.host,
+                       'port': self.port,
+                       'batch_size': self.batch_size,
+                       'lease_timeout': self.lease_timeout})
+        return config
+
+    def _is_done(self):
+        if self.traverse and self.graph_size is not None and \
+                self.get_size() > self.graph_size:
+            return True
+        return self.new_nodes.empty() and not self.leases
+
+    def _expire_leases(self, now):
+        """return the unreported nodes of expired leases to the frontier.
+        Must be called while holding lease_lock
+        """
+        for lease_id, lease in self.leases.items():
+            if lease['deadline'] > now:
+                continue
+            del self.leases[lease_id]
+            self.expired_leases += 1
+            self._release_nodes(lease['nodes'])
+
+    def handle(self, request):
+        """handle a request of a worker and return the reply. Requests:
+
+        {'op': 'lease'} : returns {'lease': <id>, 'nodes': [...], 'timeout',
+            'directions', 'breadth'}, {'wait': <seconds>} when no node is
+            available yet or {'done': True} when the crawl is over
+        {'op': 'report', 'lease': <id>, 'node', 'followers', 'following'} :
+            records the relations of a leased node and renews the lease
+        {'op': 'renew', 'lease': <id>} : renews a lease
+
+        report and renew return {'ok': False} for expired leases
+        """
+        if self.secret is not None and request.get('secret') != self.secret:
+            return {'error': 'unauthorized'}
+
+        # the state is updated under the lock, the progress callbacks and the
+        # last checkpoint, which may be slow, run after releasing it
+        self.lease_lock.acquire()
+        try:
+            reply, explored_count = self._handle(request, time())
+            done = self._is_done()
+        finally:
+            self.lease_lock.release()
+
+        if explored_count is not None:
+            self._notify_progress(explored_count)
+        if done and not self.finished.is_set():
+            self._finish()
+        return reply
+
+    def _handle(self, request, now):
+        """return the reply to a request and the number of explored nodes if
+        the request recorded relations. Must be called while holding
+        lease_lock
+        """
+        self._expire_leases(now)
+        op = request['op']
+
+        if op == 'lease':
+            if self._is_done():
+                return {'done': True}, None
+            nodes = self._dequeue_nodes(self.batch_size)
+            if not nodes:
+                return {'wait': 1}, None
+            self.lease_count += 1
+            self.leases[self.lease_count] = {
+                'nodes': set(nodes), 'deadline': now + self.lease_timeout}
+            return {'lease': self.lease_count, 'nodes': nodes,
+                    'timeout': self.lease_timeout,
+                    'directions': self.directions,
+                    'breadth': self.breadth}, None
+
+        lease = self.leases.get(request['lease'])
+        if lease is None:
+            return {'ok': False}, None
+        lease['deadline'] = now + self.lease_timeout
+
+        explored_count = None
+        if op == 'report':
+            node = request['node']
+            if node in lease['nodes']:
+                lease['nodes'].discard(node)
+                explored_count = self._record_relations(
+                    node, request['followers'], request['following'],
+                    notify=False)
+            if not lease['nodes']:
+                del self.leases[request['lease']]
+        return {'ok': True}, explored_count
+
+    def start(self):
+        """
+        start serving workers from a background thread
+        """
+        self._start_services()
+        self.server = _CoordinatorServer((self.host, self.port),
+                                         _CoordinatorHandler)
+        self.server.coordinator = self
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.workers.append(thread)
+
+        monitor = Thread(target=self._monitor)
+        monitor.daemon = True
+        monitor.start()
+
+    def _monitor(self):
+        # expire leases and detect the end of the crawl while no worker asks
+        while not self.finished.is_set():
+            self.lease_lock.acquire()
+            try:
+                self._expire_leases(time())
+                done = self._is_done()
+            finally:
+                self.lease_lock.release()
+            if done:
+                self._finish()
+                return
+            sleep(1)
+
+    def stop(self, timeout=None):
+        """
+        stop serving workers. Leased nodes stay in progress and are saved as
+        part of the frontier by checkpoint
+        """
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if not self.finished.is_set():
+            self._finish()
+        return True
+
+
+class _CoordinatorClient(object):
+    """
+    line based json client of a CrawlCoordinator. Calls are serialized so that
+    the client can be shared by the threads of a worker
+    """
+    def __init__(self, address, secret=None, timeout=60):
+        self.secret = secret
+        self.lock = thread_lock()
+        self.connection = socket.create_connection(tuple(address), timeout)
+        self.reader = self.connection.makefile('rb')
+
+    def call(self, **request):
+        if self.secret is not None:
+            request['secret'] = self.secret
+        self.lock.acquire()
+        try:
+            self.connection.sendall(json.dumps(request) + '\n')
+            line = self.reader.readline()
+        finally:
+            self.lock.release()
+        if not line:
+            raise socket.error('connection closed by the coordinator')
+        return json.loads(line)
+
+    def close(self):
+        self.reader.close()
+        self.connection.close()
+
+
+def _renew_periodically(client, lease, interval, stopped):
+    while not stopped.wait(interval):
+        try:
+            if not client.call(op='renew', lease=lease).get('ok'):
+                return
+        except socket.error:
+            return
+
+
+@api_caller('crawl_worker')
+def crawl_worker(address, api=None, logger=None, secret=None):
+    """explore the nodes leased by the coordinator listening at address
+    (host, port) and report their relations, until the coordinator reports
+    that the crawl is over. The api tokens may carry their own proxy
+    >>> help(tweegraph.api.create_api_instance)
+
+    Parameters
+    ----------
+    address : (host, port) of the CrawlCoordinator
+    api     : api tokens of the worker
+    secret  : secret of the coordinator, if any
+    """
+    # followers/ids and friends/ids have separate rate limit windows
+    followers_scheduler = RateLimitScheduler(api)
+    following_scheduler = RateLimitScheduler(api)
+
+    client = _CoordinatorClient(address, secret)
+    try:
+        while True:
+            reply = client.call(op='lease')
+            if reply.get('done'):
+                logger.info('terminating')
+                return
+            if 'error' in reply:
+                logger.warning('coordinator error: %s' % reply['error'])
+                return
+            if 'wait' in reply:
+                sleep(reply['wait'])
+                continue
+
+            # keep the lease alive while slow nodes are explored
+            stopped = Event()
+            renewer = Thread(target=_renew_periodically,
+                             args=(client, reply['lease'],
+                                   reply['timeout'] / 3.0, stopped))
+            renewer.daemon = True
+            renewer.start()
+            try:
+                for node in reply['nodes']:
+                    followers = []
+                    following = []
+                    if 'followers' in reply['directions']:
+                        followers = request_data(api.followers_ids, node,
+                                                 reply['breadth'], logger,
+                                                 followers_scheduler)
+                    if 'following' in reply['directions']:
+                        following = request_data(api.friends_ids, node,
+                                                 reply['breadth'], logger,
+                                                 following_scheduler)
+                    if not client.call(op='report', lease=reply['lease'],
+                                       node=node, followers=followers,
+                                       following=following).get('ok'):
+                        logger.warning('lease %d expired' % reply['lease'])
+                        break
+            finally:
+                stopped.set()
+    finally:
+        client.close()
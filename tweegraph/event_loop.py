@@ -0,0 +1,540 @@
+"""event_loop module provides a graph traverser that makes the requests of all
+api tokens from a single thread. Requests are sent over non-blocking sockets
+and multiplexed with poll, so many requests per token and many tokens and
+proxies can be in flight without a thread for each of them.
+"""
+
+import os
+import ssl
+import json
+import heapq
+import errno
+import base64
+import socket
+import select
+import requests
+from time import time
+from threading import Thread
+from urlparse import urlparse
+
+from tweepy.models import User
+
+from tweegraph.api import create_api_instance, RateLimitScheduler
+from tweegraph.traverser import TwitterGraphTraverser, log_wrap
+
+_PATHS = {'followers': '/followers/ids.json',
+          'following': '/friends/ids.json',
+          'lookup': '/users/lookup.json'}
+
+# poll events of the operation a request waits for. Errors and hang ups are
+# always reported and are handled by the next step of the request
+_EVENTS = {'r': select.POLLIN, 'w': select.POLLOUT}
+
+
+class _Response(object):
+    """status, lower case headers and body of a response"""
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+def _parse_response(data):
+    """parse a complete http response. Raises ValueError if it is truncated"""
+    head, separator, body = data.partition('\r\n\r\n')
+    if not separator:
+        raise ValueError('incomplete response')
+    lines = head.split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size, separator, body = body.partition('\r\n')
+            if not separator:
+                raise ValueError('incomplete response')
+            size = int(size.split(';')[0], 16)
+            if not size:
+                break
+            if len(body) < size:
+                raise ValueError('incomplete response')
+            chunks.append(body[:size])
+            body = body[size + 2:]
+        body = ''.join(chunks)
+    elif 'content-length' in headers:
+        length = int(headers['content-length'])
+        if len(body) < length:
+            raise ValueError('incomplete response')
+        body = body[:length]
+    return _Response(status, headers, body)
+
+
+class _HTTPSRequest(object):
+    """
+    a single https request over a non-blocking socket, optionally tunnelled
+    through an http proxy with CONNECT. The connection is closed after the
+    response. step advances the request whenever its socket is ready for the
+    operation in want ('r' or 'w') and returns True once the request is done,
+    with either response or error set
+    """
+    def __init__(self, host, port, data, context, address, proxy=None,
+                 timeout=60):
+        self.host = host
+        self.port = port
+        self.data = data
+        self.context = context
+        self.address = address
+        self.proxy = proxy
+        self.deadline = time() + timeout
+        self.sock = None
+        self.state = 'connect'
+        self.want = 'w'
+        self.outgoing = ''
+        self.incoming = []
+        self.response = None
+        self.error = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def open(self):
+        family, socktype, proto, _, address = self.address
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+
+    def fail(self, error):
+        self.error = error
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+    def step(self):
+        try:
+            return self._step()
+        except (socket.error, ValueError) as e:
+            self.fail(e)
+            return True
+
+    def _step(self):
+        if self.state == 'connect':
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.proxy:
+                host, port, authorization = self.proxy
+                self.outgoing = 'CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n' % (
+                    self.host, self.port, self.host, self.port)
+                if authorization:
+                    self.outgoing += 'Proxy-Authorization: %s\r\n' % \
+                        authorization
+                self.outgoing += '\r\n'
+                self.state = 'proxy_send'
+            else:
+                self._start_tls()
+
+        if self.state == 'proxy_send':
+            if not self._send():
+                return False
+            self.state, self.want = 'proxy_recv', 'r'
+            return False
+
+        if self.state == 'proxy_recv':
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error('connection closed by the proxy')
+            self.incoming.append(data)
+            head = ''.join(self.incoming)
+            if '\r\n\r\n' not in head:
+                return False
+            if head.split()[1] != '200':
+                raise socket.error('proxy refused to connect: %s' %
+                                   head.split('\r\n')[0])
+            self.incoming = []
+            self._start_tls()
+
+        if self.state == 'handshake':
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.want = 'r'
+                return False
+            except ssl.SSLWantWriteError:
+                self.want = 'w'
+                return False
+            self.outgoing = self.data
+            self.state, self.want = 'send', 'w'
+
+        if self.state == 'send':
+            if not self._send():
+                return False
+            self.state, self.want = 'recv', 'r'
+            return False
+
+        # read until the server closes the connection. Data buffered by the
+        # ssl layer is not reported by poll, so reading goes on until the
+        # socket would block
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return False
+            except ssl.SSLError as e:
+                # servers often close the connection without a tls
+                # close_notify. Truncated responses are caught when parsing
+                eof = (ssl.SSLEOFError, ssl.SSLZeroReturnError)
+                if not isinstance(e, eof) and 'eof' not in str(e).lower():
+                    raise
+                data = ''
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            if not data:
+                self.response = _parse_response(''.join(self.incoming))
+                self.close()
+                return True
+            self.incoming.append(data)
+
+    def _start_tls(self):
+        self.sock = self.context.wrap_socket(self.sock,
+                                             server_hostname=self.host,
+                                             do_handshake_on_connect=False)
+        self.state, self.want = 'handshake', 'w'
+
+    def _send(self):
+        """send as much of outgoing as possible. True once all is sent"""
+        try:
+            sent = self.sock.send(self.outgoing)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return False
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        self.outgoing = self.outgoing[sent:]
+        return not self.outgoing
+
+
+def _parse_proxy(proxy):
+    """returns (host, port, proxy authorization) of a proxy url"""
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    proxy = urlparse(proxy)
+    authorization = None
+    if proxy.username:
+        authorization = 'Basic ' + base64.b64encode(
+            '%s:%s' % (proxy.username, proxy.password or ''))
+    return proxy.hostname, proxy.port or 8080, authorization
+
+
+class EventLoopTraverser(TwitterGraphTraverser):
+    """
+    EventLoopTraverser class. Crawls like TwitterGraphTraverser, with the same
+    parameters and methods, but the requests of all api tokens are made from
+    a single thread over non-blocking sockets. Every token explores up to
+    concurrency nodes at a time, with their followers/ids and friends/ids
+    requests in flight together, paced by the rate limit schedulers of the
+    token. A token with a proxy tunnels its requests through it.
+
+    >>> help(tweegraph.traverser.TwitterGraphTraverser)
+
+    Parameters
+    ----------
+    concurrency : number of nodes explored at a time by each api key.
+        Defaults to 1
+    timeout     : seconds after which a request is considered failed and is
+        retried. Defaults to 60
+    max_retries : number of times a request whose connection failed is
+        retried, with exponential backoff, before it is given up like any
+        other failed request. Defaults to 10
+
+    The rest of the keyword arguments are passed to TwitterGraphTraverser
+    """
+    def __init__(self, starting_ids, credentials, timeout=60, max_retries=10,
+                 **kwargs):
+        super(EventLoopTraverser, self).__init__(starting_ids, credentials,
+                                                 **kwargs)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._timers = []
+        self._timer_count = 0
+        self._requests = {}
+        self._addresses = {}
+
+    def start(self):
+        """
+        initiate graph traversing from a single background thread
+        """
+        self._start_services()
+        for _ in self.credentials:
+            self.schedulers.append({'followers': RateLimitScheduler(
+                                        interrupt=self.stopped),
+                                    'following': RateLimitScheduler(
+                                        interrupt=self.stopped),
+                                    'lookup': RateLimitScheduler(
+                                        interrupt=self.stopped)})
+        if not self.credentials:
+            self.finished.set()
+            return
+
+        self.active_workers = 1
+        worker = Thread(target=self._run_worker)
+        self.workers.append(worker)
+        worker.start()
+
+    def _config(self):
+        config = super(EventLoopTraverser, self)._config()
+        config.update({'timeout': self.timeout,
+                       'max_retries': self.max_retries})
+        return config
+
+    def _call_later(self, delay, callback, *args):
+        self._timer_count += 1
+        heapq.heappush(self._timers,
+                       (time() + delay, self._timer_count, callback, args))
+
+    def _resolve(self, host, port):
+        if (host, port) not in self._addresses:
+            self._addresses[(host, port)] = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)[0]
+        return self._addresses[(host, port)]
+
+    def _request(self, token, endpoint, params, callback, retries=0):
+        """
+        send a request once the scheduler of the endpoint has a slot for it.
+        callback gets the decoded response or None if the request failed
+        """
+        delay = token['schedulers'][endpoint].reserve()
+        self._call_later(delay, self._send, token, endpoint, params, callback,
+                         retries)
+
+    def _send(self, token, endpoint, params, callback, retries):
+        api = token['api']
+        url = 'https://%s%s%s' % (api.host, api.api_root, _PATHS[endpoint])
+        prepared = requests.Request('GET', url, params=params,
+                                    auth=api.auth.apply_auth()).prepare()
+        data = 'GET %s HTTP/1.1\r\nHost: %s\r\nAuthorization: %s\r\n' \
+            'Accept-Encoding: identity\r\nConnection: close\r\n\r\n' % (
+                prepared.path_url, api.host,
+                prepared.headers['Authorization'])
+
+        request = _HTTPSRequest(token['host'], token['port'], str(data),
+                                token['context'], None, token['proxy'],
+                                self.timeout)
+        self._requests[request] = (token, endpoint, params, callback, retries)
+        try:
+            if token['proxy']:
+                request.address = self._resolve(*token['proxy'][:2])
+            else:
+                request.address = self._resolve(token['host'], token['port'])
+            request.open()
+        except socket.error as e:
+            request.fail(e)
+            self._complete(request)
+
+    def _complete(self, request):
+        """handle a finished request: retry it, halt on rate limits or pass
+        the decoded response to its callback
+        """
+        token, endpoint, params, callback, retries = \
+            self._requests.pop(request)
+        scheduler = token['schedulers'][endpoint]
+        log_msg = 'exploring node: %s' % params.get('id', params.get(
+            'user_id'))
+
+        if request.error is not None:
+            if retries >= self.max_retries:
+                self.loop_logger.warning('Too many connection retries (%s) '
+                                         % request.error + log_msg)
+                callback(None)
+                return
+            self._call_later(min(0.5 * 2 ** retries, 30), self._request,
+                             token, endpoint, params, callback, retries + 1)
+            return
+
+        response = request.response
+        scheduler.update(response)
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            data = None
+
+        if response.status == 429 or isinstance(data, dict) and any(
+                error.get('code') == 88 for error in data.get('errors', [])):
+            delay = scheduler.delay() or 15 * 60
+            self.loop_logger.info('Limit reached. Halting for %d sec. ' %
+                                  delay + log_msg)
+            scheduler.record_sleep(delay)
+            self._call_later(delay, self._request, token, endpoint, params,
+                             callback, retries)
+        elif response.status == 404 and endpoint == 'lookup':
+            # none of the ids matches an existing user
+            callback([])
+        elif response.status != 200 or data is None:
+            self.loop_logger.warning('%d %s %s' % (
+                response.status, response.body[:200], log_msg))
+            callback(None)
+        else:
+            callback(data)
+
+    def _request_ids(self, token, direction, node, ids, cursor, callback):
+        """
+        collect the followers or friends ids of node page by page, like
+        request_data, and pass them to callback
+        """
+        def on_page(data):
+            if not data or not data.get('ids'):
+                return callback([])
+            ids.extend(data['ids'])
+            if self.breadth and len(ids) >= self.breadth:
+                return callback(ids[:self.breadth])
+            if not data.get('next_cursor'):
+                return callback(ids)
+            self._request_ids(token, direction, node, ids,
+                              data['next_cursor'], callback)
+
+        self._request(token, direction, {'id': node, 'cursor': cursor},
+                      on_page)
+
+    def _explore(self, token, node):
+        directions = [direction for direction in ['followers', 'following']
+                      if direction in self.directions]
+        relations = {'followers': [], 'following': []}
+        token['exploring'].add(node)
+
+        def on_relations(direction, ids):
+            relations[direction] = ids
+            directions.remove(direction)
+            if directions or node not in token['exploring']:
+                return
+            token['exploring'].discard(node)
+            if not self.stopped.is_set():
+                self._record_relations(node, relations['followers'],
+                                       relations['following'])
+
+        if not directions:
+            token['exploring'].discard(node)
+            self._record_relations(node, [], [])
+            return
+        for direction in list(directions):
+            self._request_ids(token, direction, node, [], -1,
+                              lambda ids, direction=direction:
+                                  on_relations(direction, ids))
+
+    def _lookup(self, token, nodes):
+        token['lookup'] = nodes
+
+        def on_users(data):
+            token['lookup'] = []
+            users = None
+            if data is not None:
+                users = dict((user.id, user) for user in
+                             User.parse_list(token['api'], data))
+            token['pending'] = self._select_nodes(nodes, users,
+                                                  self.loop_logger)
+
+        self._request(token, 'lookup',
+                      {'user_id': ','.join(str(node) for node in nodes)},
+                      on_users)
+
+    def _feed(self, token):
+        """start exploring nodes with token until it explores concurrency
+        nodes at a time
+        """
+        while len(token['exploring']) < self.concurrency and \
+                not token['lookup']:
+            if not token['pending']:
+                nodes = self._dequeue_nodes(100 if self.prefilter else 1)
+                if not nodes:
+                    return
+                if self.prefilter:
+                    self._lookup(token, nodes)
+                    return
+                token['pending'] = nodes
+            self._explore(token, token['pending'].pop(0))
+
+    def _is_idle(self, tokens):
+        return not self._requests and not self._timers and \
+            not any(token['exploring'] or token['lookup'] or token['pending']
+                    for token in tokens)
+
+    def _explore_graph(self):
+        self.loop_logger = log_wrap(self.logger.name + '.event_loop')
+        context = ssl.create_default_context(
+            cafile=os.environ.get('REQUESTS_CA_BUNDLE') or
+            requests.certs.where())
+        tokens = []
+        for credentials, schedulers in zip(self.credentials,
+                                           self.schedulers):
+            api = create_api_instance(credentials)
+            host = urlparse('//' + api.host)
+            tokens.append({'api': api,
+                           'host': host.hostname,
+                           'port': host.port or 443,
+                           'proxy': _parse_proxy(credentials['proxy'])
+                           if credentials.get('proxy') else None,
+                           'context': context,
+                           'schedulers': schedulers,
+                           'exploring': set(),
+                           'lookup': [],
+                           'pending': []})
+
+        try:
+            while True:
+                if self.stopped.is_set() or \
+                        self.traverse and self.get_size() > self.graph_size \
+                        or self._is_idle(tokens) and self._is_exhausted():
+                    self.loop_logger.info('terminating')
+                    return
+
+                for token in tokens:
+                    self._feed(token)
+
+                timeout = 0.5
+                if self._timers:
+                    timeout = max(0, min(timeout, self._timers[0][0] - time()))
+                # poll, unlike select, is not limited to 1024 descriptors
+                if self._requests:
+                    poller = select.poll()
+                    requests_by_fd = {}
+                    for request in self._requests:
+                        requests_by_fd[request.fileno()] = request
+                        poller.register(request, _EVENTS[request.want])
+                    ready = [requests_by_fd[fd] for fd, _ in
+                             poller.poll(timeout * 1000)]
+                else:
+                    self.stopped.wait(timeout)
+                    ready = []
+
+                for request in ready:
+                    if request.step():
+                        self._complete(request)
+
+                now = time()
+                for request in self._requests.keys():
+                    if request.deadline < now:
+                        request.fail(socket.timeout('timed out'))
+                        self._complete(request)
+
+                while self._timers and self._timers[0][0] <= time():
+                    _, _, callback, args = heapq.heappop(self._timers)
+                    callback(*args)
+        finally:
+            for request in self._requests:
+                request.close()
+            self._requests = {}
+            self._timers = []
+            # nodes that were not explored, or only in part, go back to the
+            # frontier
+            for token in tokens:
+                self._release_nodes(list(token['exploring']) +
+                                    token['pending'] + token['lookup'])
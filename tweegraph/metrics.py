@@ -0,0 +1,120 @@
+"""metrics module exposes the metrics of a running TwitterGraphTraverser in
+the Prometheus text format over a local http endpoint
+"""
+
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# (metric name, key in TwitterGraphTraverser.metrics, description). Counter
+# names get the _total suffix when formatted
+_GAUGES = [('elapsed_seconds', 'elapsed', 'Seconds since crawling started.'),
+           ('queue_depth', 'queue_depth', 'Nodes waiting in the frontier.'),
+           ('explored_nodes', 'explored_nodes',
+            'Nodes whose relations have been collected.'),
+           ('in_progress', 'in_progress', 'Nodes that are being explored.'),
+           ('collected_size', 'collected_size',
+            'Value returned by get_size.'),
+           ('duplicate_dequeue_ratio', 'duplicate_dequeue_ratio',
+            'Fraction of dequeued nodes that were already explored.'),
+           ('export_duration_last_seconds', 'export_duration_last',
+            'Duration of the last export in seconds.')]
+
+_COUNTERS = [('dequeued', 'dequeued', 'Nodes taken from the frontier.'),
+             ('duplicate_dequeues', 'duplicate_dequeues',
+              'Nodes taken from the frontier that were already explored.'),
+             ('lock_wait_seconds', 'lock_wait_time',
+              'Seconds spent waiting for the explored nodes lock.'),
+             ('exports', 'exports', 'Number of exports.'),
+             ('export_duration_seconds', 'export_duration_total',
+              'Seconds spent exporting.'),
+             ('requests', 'requests', 'Requests of all api tokens.')]
+
+
+def to_prometheus(metrics, prefix='tweegraph_'):
+    """Format the metrics returned by TwitterGraphTraverser.metrics in the
+    Prometheus text exposition format
+
+    Parameters
+    ----------
+    metrics : dict
+        metrics as returned by TwitterGraphTraverser.metrics
+    prefix  : str
+        prefix of the metric names
+
+    Returns
+    -------
+    text : str
+    """
+    lines = []
+
+    def add(name, kind, description, samples):
+        lines.append('# HELP %s%s %s' % (prefix, name, description))
+        lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+        for labels, value in samples:
+            labels = ','.join('%s="%s"' % label for label in labels)
+            labels = '{' + labels + '}' if labels else ''
+            lines.append('%s%s%s %s' % (prefix, name, labels, repr(value)))
+
+    for name, key, description in _GAUGES:
+        add(name, 'gauge', description, [((), metrics[key])])
+    for name, key, description in _COUNTERS:
+        add(name + '_total', 'counter', description, [((), metrics[key])])
+
+    # rates are left to the scraper, e.g. rate(tweegraph_requests_total[5m])
+    tokens = list(enumerate(metrics['tokens']))
+    add('token_requests_total', 'counter',
+        'Requests of each api token per endpoint.',
+        [((('token', idx), ('endpoint', endpoint)), values['requests'])
+         for idx, token in tokens
+         for endpoint, values in sorted(token['endpoints'].items())])
+    add('token_sleep_seconds_total', 'counter',
+        'Seconds each api token spent halted by rate limits per endpoint.',
+        [((('token', idx), ('endpoint', endpoint)), values['sleep_time'])
+         for idx, token in tokens
+         for endpoint, values in sorted(token['endpoints'].items())])
+
+    return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = to_prometheus(self.server.traverser.metrics())
+        self.send_response(200)
+        self.send_header('content-type', 'text/plain; version=0.0.4')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(traverser, port=9100, host='127.0.0.1'):
+    """Serve the metrics of the traverser at http://host:port/metrics from a
+    background thread
+
+    Parameters
+    ----------
+    traverser : TwitterGraphTraverser instance
+    port      : port to listen to. Defaults to 9100
+    host      : interface to listen to. Defaults to 127.0.0.1
+
+    Returns
+    -------
+    server : the http server. Call shutdown() to stop serving
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.traverser = traverser
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
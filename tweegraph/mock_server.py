@@ -0,0 +1,390 @@
+"""mock_server module provides a local stand-in for the parts of the twitter
+REST api that tweegraph uses. It serves a synthetic graph and synthetic
+timelines with per token rate limit windows, 429 responses, dropped
+connections and latency, so that the crawlers can be benchmarked without
+spending real api keys.
+"""
+
+from __future__ import division
+import os
+import re
+import ssl
+import json
+import random
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from time import sleep, time, strftime, gmtime
+from threading import Thread, Lock as thread_lock
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# requests per window of each endpoint for user authentication
+_LIMITS = {'/1.1/followers/ids.json': 15,
+           '/1.1/friends/ids.json': 15,
+           '/1.1/statuses/user_timeline.json': 900,
+           '/1.1/users/lookup.json': 900,
+           '/1.1/account/verify_credentials.json': 75}
+
+_WORDS = ['love', 'hate', 'great', 'bad', 'happy', 'sad', 'today', 'game',
+          'music', 'vote', 'news', 'good', 'awful', 'nice', 'terrible', 'new']
+_HASHTAGS = ['music', 'elections', 'football', 'news', 'tech', 'movies',
+             'greece', 'science', 'art', 'travel', 'food', 'fashion']
+_EMOJIS = [u'\U0001f601', u'\U0001f602', u'\U0001f620', u'\U0001f622',
+           u'\U0001f60d', u'\U0001f61e']
+
+
+class SyntheticTwitter(object):
+    """
+    SyntheticTwitter class. Generates a directed graph with ids 1 .. users in
+    which the followed accounts are chosen with a zipf like popularity, so
+    that hubs emerge, and deterministic timelines for every user.
+
+    Parameters
+    ----------
+    users     : number of users
+    edges     : number of follow relations to generate (before removing
+        duplicates and self loops)
+    protected : fraction of protected accounts
+    suspended : fraction of suspended accounts
+    tweets    : mean number of tweets per user (at most 3200 are served)
+    seed      : seed of the random generator
+    """
+    def __init__(self, users=10000, edges=500000, protected=0.05,
+                 suspended=0.01, tweets=200, seed=0):
+        rng = np.random.RandomState(seed)
+        self.users = users
+
+        popularity = rng.permutation(1 / np.arange(1, users + 1) ** 0.8)
+        popularity /= popularity.sum()
+        follower = rng.randint(1, users + 1, size=edges).astype(np.int64)
+        followee = rng.choice(np.arange(1, users + 1, dtype=np.int64),
+                              size=edges, p=popularity)
+        keys = np.unique(follower[follower != followee] * (users + 1) +
+                         followee[follower != followee])
+        follower, followee = keys // (users + 1), keys % (users + 1)
+
+        self.followers = self._adjacency(followee, follower)
+        self.friends = self._adjacency(follower, followee)
+
+        status = rng.rand(users + 1)
+        self.protected = status < protected
+        self.suspended = (status >= protected) & \
+            (status < protected + suspended)
+        self.tweet_counts = np.minimum(rng.geometric(1 / tweets, users + 1),
+                                       3200)
+
+    def _adjacency(self, sources, targets):
+        order = np.argsort(sources, kind='mergesort')
+        offsets = np.zeros(self.users + 2, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=self.users + 1),
+                  out=offsets[1:])
+        return offsets, targets[order]
+
+    def exists(self, user):
+        return 1 <= user <= self.users and not self.suspended[user]
+
+    def followers_ids(self, user):
+        offsets, ids = self.followers
+        return ids[offsets[user]: offsets[user + 1]]
+
+    def friends_ids(self, user):
+        offsets, ids = self.friends
+        return ids[offsets[user]: offsets[user + 1]]
+
+    def user(self, user):
+        """return the user object of the users/lookup endpoint"""
+        return {'id': user,
+                'id_str': str(user),
+                'screen_name': 'user_%d' % user,
+                'protected': bool(self.protected[user]),
+                'followers_count': len(self.followers_ids(user)),
+                'friends_count': len(self.friends_ids(user)),
+                'statuses_count': int(self.tweet_counts[user]),
+                'created_at': 'Thu Jan 01 00:00:00 +0000 2015'}
+
+    def status(self, user, tweet_id):
+        """return a deterministic status with the given id"""
+        rng = random.Random(tweet_id)
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(3, 12))]
+        hashtags = []
+        for _ in range(rng.choice([0, 0, 1, 1, 2])):
+            hashtag = rng.choice(_HASHTAGS)
+            start = len(u' '.join(words)) + 1
+            words.append(u'#' + hashtag)
+            hashtags.append({'text': hashtag,
+                             'indices': [start, start + len(hashtag) + 1]})
+        if rng.random() < 0.2:
+            words.append(rng.choice(_EMOJIS))
+
+        return {'id': tweet_id,
+                'id_str': str(tweet_id),
+                'text': u' '.join(words),
+                'created_at': strftime('%a %b %d %H:%M:%S +0000 %Y',
+                                       gmtime(1420070400 + tweet_id % 10**8)),
+                'entities': {'hashtags': hashtags},
+                'user': self.user(user)}
+
+    def timeline(self, user, count=20, max_id=None, since_id=None):
+        """return up to count statuses of the user, newest first. Tweet ids
+        of a user are user * 10 ** 5 + 1 .. user * 10 ** 5 + tweet_count
+        """
+        newest = user * 10 ** 5 + int(self.tweet_counts[user])
+        oldest = user * 10 ** 5 + 1
+        if max_id is not None:
+            newest = min(newest, max_id)
+        if since_id is not None:
+            oldest = max(oldest, since_id + 1)
+
+        return [self.status(user, tweet_id) for tweet_id in
+                range(newest, max(oldest, newest - count + 1) - 1, -1)]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MockTwitterHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(self.rfile.read(length)))
+        self._handle(params)
+
+    def _respond(self, code, payload, headers={}):
+        body = json.dumps(payload)
+        self.send_response(code)
+        self.send_header('content-type', 'application/json;charset=utf-8')
+        self.send_header('content-length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, params):
+        server = self.server.mock
+        path = urlparse(self.path).path
+        if path not in server.limits:
+            return self._respond(404, {'errors': [{
+                'code': 34, 'message': 'Sorry, that page does not exist.'}]})
+
+        # transient connection failure: close without responding
+        if not server.respond():
+            self.close_connection = 1
+            return
+
+        token = re.search(r'oauth_consumer_key="([^"]*)"',
+                          self.headers.getheader('authorization') or '')
+        token = token.group(1) if token else None
+        if token in server.revoked:
+            server.count('revoked')
+            return self._respond(401, {'errors': [{
+                'code': 89, 'message': 'Invalid or expired token.'}]})
+
+        remaining, reset = server.spend(token, path)
+        headers = {'x-rate-limit-limit': str(server.limits[path]),
+                   'x-rate-limit-remaining': str(max(remaining, 0)),
+                   'x-rate-limit-reset': str(reset)}
+        if remaining < 0:
+            return self._respond(429, {'errors': [{
+                'code': 88, 'message': 'Rate limit exceeded'}]}, headers)
+
+        graph = server.graph
+        if path == '/1.1/account/verify_credentials.json':
+            # the account of the token, which is not part of the graph
+            return self._respond(200, {'id': 0,
+                                       'id_str': '0',
+                                       'screen_name': token or '',
+                                       'created_at': 'Thu Jan 01 00:00:00 '
+                                                     '+0000 2015'}, headers)
+
+        if path == '/1.1/users/lookup.json':
+            ids = [int(user) for value in params.get('user_id', [])
+                   for user in value.split(',') if user]
+            users = [graph.user(user) for user in ids if graph.exists(user)]
+            if not users:
+                return self._respond(404, {'errors': [{
+                    'code': 17, 'message': 'No user matches for specified '
+                                           'terms.'}]}, headers)
+            return self._respond(200, users, headers)
+
+        user = params.get('id', params.get('user_id', ['0']))[0]
+        user = int(user) if user.isdigit() else 0
+        if not graph.exists(user):
+            return self._respond(404, {'errors': [{
+                'code': 34, 'message': 'Sorry, that page does not exist.'}]},
+                headers)
+        if graph.protected[user]:
+            return self._respond(401, {'request': path,
+                                       'error': 'Not authorized.'}, headers)
+
+        if path == '/1.1/statuses/user_timeline.json':
+            count = min(int(params.get('count', ['20'])[0]), 200)
+            max_id = params.get('max_id', [None])[0]
+            since_id = params.get('since_id', [None])[0]
+            timeline = graph.timeline(
+                user, count, max_id=int(max_id) if max_id else None,
+                since_id=int(since_id) if since_id else None)
+            return self._respond(200, timeline, headers)
+
+        if path == '/1.1/followers/ids.json':
+            ids = graph.followers_ids(user)
+        else:
+            ids = graph.friends_ids(user)
+        count = min(int(params.get('count', ['5000'])[0]), 5000)
+        cursor = int(params.get('cursor', ['-1'])[0])
+        start = max(cursor, 0)
+        next_cursor = start + count if start + count < len(ids) else 0
+        return self._respond(200, {'ids': ids[start: start + count].tolist(),
+                                   'next_cursor': next_cursor,
+                                   'next_cursor_str': str(next_cursor),
+                                   'previous_cursor': -start,
+                                   'previous_cursor_str': str(-start)},
+                             headers)
+
+
+class MockTwitterServer(object):
+    """
+    MockTwitterServer class. Serves the followers/ids, friends/ids,
+    statuses/user_timeline, users/lookup and account/verify_credentials
+    endpoints of a SyntheticTwitter graph over https on localhost. Every
+    token (oauth consumer key) has its own rate limit window per endpoint.
+
+    tweepy always uses https and verifies certificates, so the self-signed
+    certificate of the server (ca_bundle) has to be trusted, e.g. by setting
+    the REQUESTS_CA_BUNDLE environment variable before crawling.
+
+    Parameters
+    ----------
+    graph        : SyntheticTwitter instance. Defaults to SyntheticTwitter()
+    port         : port to listen to. Defaults to a free port
+    window       : length of the rate limit windows in seconds.
+        Defaults to 15 * 60
+    limits       : dict{path: requests per window}, overrides the default
+        limits of the endpoints
+    failure_rate : fraction of requests whose connection is dropped.
+        Defaults to 0.01
+    latency      : mean latency of the responses in seconds.
+        Defaults to 0.05
+    revoked      : tokens (oauth consumer keys) whose requests are rejected
+        with 401 and error code 89, as if the credentials were revoked
+
+    Methods
+    -------
+    start       : starts serving in a background thread
+    stop        : stops the server
+    credentials : returns credentials that point to the server
+    """
+    def __init__(self, graph=None, port=0, window=15 * 60, limits=None,
+                 failure_rate=0.01, latency=0.05, seed=0, revoked=()):
+        self.graph = graph if graph is not None else SyntheticTwitter()
+        self.port = port
+        self.window = window
+        self.limits = dict(_LIMITS)
+        self.limits.update(limits or {})
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.windows = {}
+        self.revoked = set(revoked)
+        self.stats = {'requests': 0, 'rate_limited': 0, 'failures': 0,
+                      'revoked': 0}
+        self.host = None
+        self.ca_bundle = None
+        self._random = random.Random(seed)
+        self._lock = thread_lock()
+        self._httpd = None
+        self._directory = None
+
+    def respond(self):
+        """wait for the latency of the request and decide whether the
+        connection is dropped
+        """
+        self._lock.acquire()
+        try:
+            self.stats['requests'] += 1
+            delay = self._random.expovariate(1 / self.latency) \
+                if self.latency else 0
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.stats['failures'] += 1
+        finally:
+            self._lock.release()
+        sleep(delay)
+        return not fail
+
+    def count(self, stat):
+        """increment the counter stat of the stats"""
+        self._lock.acquire()
+        try:
+            self.stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def spend(self, token, path):
+        """spend a request from the window of token for path. Returns the
+        remaining requests, negative if the limit was exceeded, and the reset
+        time of the window
+        """
+        self._lock.acquire()
+        try:
+            now = time()
+            reset, remaining = self.windows.get((token, path), (0, 0))
+            if now >= reset:
+                reset = int(now + self.window) + 1
+                remaining = self.limits[path]
+            remaining -= 1
+            if remaining < 0:
+                self.stats['rate_limited'] += 1
+            else:
+                self.windows[(token, path)] = (reset, remaining)
+            return remaining, reset
+        finally:
+            self._lock.release()
+
+    def start(self):
+        self._directory = tempfile.mkdtemp()
+        keyfile = os.path.join(self._directory, 'key.pem')
+        self.ca_bundle = os.path.join(self._directory, 'cert.pem')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                 '-days', '1', '-subj', '/CN=localhost',
+                 '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                 '-keyout', keyfile, '-out', self.ca_bundle],
+                stdout=devnull, stderr=devnull)
+
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', self.port),
+                                           _MockTwitterHandler)
+        self._httpd.socket = ssl.wrap_socket(self._httpd.socket,
+                                             keyfile=keyfile,
+                                             certfile=self.ca_bundle,
+                                             server_side=True)
+        self._httpd.mock = self
+        self.port = self._httpd.server_address[1]
+        self.host = 'localhost:%d' % self.port
+
+        server = Thread(target=self._httpd.serve_forever)
+        server.daemon = True
+        server.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        shutil.rmtree(self._directory)
+
+    def credentials(self, count):
+        """return count sets of api tokens that point to the server"""
+        return [{'api_key': 'key_%d' % idx,
+                 'api_secret': 'secret_%d' % idx,
+                 'access': 'access_%d' % idx,
+                 'access_secret': 'access_secret_%d' % idx,
+                 'host': self.host} for idx in range(count)]
@@ -8,7 +8,13 @@ annotated dictionary of a set of emojis
 from __future__ import division
 import re
 import os
+import hashlib
+import sqlite3
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from multiprocessing import Pool
+from threading import Lock as thread_lock
 
 from textblob.sentiments import PatternAnalyzer
 
@@ -20,14 +26,17 @@ def determine_polarity((pos_score, neg_score, obj_score)):
     return 1 if pos_score > neg_score else -1 if pos_score < neg_score else 0
 
 
+_EMOTICONS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'emoticons_sentiments.csv')
+
+
 def _get_emoticons_dict():
     """Returns a dictionary that maps unicode codes of emojis to sentiment
     score of the form (positivity, negativy, objectivity)
     """
     emoticons_sent_dict = {}
 
-    path = os.path.dirname(os.path.realpath(__file__))
-    emot_sent = pd.read_csv(path + '/' + 'emoticons_sentiments.csv')
+    emot_sent = pd.read_csv(_EMOTICONS_FILE)
 
     emot_sent = emot_sent[['unicode_code',
                            'pos_score',
@@ -45,14 +54,208 @@ def _get_emoticons_dict():
     return emoticons_sent_dict
 
 
+def _get_emoticons_digest():
+    """returns the md5 digest of the emoticons annotation file"""
+    with open(_EMOTICONS_FILE, 'rb') as emoticons_file:
+        return hashlib.md5(emoticons_file.read()).hexdigest()
+
+
+def _get_emoticons_table(emoticons_dict):
+    """Returns a list indexed by the codepoint of an emoji minus
+    _EMOTICONS_FIRST, that holds the sentiment score of the emoji or None if
+    the emoji is not annotated
+    """
+    table = [None] * (_EMOTICONS_LAST - _EMOTICONS_FIRST + 1)
+    for emot_code, score in emoticons_dict.iteritems():
+        codepoint = int(emot_code[2:], 16)
+        if _EMOTICONS_FIRST <= codepoint <= _EMOTICONS_LAST:
+            table[codepoint - _EMOTICONS_FIRST] = score
+    return table
+
+
+_EMOTICONS_FIRST = 0x1f601
+_EMOTICONS_LAST = 0x1f64f
+_EMOTICONS_RE = re.compile(u'[\U0001f601-\U0001f64f]')
 _EMOTICONS_DICT = _get_emoticons_dict()
+_EMOTICONS_TABLE = _get_emoticons_table(_EMOTICONS_DICT)
+_EMOTICONS_DIGEST = _get_emoticons_digest()
 _SENTIMENT_ANALYZER = PatternAnalyzer()
 
 
+class ScoreCache(object):
+    """
+    ScoreCache class. Memoizes tweet scores, keyed by the sha1 of the tweet
+    text, in an in-memory LRU and optionally in an sqlite file that is shared
+    by later runs and by concurrent processes. The file is cleared when
+    emoticons_sentiments.csv changes.
+
+    Parameters
+    ----------
+    size : maximum number of scores kept in memory. Defaults to 100000
+    path : path of the sqlite file. Defaults to None (memory only)
+
+    Methods
+    -------
+    get   : returns the cached score of a key or None
+    put   : caches the score of a key
+    clear : drops all cached scores
+    """
+    def __init__(self, size=100000, path=None):
+        self.size = size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = thread_lock()
+        self._lru = OrderedDict()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        """open the sqlite file once per process. Connections must not be
+        shared with forked processes
+        """
+        if self._pid == os.getpid():
+            return self._connection
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False, timeout=60)
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                           '(key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                           '(hash BLOB PRIMARY KEY, pos REAL, neg REAL, '
+                           'obj REAL)')
+        digest = connection.execute('SELECT value FROM meta WHERE key = ?',
+                                    ('emoticons',)).fetchone()
+        if digest is None or digest[0] != _EMOTICONS_DIGEST:
+            connection.execute('DELETE FROM scores')
+            connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               ('emoticons', _EMOTICONS_DIGEST))
+        self._connection = connection
+        self._pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            score = self._lru.pop(key, None)
+            if score is None and self.path:
+                row = self._connect().execute(
+                    'SELECT pos, neg, obj FROM scores WHERE hash = ?',
+                    (sqlite3.Binary(key),)).fetchone()
+                score = tuple(row) if row else None
+            if score is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, score)
+            return score
+        finally:
+            self.lock.release()
+
+    def put(self, key, score):
+        self.lock.acquire()
+        try:
+            self._remember(key, score)
+            if self.path:
+                self._connect().execute(
+                    'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                    (sqlite3.Binary(key),) + tuple(score))
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self._lru.clear()
+            if self.path:
+                self._connect().execute('DELETE FROM scores')
+        finally:
+            self.lock.release()
+
+    def _remember(self, key, score):
+        if self.size <= 0:
+            return
+        self._lru[key] = score
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+
+_SCORE_CACHE = ScoreCache()
+
+
+def set_score_cache(size=100000, path=None):
+    """configure the cache used by get_tweet_score. Scores are kept in an LRU
+    of the given size and, if a path is given, persisted in an sqlite file.
+    Set size to 0 and path to None to disable caching.
+
+    Returns
+    -------
+    cache : the ScoreCache instance or None if caching is disabled
+    """
+    global _SCORE_CACHE
+    if size <= 0 and path is None:
+        _SCORE_CACHE = None
+    else:
+        _SCORE_CACHE = ScoreCache(size, path)
+    return _SCORE_CACHE
+
+
 def get_tweet_score(tweet=None):
     """Returns sentiment score of tweet by averaging the text score as decided
-    by the PatternAnalyzer with the average score of the detected emojis
+    by the PatternAnalyzer with the average score of the detected emojis.
+    Scores are memoized by the cache configured with set_score_cache
     """
+    if _SCORE_CACHE is None:
+        return _compute_tweet_score(tweet)
+
+    text = tweet.encode('utf-8') if isinstance(tweet, unicode) else tweet
+    key = hashlib.sha1(text).digest()
+    tweet_score = _SCORE_CACHE.get(key)
+    if tweet_score is None:
+        tweet_score = _compute_tweet_score(tweet)
+        _SCORE_CACHE.put(key, tweet_score)
+    return tweet_score
+
+
+def get_tweet_scores(texts, processes=None, chunk_size=10000):
+    """Returns the sentiment scores of a sequence of tweets, as computed by
+    get_tweet_score, in three arrays
+
+    Parameters
+    ----------
+    texts      : sequence of tweet texts
+    processes  : number of processes that score chunks of the texts in
+        parallel. Defaults to None (serial)
+    chunk_size : number of texts sent to a process at a time
+
+    Returns
+    -------
+    pos_scores, neg_scores, obj_scores : numpy arrays of float64
+    """
+    texts = list(texts)
+    if processes and len(texts) > chunk_size:
+        chunks = [texts[idx:idx + chunk_size]
+                  for idx in range(0, len(texts), chunk_size)]
+        pool = Pool(processes)
+        try:
+            scores = [score for chunk in pool.map(_score_chunk, chunks)
+                      for score in chunk]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = _score_chunk(texts)
+
+    scores = np.array(scores, dtype=np.float64).reshape(-1, 3)
+    return scores[:, 0], scores[:, 1], scores[:, 2]
+
+
+def _score_chunk(texts):
+    return [get_tweet_score(text) for text in texts]
+
+
+def _compute_tweet_score(tweet):
+    """sentiment score of tweet without caching"""
     text_score = [0, 0]  # pos_score, neg_score
     emot_score = [0, 0]  # pos_score, neg_score
     emot_sent_scores = []
@@ -64,14 +267,11 @@ def get_tweet_score(tweet=None):
     else:
         text_score[1] = abs(polarity)
 
-    # find emoticons
-    emoticons = re.findall(u'[\U0001f601-\U0001f64f]', tweet)
-
-    # retrieve sentiment scores of emoticons using annotation dict
-    for emot_code in emoticons:
-        emot_code = emot_code.encode('unicode_escape')
-        if emot_code in _EMOTICONS_DICT:
-            emot_sent_scores.append(_EMOTICONS_DICT[emot_code])
+    # retrieve sentiment scores of emoticons using the codepoint table
+    for emoticon in _EMOTICONS_RE.findall(tweet):
+        score = _EMOTICONS_TABLE[ord(emoticon) - _EMOTICONS_FIRST]
+        if score is not None:
+            emot_sent_scores.append(score)
     # taking the sum of pos and neg
     for score in emot_sent_scores:
         emot_score[0] += score[0]
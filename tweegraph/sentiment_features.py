@@ -7,21 +7,29 @@
 from __future__ import division
 from sys import maxint
 import math
+import numpy as np
+from scipy import sparse
 from tweegraph.db import get_user_topic_affiliation_dict
 from tweegraph.db import get_topic_user_dict
 from tweegraph.db import determine_polarity
+from tweegraph.topic_index import UserTopicIndex
 
 _USER_TOPIC_DICT = {}
 _TOPIC_USER_DICT = {}
 
+# UserTopicIndex set by set_user_topic_index. When set, the metrics read the
+# index instead of the dicts
+_INDEX = None
+
 
 def set_user_topic_dict(user_topic_dict):
     """used to set the user topic affiliation dict that is going to be used
     for producing the correlations. Must always be set before using the
     metrics.
     """
-    global _USER_TOPIC_DICT
+    global _USER_TOPIC_DICT, _INDEX
     _USER_TOPIC_DICT = dict(user_topic_dict)
+    _INDEX = None
 
 
 def set_topic_user_dict(topic_user_dict):
@@ -29,15 +37,55 @@ def set_topic_user_dict(topic_user_dict):
     for producing the correlations. Must always be set before using the
     metrics.
     """
-    global _TOPIC_USER_DICT
+    global _TOPIC_USER_DICT, _INDEX
     _TOPIC_USER_DICT = dict(topic_user_dict)
+    _INDEX = None
+
+
+def set_user_topic_index(index):
+    """used instead of set_user_topic_dict and set_topic_user_dict to set a
+    UserTopicIndex, e.g. one memory mapped with UserTopicIndex.load, as the
+    source of the metrics
+    """
+    global _USER_TOPIC_DICT, _TOPIC_USER_DICT, _INDEX
+    _USER_TOPIC_DICT = {}
+    _TOPIC_USER_DICT = {}
+    _INDEX = index
+
+
+def _entry(user_id, hashtag):
+    """scores and counts of the user for the hashtag"""
+    if _INDEX is not None:
+        return _INDEX.entry(user_id, hashtag)
+    return _USER_TOPIC_DICT[user_id][hashtag]
+
+
+def _hashtags(user_id):
+    if _INDEX is not None:
+        return _INDEX.hashtags(user_id)
+    return _USER_TOPIC_DICT[user_id]
+
+
+def _total(user_id):
+    """sum of the hashtag counts of the user"""
+    if _INDEX is not None:
+        return _INDEX.total(user_id)
+    return sum(sum(values[3:6]) for values in
+               _USER_TOPIC_DICT[user_id].itervalues())
+
+
+def _adoption(hashtag):
+    """number of users that adopted the hashtag"""
+    if _INDEX is not None:
+        return _INDEX.adoption_of(hashtag)
+    return len(_TOPIC_USER_DICT[hashtag])
 
 
 def svo_distance(user_id, hashtag, a=0.45, b=0.45, c=0.1):
     """retuns the sentiment volume objectivity metric
     """
     # sentiment
-    count_pos, count_neg, count_neut = _USER_TOPIC_DICT[user_id][hashtag][3:6]
+    count_pos, count_neg, count_neut = _entry(user_id, hashtag)[3:6]
     sentiment = count_pos - count_neg / (count_pos + count_neg)
     sentiment = 1 / (1 + 10**-sentiment)  # normalization
 
@@ -47,9 +95,7 @@ def svo_distance(user_id, hashtag, a=0.45, b=0.45, c=0.1):
     objectivity = count_neut / hashtag_count
 
     # volume
-    total_count = 0
-    for hashtag in _USER_TOPIC_DICT[user_id]:
-        total_count += sum(_USER_TOPIC_DICT[user_id][hashtag][3:6])
+    total_count = _total(user_id)
     volume = hashtag_count / total_count
     
     return a * sentiment + b * volume + c * objectivity
@@ -59,8 +105,8 @@ def get_common_hashtags(user_id_1, user_id_2):
     """returns a list of the hashtags the two users have in common. If size is
     set to True instead of the list only the size of the list is returned
     """
-    common_hashtags = list(set(_USER_TOPIC_DICT[user_id_2]) & \
-                           set(_USER_TOPIC_DICT[user_id_1]))
+    common_hashtags = list(set(_hashtags(user_id_2)) &
+                           set(_hashtags(user_id_1)))
     return common_hashtags
 
 
@@ -77,8 +123,8 @@ def get_sentiment_agreement(user_id_1, user_id_2,
         common_hashtags = get_common_hashtags(user_id_1, user_id_2)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 == pol_2 and pol_1 not in exclude:
             agreement_score += 1
@@ -96,8 +142,8 @@ def get_sentiment_disagreement(user_id_1, user_id_2, common_hashtags=[]):
         common_hashtags = get_common_hashtags(user_id_1, user_id_2)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 and pol_1 == -pol_2:
             disagreement_score += 1
@@ -151,11 +197,11 @@ def get_sentiment_rarest(user_id_1, user_id_2, common_hashtags=[]):
         common_hashtags = get_common_hashtags(user_id_1, user_id_2)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 and pol_1 == pol_2:
-            adoption = min(adoption, len(_TOPIC_USER_DICT[hashtag]))
+            adoption = min(adoption, _adoption(hashtag))
 
     if adoption != maxint:
         return adoption
@@ -172,11 +218,12 @@ def get_sentiment_adamic_adar(user_id_1, user_id_2, common_hashtags=[]):
         common_hashtags = get_common_hashtags(user_id_1, user_id_2)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 == pol_2:
-            adamic_adar_score += 1 / math.log(len(_TOPIC_USER_DICT[hashtag]))
+            adoption = _adoption(hashtag)
+            adamic_adar_score += 1 / math.log(adoption)
 
     return adamic_adar_score
 
@@ -190,11 +237,11 @@ def get_sentiment_inverse(user_id_1, user_id_2, common_hashtags=[]):
         common_hashtags = get_common_hashtags(user_id_1, user_id_2)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 == pol_2:
-            inverse += 1 / len(_TOPIC_USER_DICT[hashtag])
+            inverse += 1 / _adoption(hashtag)
 
     return inverse
 
@@ -212,11 +259,11 @@ def get_size_of_common_hashtags(user_id_1, user_id_2, common_hashtags=[]):
             user_id_1, user_id_2, common_hashtags=common_hashtags)
 
     for hashtag in common_hashtags:
-        pol_1 = determine_polarity((_USER_TOPIC_DICT[user_id_1][hashtag][:3]))
-        pol_2 = determine_polarity((_USER_TOPIC_DICT[user_id_2][hashtag][:3]))
+        pol_1 = determine_polarity(_entry(user_id_1, hashtag)[:3])
+        pol_2 = determine_polarity(_entry(user_id_2, hashtag)[:3])
 
         if pol_1 == pol_2:
-            mean_size += len(_TOPIC_USER_DICT[hashtag])
+            mean_size += _adoption(hashtag)
 
     if sentiment_agreement:
         return mean_size / sentiment_agreement
@@ -224,3 +271,101 @@ def get_size_of_common_hashtags(user_id_1, user_id_2, common_hashtags=[]):
         return -1
 
 
+def get_sentiment_features(pairs, chunk_size=100000, index=None):
+    """computes the sentiment features of many pairs of users at once. The
+    result for every pair equals the result of the corresponding get_sentiment
+    function, but all the features are computed in one vectorized pass over
+    sparse user x hashtag polarity matrices instead of per pair and feature.
+
+    Parameters
+    ----------
+    pairs      : sequence of (user_id_1, user_id_2) pairs or an array of shape
+        (n, 2). Users must be in the user topic dict
+    chunk_size : number of pairs processed at a time. Bounds the memory used
+        for the intermediate pair x hashtag matrices
+    index      : UserTopicIndex to use. Defaults to the index set with
+        set_user_topic_index or, if none is set, to an index built from the
+        user topic and topic user dicts for this call
+
+    Returns
+    -------
+    features : dict of numpy arrays of length n with the keys 'common',
+        'agreement', 'disagreement', 'alignment', 'misalignment', 'rarest',
+        'adamic_adar', 'inverse' and 'mean_size'
+    """
+    if index is None:
+        index = _INDEX
+    if index is None:
+        index = UserTopicIndex.from_dicts(_USER_TOPIC_DICT, _TOPIC_USER_DICT)
+    pos, neg, obj = index.polarity_matrices()
+    adoption = index.adoption.astype(np.float64)
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    index_1 = index.rows(pairs[:, 0])
+    index_2 = index.rows(pairs[:, 1])
+
+    with np.errstate(divide='ignore'):
+        adamic_adar_weights = 1 / np.log(adoption)
+        inverse_weights = 1 / adoption
+
+    names = ['common', 'agreement', 'disagreement', 'alignment',
+             'misalignment', 'rarest', 'adamic_adar', 'inverse', 'mean_size']
+    features = dict((name, []) for name in names)
+
+    for start in range(0, len(pairs), chunk_size):
+        rows_1 = index_1[start:start + chunk_size]
+        rows_2 = index_2[start:start + chunk_size]
+        pos_1, pos_2 = pos[rows_1], pos[rows_2]
+        neg_1, neg_2 = neg[rows_1], neg[rows_2]
+        obj_1, obj_2 = obj[rows_1], obj[rows_2]
+        any_1 = pos_1 + neg_1 + obj_1
+        any_2 = pos_2 + neg_2 + obj_2
+
+        # pair x hashtag indicators of common hashtags with polar agreement,
+        # any agreement and polar disagreement
+        polar = pos_1.multiply(pos_2) + neg_1.multiply(neg_2)
+        same = (polar + obj_1.multiply(obj_2)).tocsr()
+        opposite = pos_1.multiply(neg_2) + neg_1.multiply(pos_2)
+
+        common = _row_sums(any_1.multiply(any_2))
+        agreement = _row_sums(same)
+        polar_agreement = _row_sums(polar)
+        disagreement = _row_sums(opposite)
+
+        features['common'].append(common)
+        features['agreement'].append(agreement)
+        features['disagreement'].append(disagreement)
+        features['alignment'].append(_ratio(polar_agreement, common))
+        features['misalignment'].append(_ratio(disagreement, common))
+        features['rarest'].append(_row_min(
+            sparse.csr_matrix(polar.dot(sparse.diags(adoption)))))
+        features['adamic_adar'].append(same.dot(adamic_adar_weights))
+        features['inverse'].append(same.dot(inverse_weights))
+        features['mean_size'].append(_ratio(same.dot(adoption), agreement))
+
+    for name in names:
+        features[name] = np.concatenate(features[name]) if features[name] \
+            else np.zeros(0)
+    return features
+
+
+def _row_sums(matrix):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def _ratio(numerator, denominator):
+    """numerator / denominator or -1 where the denominator is 0"""
+    ratio = np.full(len(numerator), -1, dtype=np.float64)
+    nonzero = denominator > 0
+    ratio[nonzero] = numerator[nonzero] / denominator[nonzero]
+    return ratio
+
+
+def _row_min(matrix):
+    """minimum of the stored values of each row or -1 for empty rows"""
+    matrix.eliminate_zeros()
+    minimum = np.full(matrix.shape[0], -1, dtype=np.float64)
+    nonempty = np.diff(matrix.indptr) > 0
+    if nonempty.any():
+        starts = matrix.indptr[:-1][nonempty]
+        minimum[nonempty] = np.minimum.reduceat(matrix.data, starts)
+    return minimum
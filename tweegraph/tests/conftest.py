@@ -0,0 +1,25 @@
+import pytest
+
+from .. mock_server import MockTwitterServer
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """returns a function that starts a MockTwitterServer, without failures
+    and latency unless they are given, and trusts its certificate for the
+    rest of the test. The servers are stopped after the test
+    """
+    servers = []
+
+    def start(graph, **kwargs):
+        kwargs.setdefault('failure_rate', 0)
+        kwargs.setdefault('latency', 0)
+        server = MockTwitterServer(graph, **kwargs)
+        server.start()
+        servers.append(server)
+        monkeypatch.setenv('REQUESTS_CA_BUNDLE', server.ca_bundle)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
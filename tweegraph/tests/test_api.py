@@ -0,0 +1,66 @@
+from time import time
+
+from .. api import RateLimitScheduler
+
+
+class Response(object):
+    def __init__(self, remaining, reset):
+        self.headers = {'x-rate-limit-remaining': str(remaining),
+                        'x-rate-limit-reset': str(reset)}
+
+
+def test_scheduler_unknown_limits():
+    scheduler = RateLimitScheduler()
+    assert scheduler.delay(now=100) == 0
+
+
+def test_scheduler_exhausted_budget():
+    scheduler = RateLimitScheduler(margin=1)
+    scheduler.update(Response(0, 1000))
+    assert scheduler.delay(now=400) == 601
+    assert scheduler.delay(now=1001) == 0
+
+
+def test_scheduler_pacing():
+    scheduler = RateLimitScheduler(margin=0)
+    scheduler.update(Response(10, 1000))
+    scheduler.last_request = 0
+    assert scheduler.delay(now=0) == 100
+    assert scheduler.delay(now=100) == 0
+
+    scheduler.pace = False
+    assert scheduler.delay(now=0) == 0
+
+
+def test_shared_scheduler_reserves_slots():
+    class API(object):
+        last_response = Response(0, 10 ** 10)
+
+    scheduler = RateLimitScheduler()
+    scheduler.update(Response(2, 10 ** 10))
+    first, second = scheduler.share(API()), scheduler.share(API())
+    first.wait()
+    assert scheduler.remaining == 1
+    assert second.delay() > 0
+
+    second.update()
+    assert scheduler.remaining == 0
+
+
+def test_scheduler_out_of_order_responses():
+    reset = int(time()) + 1000
+    scheduler = RateLimitScheduler(pace=False)
+    scheduler.update(Response(10, reset))
+    scheduler.wait()
+    scheduler.wait()
+    assert scheduler.remaining == 8
+
+    # a slower response of an earlier request of the same window
+    scheduler.update(Response(9, reset))
+    assert scheduler.remaining == 8
+    # a response of the previous window
+    scheduler.update(Response(0, reset - 900))
+    assert scheduler.remaining == 8 and scheduler.reset == reset
+    # a new window
+    scheduler.update(Response(14, reset + 900))
+    assert scheduler.remaining == 14 and scheduler.reset == reset + 900
@@ -1,8 +1,13 @@
+import json
 import tweepy
+import numpy as np
 
 from .. data import get_unique_nodes_from_dict as un_nodes_dict
 from .. data import get_edges_from_dict as edges_dict
 from .. data import get_mutual_following_edges as mutual_edges
+from .. data import get_mutual_following_dict as mutual_dict
+from .. data import get_relations_from_log as relations_from_log
+from .. data import load_graph
 
 
 test_dict = {
@@ -46,3 +51,38 @@ def test_mutual_following():
     global m_edges
     list_of_mutual_edges = mutual_edges(test_dict, edges)
     assert list_of_mutual_edges == m_edges
+    assert mutual_edges(test_dict) == [edge for edge in edges
+                                       if edge in m_edges]
+    assert mutual_dict(test_dict) == {'1': {'following': [2]},
+                                      '2': {'following': [1]}}
+
+
+def test_relations_from_log(tmpdir):
+    global test_dict
+    log = tmpdir.join('relations.jsonl')
+    log.write(''.join(json.dumps({'id': int(key),
+                                  'followers': value['followers'],
+                                  'following': value['following']}) + '\n'
+                      for key, value in test_dict.items()) + '{"id": 7, "fol')
+    assert relations_from_log(str(log)) == test_dict
+
+
+def test_csr_graph(tmpdir):
+    file_name = str(tmpdir.join('links.csv'))
+    with open(file_name, 'w') as links:
+        links.write('10,30\n20,30\n30,10\n10,30\n40,20\n')
+
+    graph = load_graph(file_name)
+    cached = load_graph(file_name)
+    for graph in (graph, cached):
+        assert list(graph.nodes) == [10, 20, 30, 40]
+        assert graph.number_of_edges() == 4
+        assert list(graph.successors(10)) == [30]
+        assert list(graph.predecessors(30)) == [10, 20]
+        assert list(graph.out_degree()) == [1, 1, 1, 1]
+        assert list(graph.in_degree()) == [1, 1, 2, 0]
+    assert isinstance(cached.nodes, np.memmap)
+
+    graph = load_graph(file_name, directed=False)
+    assert list(graph.neighbors(30)) == [10, 20]
+    assert graph.number_of_edges() == 3
@@ -0,0 +1,185 @@
+from threading import Event, Thread
+from pymongo.errors import BulkWriteError, WriteError
+
+from .. import db
+
+
+def test_timeline_chunks():
+    timeline = [{'id': idx, 'text': 'x' * 100} for idx in range(50, 0, -1)]
+    max_chunk_size = db._MAX_CHUNK_SIZE
+    db._MAX_CHUNK_SIZE = 1000
+    try:
+        documents = db._timeline_documents(7, timeline)
+    finally:
+        db._MAX_CHUNK_SIZE = max_chunk_size
+
+    assert len(documents) > 1
+    assert documents[0]['_id'] == 7
+    assert documents[0]['newest_id'] == 50
+    assert documents[0]['chunks'] == len(documents)
+    assert [document['chunk'] for document in documents] == \
+        range(len(documents))
+    assert [status for document in documents
+            for status in document['content']] == timeline
+
+
+def test_status_documents():
+    timeline = [{'id': idx, 'text': 'x'} for idx in range(3, 0, -1)]
+    documents = db._status_documents(7, timeline)
+
+    assert [document['_id'] for document in documents] == [3, 2, 1]
+    assert all(document['user_id'] == 7 for document in documents)
+    assert 'user_id' not in timeline[0]
+
+
+def test_insert_documents_skips_stored():
+    class Collection(object):
+        def __init__(self, code):
+            self.code = code
+
+        def insert_many(self, documents, ordered):
+            raise BulkWriteError({'nInserted': len(documents) - 1,
+                                  'writeErrors': [{'code': self.code}]})
+
+    assert db._insert_documents(Collection(11000), [{}, {}, {}]) == 2
+    try:
+        db._insert_documents(Collection(121), [{}, {}])
+    except BulkWriteError:
+        pass
+    else:
+        assert False
+
+
+def test_merge_overflow_keeps_stored_timeline():
+    class Collection(object):
+        def __init__(self, database, name):
+            self.database = database
+            self.name = name
+            self.documents = []
+
+        def update_one(self, query, update):
+            raise WriteError('document too large')
+
+        def find(self, query, projection):
+            return self
+
+        def sort(self, key, direction):
+            return sorted(self.documents, key=lambda document: document[key])
+
+        def insert_many(self, documents):
+            if self.database.fail:
+                raise WriteError('insert failed')
+            self.documents.extend(documents)
+
+        def drop(self):
+            self.database.collections.pop(self.name, None)
+
+        def rename(self, name, dropTarget):
+            self.drop()
+            self.name = name
+            self.database.collections[name] = self
+
+    class Database(object):
+        def __init__(self):
+            self.fail = False
+            self.collections = {}
+
+        def __getitem__(self, name):
+            if name not in self.collections:
+                self.collections[name] = Collection(self, name)
+            return self.collections[name]
+
+    for fail in [True, False]:
+        database = Database()
+        database['7'].insert_many(
+            db._timeline_documents(7, [{'id': 2}, {'id': 1}]))
+        database.fail = fail
+        try:
+            db._merge_timeline(database['7'], 7, [{'id': 4}, {'id': 3}])
+        except WriteError:
+            assert fail
+        else:
+            assert not fail
+
+        statuses = [status['id'] for status in
+                    db._get_statuses(database['7'])]
+        assert statuses == ([2, 1] if fail else [4, 3, 2, 1])
+        assert list(database.collections) == ['7']
+
+
+def test_collections_layout_skips_other_collections(monkeypatch):
+    class Database(object):
+        def collection_names(self):
+            return ['12', 'timelines', '7', '7_merged', 'system.indexes']
+
+    monkeypatch.setattr(db, 'get_client', lambda: {'db': Database()})
+    # e.g. a db migrated in place to the 'single' layout
+    assert db._get_user_ids('db') == ['12', '7']
+    assert db.get_number_of_collections('db') == 2
+
+
+def test_writer_backpressure(monkeypatch):
+    release = Event()
+    written = []
+
+    def write_batch(self, batch):
+        release.wait(10)
+        written.extend(batch)
+
+    class Status(object):
+        _json = {'id': 1}
+
+    def produce():
+        for user in range(5):
+            writer.store_timeline('db', user, [Status()])
+
+    monkeypatch.setattr(db.TimelineWriter, '_write_batch', write_batch)
+    writer = db.TimelineWriter(batch_size=1, max_pending=2)
+    producer = Thread(target=produce)
+    producer.start()
+    # one timeline is being written and two are queued
+    producer.join(0.5)
+    assert producer.is_alive()
+
+    release.set()
+    producer.join(10)
+    writer.flush()
+    assert len(written) == 5
+
+
+def test_writer_keeps_user_order_and_reports_failures(monkeypatch):
+    writes = []
+
+    def insert_documents(collection, documents):
+        if collection == ('db', '8'):
+            raise WriteError('insert failed')
+        writes.append(('store', collection[1],
+                       [document['_id'] for document in documents]))
+
+    def merge_timeline(collection, user_id, timeline):
+        writes.append(('merge', collection[1], user_id))
+
+    class Status(object):
+        _json = {'id': 1}
+
+    monkeypatch.setattr(db, 'get_client', lambda: {
+        'db': dict((user, ('db', user)) for user in ['7', '8', '9'])})
+    monkeypatch.setattr(db, '_insert_documents', insert_documents)
+    monkeypatch.setattr(db, '_merge_timeline', merge_timeline)
+
+    writer = db.TimelineWriter(batch_size=10)
+    writer._write_batch([('store', 'db', 7, [{'id': 1}]),
+                         ('merge', 'db', 7, [{'id': 2}]),
+                         ('store', 'db', 9, [{'id': 1}]),
+                         ('store', 'db', 8, [{'id': 1}])])
+    # the store of user 7 is written before its merge
+    assert sorted(writes) == [('merge', '7', 7), ('store', '7', [7]),
+                              ('store', '9', [9])]
+    assert writes.index(('store', '7', [7])) < \
+        writes.index(('merge', '7', 7))
+    assert writer.failed == [8]
+
+    writer.failed = []
+    writer.store_timeline('db', 8, [Status()])
+    writer.flush()
+    assert writer.failed == [8]
@@ -0,0 +1,76 @@
+from threading import Event, Thread
+from multiprocessing import Process
+
+from ..distributed import CrawlCoordinator, crawl_worker, _CoordinatorClient
+from ..mock_server import SyntheticTwitter
+
+
+def test_coordinator_with_worker_processes(tmpdir, mock_server):
+    graph = SyntheticTwitter(users=150, edges=600, protected=0, suspended=0)
+    server = mock_server(graph, window=2,
+                         limits={'/1.1/followers/ids.json': 1000,
+                                 '/1.1/friends/ids.json': 1000})
+
+    coordinator = CrawlCoordinator([1, 2, 3], graph_size=10 ** 9,
+                                   export_name=str(tmpdir.join('out.json')),
+                                   batch_size=5, lease_timeout=1,
+                                   secret='secret')
+    coordinator.start()
+    try:
+        # a worker that crashes after taking a lease
+        crashed = _CoordinatorClient(coordinator.address, 'secret')
+        lost = crashed.call(op='lease')['nodes']
+        crashed.close()
+
+        workers = [Process(target=crawl_worker, args=(coordinator.address,),
+                           kwargs={'api': tokens, 'secret': 'secret'})
+                   for tokens in server.credentials(3)]
+        for worker in workers:
+            worker.start()
+        assert coordinator.wait(60)
+        for worker in workers:
+            worker.join(10)
+            assert worker.exitcode == 0
+    finally:
+        coordinator.stop()
+
+    assert coordinator.expired_leases >= 1
+    assert not coordinator.in_progress and not coordinator.leases
+    assert set(lost) <= set(coordinator.explored_nodes)
+    assert set(coordinator.explored_nodes) == coordinator.seen_nodes
+    for node, relations in coordinator.explored_nodes.items():
+        assert sorted(relations['followers']) == \
+            sorted(graph.followers_ids(node).tolist())
+        assert sorted(relations['following']) == \
+            sorted(graph.friends_ids(node).tolist())
+
+
+def test_slow_progress_callbacks_do_not_block_leases():
+    coordinator = CrawlCoordinator(range(1, 11), batch_size=5)
+    called, release = Event(), Event()
+
+    def slow_callback(coordinator):
+        called.set()
+        release.wait(10)
+
+    coordinator.on_progress(slow_callback, every=1)
+    lease = coordinator.handle({'op': 'lease'})
+    report = Thread(target=coordinator.handle,
+                    kwargs={'request': {'op': 'report',
+                                        'lease': lease['lease'],
+                                        'node': lease['nodes'][0],
+                                        'followers': [], 'following': []}})
+    report.start()
+    try:
+        assert called.wait(10)
+        # other workers are served while the callback runs
+        leases = []
+        worker = Thread(target=lambda: leases.append(
+            coordinator.handle({'op': 'lease'})))
+        worker.start()
+        worker.join(5)
+        assert leases and leases[0]['nodes'] == range(6, 11)
+        assert coordinator.explored_count == 1
+    finally:
+        release.set()
+        report.join(10)
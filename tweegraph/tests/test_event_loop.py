@@ -0,0 +1,65 @@
+import socket
+from time import time
+
+from .. event_loop import EventLoopTraverser, _parse_response
+from .. mock_server import SyntheticTwitter
+
+
+def test_parse_response():
+    response = _parse_response('HTTP/1.1 200 OK\r\nTransfer-Encoding: '
+                               'chunked\r\nX-Rate-Limit-Remaining: 3\r\n\r\n'
+                               '4\r\n{"a"\r\n4\r\n: 1}\r\n0\r\n\r\n')
+    assert response.status == 200
+    assert response.headers['x-rate-limit-remaining'] == '3'
+    assert response.body == '{"a": 1}'
+
+
+def test_event_loop_traverser(tmpdir, mock_server):
+    graph = SyntheticTwitter(users=150, edges=600, suspended=0.05, seed=1)
+    server = mock_server(graph, window=2, failure_rate=0.05, latency=0.01,
+                         limits={'/1.1/followers/ids.json': 1000,
+                                 '/1.1/friends/ids.json': 1000})
+
+    traverser = EventLoopTraverser([1, 2, 3], server.credentials(2),
+                                   graph_size=10 ** 9, concurrency=8,
+                                   export_name=str(tmpdir.join('out.json')))
+    try:
+        traverser.start()
+        assert traverser.wait(60)
+    finally:
+        traverser.stop(10)
+
+    assert len(traverser.workers) == 1
+    assert server.stats['failures'] > 0
+    assert not traverser.in_progress
+    assert set(traverser.explored_nodes) == traverser.seen_nodes
+    for node, relations in traverser.explored_nodes.items():
+        followers, friends = [], []
+        if graph.exists(node) and not graph.protected[node]:
+            followers = graph.followers_ids(node).tolist()
+            friends = graph.friends_ids(node).tolist()
+        assert sorted(relations['followers']) == sorted(followers)
+        assert sorted(relations['following']) == sorted(friends)
+
+
+def test_connection_retries_are_capped():
+    # nothing listens on the port, so every connection is refused
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    credentials = [{'api_key': 'key', 'api_secret': 'secret',
+                    'access': 'access', 'access_secret': 'access_secret',
+                    'host': '127.0.0.1:%d' % port}]
+
+    traverser = EventLoopTraverser([1], credentials, max_retries=2)
+    started = time()
+    traverser.start()
+    try:
+        # the requests are given up after 0.5 + 1 seconds of backoff
+        assert traverser.wait(10)
+        assert time() - started < 5
+    finally:
+        traverser.stop(10)
+    assert all(scheduler.interrupted()
+               for scheduler in traverser.schedulers[0].values())
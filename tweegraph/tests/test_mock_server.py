@@ -0,0 +1,36 @@
+import pytest
+from tweepy import RateLimitError
+
+from .. api import create_api_instance
+from .. mock_server import SyntheticTwitter
+
+
+def test_rate_limit_headers(mock_server):
+    graph = SyntheticTwitter(users=20, edges=100, protected=0, suspended=0)
+    server = mock_server(graph, window=3600,
+                         limits={'/1.1/statuses/user_timeline.json': 2})
+    api, other = [create_api_instance(tokens)
+                  for tokens in server.credentials(2)]
+
+    resets = []
+    for remaining in ['1', '0']:
+        assert api.user_timeline(1)
+        headers = api.last_response.headers
+        assert headers['x-rate-limit-limit'] == '2'
+        assert headers['x-rate-limit-remaining'] == remaining
+        resets.append(int(headers['x-rate-limit-reset']))
+    assert resets[0] == resets[1]
+
+    # the exhausted window is answered with 429 until it resets
+    # tweepy raises RateLimitError for the error code 88
+    with pytest.raises(RateLimitError):
+        api.user_timeline(1)
+    assert api.last_response.status_code == 429
+    assert api.last_response.headers['x-rate-limit-remaining'] == '0'
+    assert int(api.last_response.headers['x-rate-limit-reset']) == resets[0]
+    assert server.stats['rate_limited'] == 1
+
+    # every token has its own window
+    assert other.user_timeline(1)
+    assert other.last_response.headers['x-rate-limit-remaining'] == '1'
+    assert other.verify_credentials().screen_name == 'key_1'
@@ -0,0 +1,42 @@
+import os
+import sqlite3
+
+from .. import sentiment_analyzer
+
+
+def test_score_cache(tmpdir):
+    path = str(tmpdir.join('scores.db'))
+    tweet = u'what a great day \U0001f602'
+    score = sentiment_analyzer._compute_tweet_score(tweet)
+
+    cache = sentiment_analyzer.set_score_cache(size=1, path=path)
+    try:
+        assert sentiment_analyzer.get_tweet_score(tweet) == score
+        assert sentiment_analyzer.get_tweet_score(tweet) == score
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # evicted from memory, read back from disk by a new cache
+        cache = sentiment_analyzer.set_score_cache(size=1, path=path)
+        sentiment_analyzer.get_tweet_score('something else')
+        assert sentiment_analyzer.get_tweet_score(tweet) == score
+        assert cache.hits == 1
+
+        # the disk store is dropped when the emoticons file changes
+        connection = sqlite3.connect(path)
+        connection.execute("UPDATE meta SET value = 'stale'")
+        connection.commit()
+        cache = sentiment_analyzer.set_score_cache(size=1, path=path)
+        assert cache.get(os.urandom(20)) is None
+        assert sentiment_analyzer.get_tweet_score(tweet) == score
+        assert (cache.hits, cache.misses) == (0, 2)
+    finally:
+        sentiment_analyzer.set_score_cache()
+
+
+def test_tweet_scores():
+    texts = [u'what a great day \U0001f602', u'awful \U0001f620 \U0001f600',
+             u'just a tweet']
+    pos, neg, obj = sentiment_analyzer.get_tweet_scores(texts)
+
+    assert zip(pos, neg, obj) == \
+        [sentiment_analyzer._compute_tweet_score(text) for text in texts]
@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+
+from .. import sentiment_features
+from .. topic_index import UserTopicIndex
+
+
+@pytest.fixture(autouse=True)
+def topic_dicts(monkeypatch):
+    # the dicts and the index set by the tests are restored afterwards
+    for name in ['_USER_TOPIC_DICT', '_TOPIC_USER_DICT', '_INDEX']:
+        monkeypatch.setattr(sentiment_features, name,
+                            getattr(sentiment_features, name))
+
+
+def test_sentiment_features():
+    user_topic = {'1': {'a': (0.5, 0.1, 0.4, 1, 0, 0),
+                        'b': (0.1, 0.5, 0.4, 0, 1, 0),
+                        'c': (0.2, 0.2, 0.6, 0, 0, 1)},
+                  '2': {'a': (0.6, 0.1, 0.3, 1, 0, 0),
+                        'b': (0.5, 0.1, 0.4, 1, 0, 0),
+                        'c': (0.1, 0.1, 0.8, 0, 0, 1)},
+                  '3': {'d': (0.5, 0.1, 0.4, 1, 0, 0)}}
+    topic_user = {'a': ['1', '2', '4'], 'b': ['1', '2'], 'c': ['1', '2'],
+                  'd': ['3', '4']}
+    sentiment_features.set_user_topic_dict(user_topic)
+    sentiment_features.set_topic_user_dict(topic_user)
+
+    features = sentiment_features.get_sentiment_features([(1, 2), (1, 3)])
+
+    expected = {
+        'common': [3, 0],
+        'agreement': [sentiment_features.get_sentiment_agreement('1', '2'), 0],
+        'disagreement': [1, 0],
+        'alignment': [
+            sentiment_features.get_sentiment_alignment_coef('1', '2'), -1],
+        'misalignment': [
+            sentiment_features.get_sentiment_misalignment_coef('1', '2'), -1],
+        'rarest': [3, -1],
+        'adamic_adar': [
+            sentiment_features.get_sentiment_adamic_adar('1', '2'), 0],
+        'inverse': [sentiment_features.get_sentiment_inverse('1', '2'), 0],
+        'mean_size': [
+            sentiment_features.get_size_of_common_hashtags('1', '2'), -1]}
+    for name, values in expected.items():
+        assert np.allclose(features[name], values), name
+
+
+def test_metrics_from_index():
+    user_topic = {'1': {'a': (0.5, 0.1, 0.4, 1, 0, 0),
+                        'b': (0.1, 0.5, 0.4, 0, 1, 2)},
+                  '2': {'a': (0.6, 0.1, 0.3, 3, 0, 0),
+                        'b': (0.5, 0.1, 0.4, 1, 0, 0)}}
+    topic_user = {'a': ['1', '2', '4'], 'b': ['1', '2']}
+
+    def metrics():
+        return [sentiment_features.get_sentiment_agreement('1', '2'),
+                sentiment_features.get_sentiment_rarest('1', '2'),
+                sentiment_features.get_sentiment_inverse('1', '2'),
+                sentiment_features.svo_distance('1', 'b'),
+                sorted(sentiment_features.get_common_hashtags('1', '2'))]
+
+    sentiment_features.set_user_topic_dict(user_topic)
+    sentiment_features.set_topic_user_dict(topic_user)
+    expected = metrics()
+
+    sentiment_features.set_user_topic_index(
+        UserTopicIndex.from_dicts(user_topic, topic_user))
+    assert metrics() == expected
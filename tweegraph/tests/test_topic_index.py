@@ -0,0 +1,29 @@
+from ..topic_index import UserTopicIndex
+
+
+def test_save_and_load(tmpdir):
+    user_topic = {'12': {u'a': (0.5, 0.1, 0.4, 2, 0, 1),
+                         u'\u03b1\u03b2': (0.1, 0.5, 0.4, 0, 1, 0)},
+                  '3': {},
+                  '7': {u'a': (0.2, 0.2, 0.6, 0, 0, 1)}}
+    topic_user = {u'a': ['12', '7', '8'], u'\u03b1\u03b2': ['12']}
+    file_name = str(tmpdir.join('index.bin'))
+    UserTopicIndex.from_dicts(user_topic, topic_user).save(file_name)
+
+    index = UserTopicIndex.load(file_name)
+    assert sorted(index) == sorted(user_topic)
+    assert all(index[user] == topics for user, topics in user_topic.items())
+    assert list(index.rows([7, '12', 3])) == [1, 2, 0]
+    assert [index.total(user) for user in (3, 7, 12)] == [0, 1, 4]
+    assert index.adoption_of(u'a') == 3
+    assert [matrix.nnz for matrix in index.polarity_matrices()] == [1, 1, 1]
+    assert '5' not in index
+    assert sorted(index.hashtags(12)) == sorted(user_topic['12'])
+    assert index.entry('7', u'a') == user_topic['7'][u'a']
+    for user, hashtag in [('7', u'\u03b1\u03b2'), ('3', u'a'), ('7', u'x')]:
+        try:
+            index.entry(user, hashtag)
+        except KeyError:
+            pass
+        else:
+            assert False
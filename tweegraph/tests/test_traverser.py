@@ -0,0 +1,304 @@
+import os
+import json
+import Queue
+import logging
+from time import sleep, time
+from threading import Event, Thread
+
+from .. import traverser as traverser_module
+from .. api import create_api_instance
+from .. metrics import to_prometheus
+from .. mock_server import SyntheticTwitter
+from .. traverser import TwitterGraphTraverser
+
+
+def test_checkpoint_resume(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    traverser = TwitterGraphTraverser([1, 2], [], graph_size=100,
+                                      checkpoint_name=checkpoint,
+                                      checkpoint_interval=60, prefilter=True,
+                                      max_followers=1000, concurrency=3)
+    traverser.new_nodes.get()
+    traverser.explored_nodes[1] = {'followers': [3, 4], 'following': [5]}
+    traverser.nodes_count += 3
+    for node in [3, 4, 5]:
+        traverser.new_nodes.put(node)
+    # node 6 is being explored while the checkpoint is taken
+    traverser.explored_nodes[6] = {'followers': [], 'following': []}
+    traverser.in_progress.add(6)
+    traverser.checkpoint()
+
+    resumed = TwitterGraphTraverser.resume(checkpoint, [])
+    assert resumed.get_size() == 5
+    assert dict(resumed.explored_nodes) == {1: {'followers': [3, 4],
+                                                'following': [5]}}
+    assert sorted(resumed.new_nodes.queue) == [2, 3, 4, 5, 6]
+    assert resumed.graph_size == 100
+    assert resumed.checkpoint_interval == 60
+    assert resumed.prefilter and resumed.max_followers == 1000
+    assert resumed.concurrency == 3
+
+
+def test_periodic_checkpoints(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    traverser = TwitterGraphTraverser([1, 2], [], checkpoint_name=checkpoint,
+                                      checkpoint_interval=0.05)
+    calls = []
+    save = traverser.checkpoint
+
+    def checkpoint_once_failing():
+        calls.append(time())
+        if len(calls) == 1:
+            raise IOError('disk full')
+        save()
+
+    # a failed checkpoint is logged and the next ones are still taken
+    traverser.checkpoint = checkpoint_once_failing
+    traverser._start_services()
+    started = time()
+    while len(calls) < 3 and time() - started < 10:
+        sleep(0.05)
+    assert os.path.exists(checkpoint)
+
+    # stopping ends the periodic checkpoints
+    traverser.stopped.set()
+    sleep(0.2)
+    periodic = len(calls)
+    traverser.new_nodes.put(3)
+    # the crawl finishing takes a last checkpoint
+    traverser._finish()
+    assert traverser.finished.is_set()
+    assert len(calls) == periodic + 1
+    with open(checkpoint) as saved:
+        assert sorted(json.load(saved)['frontier']) == [1, 2, 3]
+
+
+def test_resume_from_log(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    log = tmpdir.join('relations.jsonl')
+    traverser = TwitterGraphTraverser([1], [], export_name=str(log),
+                                      export_mode='log',
+                                      checkpoint_name=checkpoint)
+    traverser.new_nodes.get()
+    traverser.explored_nodes[1] = {'followers': [2], 'following': []}
+    traverser.explored_nodes[7] = {'followers': [8], 'following': []}
+    traverser.new_nodes.put(2)
+    traverser.checkpoint()
+
+    # node 1 never reached the log, node 2 was explored after the checkpoint
+    log.write(json.dumps({'id': 2, 'followers': [], 'following': [3]}) +
+              '\n' + json.dumps({'id': 7, 'followers': [8],
+                                 'following': []}) + '\n')
+
+    resumed = TwitterGraphTraverser.resume(checkpoint, [])
+    assert sorted(resumed.explored_nodes) == [2, 7]
+    assert sorted(resumed.new_nodes.queue) == [1, 3]
+
+
+def test_compact_storage_export(tmpdir):
+    exports = []
+    for storage in ['dict', 'compact']:
+        export_name = str(tmpdir.join(storage + '.json'))
+        traverser = TwitterGraphTraverser([1], [], export_name=export_name,
+                                          storage=storage)
+        traverser.explored_nodes[1]['followers'] = [2, 3]
+        traverser.explored_nodes[1]['following'] = [2 ** 40]
+        traverser.explored_nodes[2]['followers'] = []
+        traverser.explored_nodes[2]['following'] = []
+        traverser.export_data()
+        with open(export_name) as exported:
+            exports.append(json.load(exported))
+
+    assert exports[0] == exports[1]
+
+
+def test_incremental_timelines_without_new_statuses(monkeypatch):
+    class API(object):
+        verified = 0
+
+        def user_timeline(self):
+            pass
+
+        def verify_credentials(self):
+            self.verified += 1
+            return True
+
+    # only every 50th user has new statuses, user 7 has no stored timeline
+    def request_data(query, user, since_id=None, **kwargs):
+        if user == 13:
+            return None
+        return [{'id': user * 10}] if user % 50 == 0 or user == 7 else []
+
+    monkeypatch.setattr(traverser_module, 'request_data', request_data)
+    monkeypatch.setattr(traverser_module, 'get_newest_tweet_id',
+                        lambda db_name, user, layout: user != 7 or None)
+
+    stored, merged = [], []
+    user_queue = Queue.Queue()
+    for user in range(1, 1001):
+        user_queue.put(user)
+    api = API()
+    traverser_module._retrieve_timelines(
+        'db', user_queue, api, logging.getLogger('test'), 10, None, True,
+        lambda db_name, user, timeline: stored.append(user),
+        lambda db_name, user, timeline: merged.append(user), 'collections')
+
+    assert api.verified == 0
+    assert stored == [7]
+    assert merged == range(50, 1001, 50)
+    assert user_queue.empty()
+
+
+def test_revoked_credentials_requeue_users(mock_server):
+    graph = SyntheticTwitter(users=40, edges=100, protected=0.1, suspended=0,
+                             tweets=20)
+    protected = [user for user in range(1, 41) if graph.protected[user]]
+    server = mock_server(graph, revoked=['key_0'])
+    logger = logging.getLogger('test')
+
+    stored, attempts, stranded = [], {}, []
+    user_queue = Queue.Queue()
+    for user in range(1, 41):
+        user_queue.put(user)
+
+    def worker(api):
+        traverser_module._retrieve_timelines(
+            'db', user_queue, api, logger, 3, None, False,
+            lambda db_name, user, timeline: stored.append(user), None,
+            'collections', 2, attempts, stranded)
+
+    revoked, valid = [create_api_instance(tokens)
+                      for tokens in server.credentials(2)]
+    assert not traverser_module._verify_credentials(revoked, logger)
+    assert traverser_module._verify_credentials(valid, logger)
+
+    # twitter rejects every request of the revoked worker, which returns the
+    # users it took to the queue
+    worker(revoked)
+    assert server.stats['revoked'] == 5
+    assert user_queue.qsize() == 40 and user_queue.unfinished_tasks == 40
+    assert not attempts
+
+    worker(valid)
+
+    assert protected
+    # protected timelines are requested max_retries + 1 times
+    assert sorted(stranded) == protected
+    assert all(attempts[user] == 3 for user in protected)
+    assert sorted(stored + stranded) == range(1, 41)
+    assert user_queue.unfinished_tasks == 0
+
+
+def test_enqueue_deduplication():
+    for seen_filter in ['set', 'bloom']:
+        traverser = TwitterGraphTraverser([1, 2, 1], [],
+                                          seen_filter=seen_filter,
+                                          bloom_capacity=1000)
+        for node in [2, 3, 3, 4, 1]:
+            traverser._enqueue(node)
+        assert list(traverser.new_nodes.queue) == [1, 2, 3, 4]
+
+
+def test_prefilter_nodes():
+    class User(object):
+        def __init__(self, id, followers, friends, protected=False):
+            self.id = id
+            self.followers_count = followers
+            self.friends_count = friends
+            self.protected = protected
+
+    class API(object):
+        def lookup_users(self, user_ids):
+            users = [User(1, 50, 10), User(2, 10, 10, protected=True),
+                     User(3, 10 ** 6, 10), User(4, 5, 5)]
+            return [user for user in users if user.id in user_ids]
+
+    traverser = TwitterGraphTraverser([1, 2, 3, 4, 5], [], prefilter=True,
+                                      max_followers=1000)
+    nodes = traverser._dequeue_nodes(100)
+    assert nodes == [1, 2, 3, 4, 5]
+
+    nodes = traverser._filter_nodes(nodes, API(), traverser.logger, None)
+    assert nodes == [4, 1]
+    assert sorted(traverser.explored_nodes) == [1, 4]
+    assert traverser.in_progress == set([1, 4])
+
+
+def test_metrics():
+    traverser = TwitterGraphTraverser([1, 2], [])
+    traverser.explored_nodes[1] = {'followers': [], 'following': []}
+    traverser._dequeue_nodes(2)
+
+    metrics = traverser.metrics()
+    assert metrics['dequeued'] == 2
+    assert metrics['duplicate_dequeue_ratio'] == 0.5
+    assert metrics['explored_nodes'] == 1
+    assert metrics['in_progress'] == 1
+
+    text = to_prometheus(metrics)
+    assert 'tweegraph_dequeued_total 2\n' in text
+    assert '# TYPE tweegraph_queue_depth gauge\n' in text
+    assert 'tweegraph_requests_total 0\n' in text
+    assert 'tweegraph_lock_wait_seconds_total ' in text
+    assert 'tweegraph_export_duration_last_seconds 0\n' in text
+
+
+def _crawl(server, tmpdir, test):
+    traverser = TwitterGraphTraverser([1, 2, 3], server.credentials(1),
+                                      graph_size=10 ** 9,
+                                      export_name=str(tmpdir.join('out.json')))
+    try:
+        test(traverser)
+    finally:
+        traverser.stop(10)
+    return traverser
+
+
+def test_wait_and_progress(tmpdir, mock_server):
+    graph = SyntheticTwitter(users=100, edges=400, protected=0, suspended=0)
+    progress = []
+
+    def fail(traverser):
+        raise ValueError('failing callback')
+
+    def test(traverser):
+        traverser.on_progress(
+            lambda crawler: progress.append(crawler.explored_count), every=10)
+        # failing callbacks are logged and do not stop the crawlers
+        traverser.on_progress(fail, every=5)
+        traverser.start()
+        # the crawl ends once the frontier is exhausted
+        assert traverser.wait(60)
+
+    server = mock_server(graph, window=2,
+                         limits={'/1.1/followers/ids.json': 1000,
+                                 '/1.1/friends/ids.json': 1000})
+    traverser = _crawl(server, tmpdir, test)
+    assert not traverser.in_progress
+    assert set(traverser.explored_nodes) == traverser.seen_nodes
+    assert progress == range(10, traverser.explored_count + 1, 10)
+
+
+def test_stop_interrupts_rate_limit_sleeps(tmpdir, mock_server):
+    graph = SyntheticTwitter(users=100, edges=400, protected=0, suspended=0)
+
+    def test(traverser):
+        traverser.start()
+        # the crawlers sleep for most of the hour long window
+        assert not traverser.wait(1)
+        started = time()
+        assert traverser.stop(10)
+        assert time() - started < 5
+
+    server = mock_server(graph, window=3600,
+                         limits={'/1.1/followers/ids.json': 3,
+                                 '/1.1/friends/ids.json': 3})
+    traverser = _crawl(server, tmpdir, test)
+    assert not any(worker.is_alive() for worker in traverser.workers)
+    # the nodes that were being explored are back in the frontier
+    assert not traverser.in_progress
+    assert set(traverser.new_nodes.queue) & set([1, 2, 3])
+    traverser.export_data()
+    with open(traverser.export_name) as exported:
+        assert all(int(node) not in traverser.new_nodes.queue
+                   for node in json.load(exported))
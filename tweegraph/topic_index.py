@@ -0,0 +1,244 @@
+"""array backed user-topic affiliation index that can be stored in a binary
+file and memory mapped
+"""
+
+import numpy as np
+from scipy import sparse
+
+from tweegraph.data import save_arrays, load_arrays
+from tweegraph.db import get_user_topic_affiliation_dict, get_topic_user_dict
+from tweegraph.sentiment_analyzer import determine_polarity
+
+
+class UserTopicIndex(object):
+    """
+    UserTopicIndex class. Holds the user topic affiliation dict and the
+    hashtag adoption of the topic user dict in flat arrays. Users and hashtags
+    are interned to integers: users are kept sorted by id and the entries of
+    every user (one per hashtag) are kept contiguous, as in a CSR matrix.
+    Polarities, per user totals and per hashtag adoption are precomputed. The
+    index can be saved to a binary file and memory mapped from it, so it does
+    not have to be rebuilt from the db.
+
+    Behaves as a read only dict{user_id: {topic: sentiment_score}} with str
+    user ids, like the dict returned by get_user_topic_affiliation_dict.
+
+    Parameters
+    ----------
+    arrays : dict of numpy arrays as built by from_dicts or read by load
+
+    Methods
+    -------
+    from_dicts        : builds the index from the affiliation dicts
+    from_db           : builds the index from timelines stored in MongoDB
+    save              : writes the index to a binary file
+    load              : reads or memory maps an index written by save
+    rows              : returns the rows of the given user ids
+    hashtag           : returns the integer id of a hashtag
+    hashtags          : returns the hashtags of a user
+    entry             : returns the scores and counts of a user for a hashtag
+    total             : returns the sum of the hashtag counts of a user
+    adoption_of       : returns the number of users that adopted a hashtag
+    polarity_matrices : returns sparse user x hashtag polarity indicators
+    """
+    def __init__(self, arrays):
+        self.users = arrays['users']
+        self.indptr = arrays['indptr']
+        self.entry_hashtags = arrays['entry_hashtags']
+        self.scores = arrays['scores']
+        self.counts = arrays['counts']
+        self.polarity = arrays['polarity']
+        self.totals = arrays['totals']
+        self.adoption = arrays['adoption']
+        self.hashtag_data = arrays['hashtag_data']
+        self.hashtag_offsets = arrays['hashtag_offsets']
+        self._hashtag_names = None
+        self._hashtag_ids = None
+        self._matrices = None
+
+    @classmethod
+    def from_dicts(cls, user_topic, topic_user=None):
+        """build the index from a user topic affiliation dict and a topic user
+        dict. If no topic user dict is given hashtag adoption is counted from
+        the user topic dict
+        """
+        names = sorted(set(topic for topics in user_topic.itervalues()
+                           for topic in topics))
+        hashtag_ids = dict((name, idx) for idx, name in enumerate(names))
+        users = sorted(user_topic, key=int)
+
+        indptr = np.zeros(len(users) + 1, dtype=np.int64)
+        entries = []
+        for row, user in enumerate(users):
+            topics = sorted(user_topic[user].iteritems(),
+                            key=lambda (topic, values): hashtag_ids[topic])
+            entries.extend(topics)
+            indptr[row + 1] = len(entries)
+
+        entry_hashtags = np.array([hashtag_ids[topic] for topic, _ in entries],
+                                  dtype=np.int32)
+        scores = np.array([values[:3] for _, values in entries],
+                          dtype=np.float64).reshape(-1, 3)
+        counts = np.array([values[3:6] for _, values in entries],
+                          dtype=np.int64).reshape(-1, 3)
+        polarity = np.array([determine_polarity(values[:3])
+                             for _, values in entries], dtype=np.int8)
+        entry_rows = np.repeat(np.arange(len(users)), np.diff(indptr))
+        totals = np.bincount(entry_rows, weights=counts.sum(axis=1),
+                             minlength=len(users))
+
+        if topic_user:
+            adoption = np.array([len(topic_user.get(name, ()))
+                                 for name in names], dtype=np.int64)
+        else:
+            adoption = np.bincount(entry_hashtags, minlength=len(names))
+
+        encoded = [name.encode('utf-8') for name in names]
+        hashtag_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        hashtag_offsets[1:] = np.cumsum([len(name) for name in encoded])
+        hashtag_data = np.frombuffer(''.join(encoded), dtype=np.uint8)
+
+        return cls({'users': np.array([int(user) for user in users],
+                                      dtype=np.int64),
+                    'indptr': indptr,
+                    'entry_hashtags': entry_hashtags,
+                    'scores': scores,
+                    'counts': counts,
+                    'polarity': polarity,
+                    'totals': totals.astype(np.int64),
+                    'adoption': adoption.astype(np.int64),
+                    'hashtag_data': hashtag_data,
+                    'hashtag_offsets': hashtag_offsets})
+
+    @classmethod
+    def from_db(cls, db_name, layout='collections', processes=None):
+        """build the index from the timelines stored in db_name
+        >>> help(tweegraph.db.get_user_topic_affiliation_dict)
+        """
+        return cls.from_dicts(
+            get_user_topic_affiliation_dict(db_name, layout, processes),
+            get_topic_user_dict(db_name, layout))
+
+    def save(self, file_name):
+        save_arrays(file_name, {'users': self.users,
+                                'indptr': self.indptr,
+                                'entry_hashtags': self.entry_hashtags,
+                                'scores': self.scores,
+                                'counts': self.counts,
+                                'polarity': self.polarity,
+                                'totals': self.totals,
+                                'adoption': self.adoption,
+                                'hashtag_data': self.hashtag_data,
+                                'hashtag_offsets': self.hashtag_offsets},
+                    meta={'type': 'user_topic_index'})
+
+    @classmethod
+    def load(cls, file_name, mmap=True):
+        """read an index written by save. With mmap the arrays are memory
+        mapped read only instead of read in memory
+        """
+        arrays, meta = load_arrays(file_name, mmap)
+        if not meta or meta.get('type') != 'user_topic_index':
+            raise ValueError('%s is not a user topic index' % file_name)
+        return cls(arrays)
+
+    @property
+    def hashtag_names(self):
+        if self._hashtag_names is None:
+            data = self.hashtag_data.tobytes()
+            offsets = self.hashtag_offsets
+            self._hashtag_names = [
+                data[offsets[idx]:offsets[idx + 1]].decode('utf-8')
+                for idx in range(len(offsets) - 1)]
+        return self._hashtag_names
+
+    def hashtag(self, name):
+        if self._hashtag_ids is None:
+            self._hashtag_ids = dict((hashtag, idx) for idx, hashtag
+                                     in enumerate(self.hashtag_names))
+        return self._hashtag_ids[name]
+
+    def rows(self, user_ids):
+        """returns an array with the row of each of the given user ids. Raises
+        KeyError for unknown users
+        """
+        user_ids = np.asarray(user_ids).astype(np.int64).reshape(-1)
+        rows = np.searchsorted(self.users, user_ids)
+        found = rows < len(self.users)
+        found[found] = self.users[rows[found]] == user_ids[found]
+        if not found.all():
+            raise KeyError(str(user_ids[~found][0]))
+        return rows
+
+    def _entries(self, user_id):
+        row = self.rows([user_id])[0]
+        return self.indptr[row], self.indptr[row + 1]
+
+    def hashtags(self, user_id):
+        """returns the hashtags of a user"""
+        start, end = self._entries(user_id)
+        names = self.hashtag_names
+        return [names[idx] for idx in self.entry_hashtags[start:end]]
+
+    def entry(self, user_id, hashtag):
+        """returns the scores and counts of a user for a hashtag, the same
+        tuple as index[user_id][hashtag] without building the dict of the
+        user. Raises KeyError if the user did not use the hashtag
+        """
+        start, end = self._entries(user_id)
+        idx = self.hashtag(hashtag)
+        # the entries of a user are sorted by hashtag
+        position = start + np.searchsorted(self.entry_hashtags[start:end], idx)
+        if position == end or self.entry_hashtags[position] != idx:
+            raise KeyError(hashtag)
+        return tuple(self.scores[position].tolist()) + \
+            tuple(self.counts[position].tolist())
+
+    def total(self, user_id):
+        return int(self.totals[self.rows([user_id])[0]])
+
+    def adoption_of(self, hashtag):
+        return int(self.adoption[self.hashtag(hashtag)])
+
+    def polarity_matrices(self):
+        """returns csr matrices of shape (users, hashtags) with ones where the
+        user expressed positive, negative and objective sentiment about the
+        hashtag
+        """
+        if self._matrices is None:
+            shape = (len(self.users), len(self.adoption))
+            polarity = np.asarray(self.polarity)
+            entry_rows = np.repeat(np.arange(len(self.users)),
+                                   np.diff(self.indptr))
+            matrices = []
+            for value in (1, -1, 0):
+                mask = polarity == value
+                indptr = np.zeros(len(self.users) + 1, dtype=np.int64)
+                indptr[1:] = np.cumsum(np.bincount(entry_rows[mask],
+                                                   minlength=len(self.users)))
+                matrices.append(sparse.csr_matrix(
+                    (np.ones(mask.sum(), dtype=np.float64),
+                     self.entry_hashtags[mask], indptr), shape=shape))
+            self._matrices = tuple(matrices)
+        return self._matrices
+
+    def __getitem__(self, user_id):
+        start, end = self._entries(user_id)
+        names = self.hashtag_names
+        return dict((names[self.entry_hashtags[idx]],
+                     tuple(self.scores[idx].tolist()) +
+                     tuple(self.counts[idx].tolist()))
+                    for idx in range(start, end))
+
+    def __contains__(self, user_id):
+        try:
+            self.rows([user_id])
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        return (str(user) for user in self.users)
+
+    def __len__(self):
+        return len(self.users)
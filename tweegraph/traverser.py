@@ -5,18 +5,28 @@ manner, starting from one or multiple nodes and / or twitter timelines
 # author: Prokopios Gryllos
 # gryllosprokopis@gmail.com
 
+import os
 import json
 import Queue
 import logging
 import numpy as np
-from time import sleep
+from time import time
 from collections import defaultdict
-from functools import wraps
+from functools import wraps, partial
 from datetime import date
 
-from threading import Thread, Lock as thread_lock
+from threading import Thread, Event, Lock as thread_lock
+from tweepy import TweepError
 from tweegraph.api import create_api_instance, request_data
-from tweegraph.db import store_timeline
+from tweegraph.api import RateLimitScheduler, lookup_users
+from tweegraph.bloom import BloomFilter
+from tweegraph.data import get_relations_from_log
+from tweegraph.db import store_timeline, merge_timeline, get_newest_tweet_id
+from tweegraph.db import TimelineWriter
+from tweegraph.metrics import start_metrics_server
+
+# error codes of invalid or expired tokens and of failed authentication
+_REVOKED_CODES = (89, 32)
 
 
 def log_wrap(log_name, console=False, log_file=False, file_name='log.txt'):
@@ -72,20 +82,167 @@ def api_caller(logger_name):
 
 
 @api_caller('collect_timelines.retriever')
-def get_and_store_timelines(db_name, user_list, api=None, logger=None):
-    """retrieve timelines and store in a MongoDB database
+def get_and_store_timelines(db_name, user_queue, api=None, logger=None,
+                            max_failures=10, scheduler=None,
+                            incremental=False, writer=None,
+                            layout='collections', max_retries=2,
+                            attempts=None, stranded=None):
+    """retrieve timelines and store in a MongoDB database. Users are pulled
+    from a queue shared among all workers so that workers that finish early
+    take over the remaining users. If the requests of max_failures
+    consecutive users fail the credentials are verified and, if they have
+    been revoked, the failed users are put back in the queue for the other
+    workers. Otherwise, and whenever a request of the worker succeeds, users
+    whose request failed are put back in the queue up to max_retries times
+    and then appended to stranded. attempts, a dict{user: failed attempts},
+    and stranded are shared among the workers of a crawl. Workers therefore
+    exit only once every user has been handled.
+    Workers that use the same token share its scheduler. In incremental mode
+    only statuses newer than the newest stored one are requested and merged
+    into the stored timeline. When a TimelineWriter is given timelines are
+    written by it in the background, using the layout of the writer.
     """
-    for user in user_list:
-        timeline = request_data(api.user_timeline, user, logger=logger)
-        store_timeline(db_name, user, timeline)
-        sleep(5)
+    if not _verify_credentials(api, logger):
+        logger.warning('invalid credentials. terminating')
+        return
+
+    if scheduler:
+        scheduler = scheduler.share(api)
+    else:
+        scheduler = RateLimitScheduler(api)
+
+    if writer:
+        layout = writer.layout
+        store, merge = writer.store_timeline, writer.merge_timeline
+    else:
+        store = partial(store_timeline, layout=layout)
+        merge = partial(merge_timeline, layout=layout)
+    try:
+        _retrieve_timelines(db_name, user_queue, api, logger, max_failures,
+                            scheduler, incremental, store, merge, layout,
+                            max_retries, attempts, stranded)
+    finally:
+        if writer:
+            writer.flush()
+
+
+def _verify_credentials(api, logger):
+    """returns False only if twitter reports that the credentials are not
+    valid. Other errors, e.g. a rate limited verify_credentials or a dropped
+    connection, are logged and the credentials are assumed to be valid
+    """
+    try:
+        return bool(api.verify_credentials())
+    except TweepError as e:
+        # tweepy raises instead of returning False for rejected credentials
+        response = getattr(e, 'response', None)
+        if getattr(e, 'api_code', None) in _REVOKED_CODES or \
+                (response is not None and response.status_code == 401):
+            return False
+        logger.warning('could not verify credentials: %s' % e)
+        return True
+
+
+def _all_tasks_done(queue):
+    queue.all_tasks_done.acquire()
+    try:
+        return not queue.unfinished_tasks
+    finally:
+        queue.all_tasks_done.release()
+
+
+def _retry_users(users, user_queue, attempts, max_retries, stranded):
+    """put users whose request failed back in the queue, or in stranded once
+    they have failed max_retries + 1 times. Users are put back before they
+    are marked as done so that the queue never looks finished in between
+    """
+    for user in users:
+        attempts[user] = attempts.get(user, 0) + 1
+        if attempts[user] > max_retries:
+            stranded.append(user)
+        else:
+            user_queue.put(user)
+        user_queue.task_done()
+
 
+def _retrieve_timelines(db_name, user_queue, api, logger, max_failures,
+                        scheduler, incremental, store, merge, layout,
+                        max_retries=2, attempts=None, stranded=None):
+    """worker loop of get_and_store_timelines"""
+    attempts = {} if attempts is None else attempts
+    stranded = [] if stranded is None else stranded
+    # users whose request failed are not marked as done until it is decided
+    # whether they are retried
+    failed = []
+    try:
+        while True:
+            try:
+                user = user_queue.get(True, 1)
+            except Queue.Empty:
+                if failed:
+                    _retry_users(failed, user_queue, attempts, max_retries,
+                                 stranded)
+                    failed = []
+                    continue
+                # users of a worker whose credentials are revoked are put
+                # back in the queue, so wait while other workers still
+                # handle users
+                if _all_tasks_done(user_queue):
+                    logger.info('terminating')
+                    return
+                continue
+
+            try:
+                since_id = None
+                if incremental:
+                    since_id = get_newest_tweet_id(db_name, user, layout)
+                timeline = request_data(api.user_timeline, user,
+                                        logger=logger, scheduler=scheduler,
+                                        since_id=since_id, strict=True)
+            except Exception:
+                user_queue.task_done()
+                raise
+
+            # an empty timeline, e.g. of a user without new statuses, is not
+            # a failure. Only failed requests count
+            if timeline is None:
+                failed.append(user)
+                if len(failed) < max_failures:
+                    continue
+                if not _verify_credentials(api, logger):
+                    logger.warning('credentials revoked. returning %d users '
+                                   'to the queue' % len(failed))
+                    return
+                _retry_users(failed, user_queue, attempts, max_retries,
+                             stranded)
+                failed = []
+                continue
 
-def crawl_timelines(db_name, user_list, credentials):
+            try:
+                if timeline and since_id:
+                    merge(db_name, user, timeline)
+                elif timeline:
+                    store(db_name, user, timeline)
+            finally:
+                user_queue.task_done()
+            # the credentials work, so the failures were caused by the users
+            _retry_users(failed, user_queue, attempts, max_retries, stranded)
+            failed = []
+    finally:
+        # users still held, e.g. by a revoked worker, go back to the queue
+        for user in failed:
+            user_queue.put(user)
+            user_queue.task_done()
+
+
+def crawl_timelines(db_name, user_list, credentials, concurrency=1,
+                    incremental=False, layout='collections', wait=False,
+                    max_retries=2):
     """Crawl timelines of the users specified in the user_list and store them
     in MongoDB under db -> db_name[user_id]. Timelines are stored as a list
     under the key 'content' in each user's collection. The method takes
-    advantage of multiple api keys, if provided.
+    advantage of multiple api keys, if provided. All workers pull users from
+    a shared queue, so the crawl is not bound by the slowest key.
 
     Parameters
     ----------
@@ -94,19 +251,123 @@ def crawl_timelines(db_name, user_list, credentials):
     credentials : dictionary which values are the api tokens that are provided
         from twitter when registering an app at apps.twitter
         >>> help(tweegraph.api.create_api_instance)
+    concurrency : number of workers per api key. Workers of the same key
+        share its rate limit budget. Defaults to 1
+    incremental : set to True to refresh already stored timelines, requesting
+        only statuses newer than the newest stored one (since_id). Users
+        without a stored timeline are collected in full. Defaults to False
+    layout      : 'collections' stores a collection per user, 'single' stores
+        every status as a document of db -> db_name['timelines'], indexed by
+        user and hashtag. Defaults to 'collections'
+        >>> help(tweegraph.db.store_timeline)
+    wait        : set to True to block until the workers have exited.
+        Defaults to False
+    max_retries : number of times the timeline of a user is requested again
+        after a failed request. Defaults to 2
+
+    Returns
+    -------
+    stranded : when wait is set, the users that could not be crawled, because
+        their requests failed more than max_retries times, their timelines
+        could not be stored or the credentials of every worker were revoked,
+        otherwise None
     """
     logger = log_wrap('collect_timelines', console=True)
 
-    chunk = int(len(user_list) / len(credentials))
-    # spawn a crawler for each of the equally divided pieces of the user list
-    for idx, tokens in enumerate(credentials[:-1]):
-        nodes = user_list[idx * chunk: chunk * (idx+1)]
-        Thread(target=get_and_store_timelines,
-               args=(db_name, nodes), kwargs={'api': tokens}).start()
+    writer = TimelineWriter(layout=layout)
+    user_queue = Queue.Queue()
+    for user in user_list:
+        user_queue.put(user)
+    attempts, stranded = {}, []
+
+    # spawn crawlers for each api key. crawlers share the same queue
+    workers = []
+    for tokens in credentials:
+        scheduler = RateLimitScheduler()
+        for _ in range(concurrency):
+            worker = Thread(target=get_and_store_timelines,
+                            args=(db_name, user_queue),
+                            kwargs={'api': tokens, 'scheduler': scheduler,
+                                    'incremental': incremental,
+                                    'writer': writer,
+                                    'max_retries': max_retries,
+                                    'attempts': attempts,
+                                    'stranded': stranded})
+            workers.append(worker)
+            worker.start()
+
+    if not wait:
+        return None
+    for worker in workers:
+        # joining in steps keeps the main thread responsive to ctrl-c
+        while worker.is_alive():
+            worker.join(1)
+
+    # the workers flush the writer before exiting
+    stranded.extend(writer.failed)
+    while True:
+        try:
+            stranded.append(user_queue.get(False))
+        except Queue.Empty:
+            break
+    if stranded:
+        logger.warning('%d users could not be crawled' % len(stranded))
+    return stranded
+
+
+class NodeRelations(object):
+    """
+    compact storage for the relations of an explored node. Followers and
+    following ids are kept in int64 arrays instead of lists of python ints.
+    Supports item access with the keys 'followers' and 'following' so that it
+    can be used in place of the relations dict of a node.
+    """
+    __slots__ = ('followers', 'following')
+
+    def __init__(self, followers=(), following=()):
+        self.followers = np.asarray(followers, dtype=np.int64)
+        self.following = np.asarray(following, dtype=np.int64)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, ids):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, np.asarray(ids, dtype=np.int64))
+
+    def to_dict(self):
+        return {'followers': self.followers.tolist(),
+                'following': self.following.tolist()}
+
 
-    nodes = user_list[(idx+1) * chunk:]
-    Thread(target=get_and_store_timelines,
-           args=(db_name, nodes), kwargs={'api': credentials[-1]}).start()
+class TimedLock(object):
+    """
+    lock that records the total time spent waiting to acquire it
+    """
+    def __init__(self):
+        self.lock = thread_lock()
+        self.wait_time = 0
+
+    def acquire(self):
+        started = time()
+        self.lock.acquire()
+        # updated while holding the lock
+        self.wait_time += time() - started
+
+    def release(self):
+        self.lock.release()
+
+
+def _to_json(obj):
+    """json serialization of compact relations"""
+    if isinstance(obj, NodeRelations):
+        return obj.to_dict()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
 
 
 class TwitterGraphTraverser(object):
@@ -135,109 +396,621 @@ class TwitterGraphTraverser(object):
 
     traverse    : bool
         set to false to limit crawling the specified list of user ids
+
+    export_mode : 'json' or 'log'
+        with 'json' export_data dumps all the collected relations in a single
+        json file. With 'log' the relations of every explored node are
+        appended, as soon as the node is explored, to a log file with one json
+        record per line by a background writer. The log can be read back with
+        tweegraph.data.get_relations_from_log. Defaults to 'json'
+
+    checkpoint_name     : file used for checkpoints. Defaults to the export
+        name followed by '_checkpoint'
+
+    checkpoint_interval : seconds between two periodic checkpoints. When set
+        to None no periodic checkpoints are taken. Defaults to None
+
+    storage     : 'dict' or 'compact'
+        with 'compact' the relations of each explored node are stored in
+        int64 arrays (NodeRelations) instead of lists of python ints, which
+        reduces memory per edge. The exported data is the same in both
+        cases. Defaults to 'dict'
+
+    seen_filter : 'set' or 'bloom'
+        nodes are added to the frontier only the first time they are seen.
+        With 'set' seen nodes are kept in a python set. With 'bloom' a Bloom
+        filter of bounded memory is used instead, at the cost of skipping a
+        bloom_error_rate fraction of unseen nodes. Defaults to 'set'
+
+    bloom_capacity   : expected number of unique nodes when seen_filter is
+        'bloom'. Defaults to 10 ** 7
+
+    bloom_error_rate : false positive rate of the Bloom filter at capacity.
+        Defaults to 0.001
+
+    prefilter   : bool
+        set to True to resolve frontier nodes in batches of up to 100 with
+        users/lookup before spending followers/ids and friends/ids calls on
+        them. Protected, deleted and suspended accounts are dropped, as well
+        as nodes above max_followers / max_following, and the rest of each
+        batch is explored starting from the nodes with the fewest relations.
+        Defaults to False
+
+    max_followers : skip nodes with more followers when prefilter is set.
+        Defaults to None (no limit)
+
+    max_following : skip nodes that follow more users when prefilter is set.
+        Defaults to None (no limit)
+
+    concurrency : number of crawlers per api key. Crawlers of the same key
+        have their own api instance but share the key's rate limit budget,
+        so up to concurrency requests per key can be in flight. Defaults to 1
+
+    metrics_port : when set, start serves the metrics of the crawler in the
+        Prometheus text format at http://127.0.0.1:<metrics_port>/metrics.
+        Defaults to None
     Methods
     -------
     export_data : saves the current crawled data in json format
+    metrics     : returns the metrics of the running crawler
+    checkpoint  : atomically saves the frontier, explored nodes and counters
+    resume      : creates a traverser from a checkpoint (classmethod)
     get_size    : returns the number of collected nodes
+    on_progress : registers a callback called every n explored nodes
     start       : initiates crawling
+    wait        : waits, up to a timeout, for the crawling to finish
+    join        : waits for the crawling to finish
+    stop        : stops crawling
     """
     logger = log_wrap(log_name='twitter_traverser', console=True)
 
     def __init__(self, starting_ids, credentials, graph_size=None,
                  directions=['followers', 'following'], breadth=None,
-                 traverse=True, export_name=None):
+                 traverse=True, export_name=None, export_mode='json',
+                 checkpoint_name=None, checkpoint_interval=None,
+                 storage='dict', seen_filter='set', bloom_capacity=10 ** 7,
+                 bloom_error_rate=0.001, prefilter=False, max_followers=None,
+                 max_following=None, concurrency=1, metrics_port=None):
         self.breadth = breadth
         self.traverse = traverse
         self.graph_size = graph_size
         self.nodes_count = len(starting_ids)
         self.directions = directions
-        self.explored_nodes = defaultdict(dict)
+        self.storage = storage
+        if storage == 'compact':
+            self.explored_nodes = defaultdict(NodeRelations)
+        else:
+            self.explored_nodes = defaultdict(dict)
         self.new_nodes = Queue.Queue()
         self.credentials = credentials
-        self.explored_lock = thread_lock()
+        self.explored_lock = TimedLock()
         self.count_lock = thread_lock()
+        self.checkpoint_lock = thread_lock()
+        self.export_mode = export_mode
+        self.export_queue = Queue.Queue()
+        self.in_progress = set()
+        self.seed_count = len(starting_ids)
+        self.checkpoint_interval = checkpoint_interval
+        self.seen_filter = seen_filter
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.prefilter = prefilter
+        self.max_followers = max_followers
+        self.max_following = max_following
+        self.concurrency = concurrency
+        self.schedulers = []
+        self.workers = []
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.started = None
+        self.dequeued = 0
+        self.duplicate_dequeues = 0
+        self.exports = 0
+        self.export_duration_total = 0
+        self.export_duration_last = 0
+        self.explored_count = 0
+        self.progress_callbacks = []
+        self.callback_lock = thread_lock()
+        self.active_workers = 0
+        self.stopped = Event()
+        self.finished = Event()
+        if seen_filter == 'bloom':
+            self.seen_nodes = BloomFilter(bloom_capacity, bloom_error_rate)
+        else:
+            self.seen_nodes = set()
 
         for node in starting_ids:
-            self.new_nodes.put(node)
+            self._enqueue(node)
 
         if not export_name:
             export_name = date.today().strftime("%Y-%m-%d")
-            self.export_name = export_name + '_twitter_relations.json'
+            if export_mode == 'log':
+                self.export_name = export_name + '_twitter_relations.jsonl'
+            else:
+                self.export_name = export_name + '_twitter_relations.json'
         else:
             self.export_name = export_name
 
-    @api_caller(logger.name + '.graph_explorer')
-    def _explore_graph(self, api=None, logger=None):
+        if not checkpoint_name:
+            self.checkpoint_name = self.export_name + '_checkpoint'
+        else:
+            self.checkpoint_name = checkpoint_name
 
-        while True:
-            explore = True
-            followers = []
-            following = []
+    def _enqueue(self, node):
+        """
+        add node to the frontier if it has not been seen before. Must be
+        called while holding explored_lock once crawling has started
+        """
+        if node not in self.seen_nodes:
+            self.seen_nodes.add(node)
+            self.new_nodes.put(node)
 
-            if self.traverse and self.get_size() > self.graph_size or \
-                    not self.traverse and self.new_nodes.empty():
-                logger.info('terminating')
-                return
+    def _dequeue_nodes(self, count=1):
+        """
+        take up to count unexplored nodes from the frontier and mark them as
+        being explored. Nodes are dequeued and marked under the same lock so
+        that checkpoints never miss a node that is being explored
+        """
+        nodes = []
+        self.explored_lock.acquire()
+        try:
+            while len(nodes) < count:
+                try:
+                    node = self.new_nodes.get(False)
+                except Queue.Empty:
+                    break
+                self.new_nodes.task_done()
+                self.dequeued += 1
+
+                # check if node is already explored
+                if node in self.explored_nodes:
+                    self.duplicate_dequeues += 1
+                    continue
+                self.explored_nodes[node]['followers'] = []
+                self.explored_nodes[node]['following'] = []
+                self.in_progress.add(node)
+                nodes.append(node)
+        finally:
+            self.explored_lock.release()
+
+        return nodes
+
+    def _filter_nodes(self, nodes, api, logger, scheduler):
+        """
+        look up the nodes and drop the protected, deleted, suspended and too
+        popular ones. Returns the remaining nodes ordered by the number of
+        relations that are going to be requested
+        """
+        users = lookup_users(api, nodes, logger, scheduler)
+        return self._select_nodes(nodes, users, logger)
+
+    def _select_nodes(self, nodes, users, logger):
+        """
+        drop the nodes that filter_nodes drops, given the looked up users.
+        When the lookup failed (users is None) all nodes are kept
+        """
+        if users is None:
+            return nodes
+
+        def degree(user):
+            count = 0
+            if 'followers' in self.directions:
+                count += user.followers_count
+            if 'following' in self.directions:
+                count += user.friends_count
+            return count
 
-            node = self.new_nodes.get(True)
-            self.new_nodes.task_done()
+        keep = []
+        for node in nodes:
+            user = users.get(node)
+            if user is None or user.protected:
+                continue
+            if self.max_followers is not None and \
+                    user.followers_count > self.max_followers:
+                continue
+            if self.max_following is not None and \
+                    user.friends_count > self.max_following:
+                continue
+            keep.append(node)
 
-            # check if node is already explored
+        dropped = set(nodes) - set(keep)
+        if dropped:
+            logger.info('dropping %d of %d nodes' % (len(dropped), len(nodes)))
             self.explored_lock.acquire()
             try:
-                if node in self.explored_nodes:
-                    explore = False
-                else:
-                    self.explored_nodes[node]['followers'] = []
-                    self.explored_nodes[node]['following'] = []
+                for node in dropped:
+                    del self.explored_nodes[node]
+                    self.in_progress.discard(node)
             finally:
                 self.explored_lock.release()
 
-            if not explore:
-                continue
+        keep.sort(key=lambda node: degree(users[node]))
+        return keep
+
+    @api_caller(logger.name + '.graph_explorer')
+    def _explore_graph(self, api=None, logger=None, schedulers=None):
+        # followers/ids and friends/ids have separate rate limit windows
+        if schedulers:
+            followers_scheduler = schedulers['followers'].share(api)
+            following_scheduler = schedulers['following'].share(api)
+            lookup_scheduler = schedulers['lookup'].share(api)
+        else:
+            followers_scheduler = RateLimitScheduler(api)
+            following_scheduler = RateLimitScheduler(api)
+            lookup_scheduler = RateLimitScheduler(api)
+
+        pending = []
+        while True:
+            followers = []
+            following = []
+
+            if self.stopped.is_set() or \
+                    self.traverse and self.get_size() > self.graph_size or \
+                    not pending and self._is_exhausted():
+                self._release_nodes(pending)
+                logger.info('terminating')
+                return
+
+            if not pending:
+                pending = self._dequeue_nodes(100 if self.prefilter else 1)
+                if not pending:
+                    self.stopped.wait(1)
+                    continue
+                if self.prefilter:
+                    pending = self._filter_nodes(pending, api, logger,
+                                                 lookup_scheduler)
+                    continue
+            node = pending.pop(0)
 
             # retrieve x followers of the node. x = breadth
             if 'followers' in self.directions:
                 followers = request_data(api.followers_ids, node,
-                                         self.breadth, logger)
+                                         self.breadth, logger,
+                                         followers_scheduler)
 
             # retrieve x friends of the node. x = breadth
             if 'following' in self.directions:
                 following = request_data(api.friends_ids, node,
-                                         self.breadth, logger)
+                                         self.breadth, logger,
+                                         following_scheduler)
+
+            # relations of a stopped worker may be partial. The node goes
+            # back to the frontier with the rest of the pending nodes
+            if self.stopped.is_set():
+                pending.insert(0, node)
+                continue
+            self._record_relations(node, followers, following)
 
+    def _release_nodes(self, nodes):
+        """
+        put nodes that were dequeued but not explored back in the frontier
+        and drop their empty relations
+        """
+        if not nodes:
+            return
+        self.explored_lock.acquire()
+        try:
+            for node in nodes:
+                if node in self.in_progress:
+                    self.in_progress.discard(node)
+                    del self.explored_nodes[node]
+                    self.new_nodes.put(node)
+        finally:
+            self.explored_lock.release()
+
+    def _is_exhausted(self):
+        """
+        True when the frontier is empty and, unless traverse is False, no
+        node is being explored that could add new nodes to it
+        """
+        self.explored_lock.acquire()
+        try:
+            return self.new_nodes.empty() and \
+                (not self.traverse or not self.in_progress)
+        finally:
+            self.explored_lock.release()
+
+    def _record_relations(self, node, followers, following, notify=True):
+        """
+        store the relations of an explored node and add its neighbors to the
+        frontier. Relations, frontier and counters are updated under the same
+        lock so that checkpoints always see a consistent state. Returns the
+        number of explored nodes. Set notify to False to call the progress
+        callbacks later with _notify_progress, e.g. after releasing a lock
+        """
+        self.explored_lock.acquire()
+        try:
             if self.traverse:
                 for follower in followers:
-                    self.new_nodes.put(follower)
+                    self._enqueue(follower)
                 for friend in following:
-                    self.new_nodes.put(friend)
-            sleep(5)
+                    self._enqueue(friend)
 
-            # lock used for thread safety with export_data method
-            self.explored_lock.acquire()
-            try:
-                self.explored_nodes[node]['followers'] = followers
-                self.explored_nodes[node]['following'] = following
-            finally:
-                self.explored_lock.release()
+            self.explored_nodes[node]['followers'] = followers
+            self.explored_nodes[node]['following'] = following
+            self.in_progress.discard(node)
 
             self.count_lock.acquire()
             try:
                 self.nodes_count += len(followers) + len(following)
             finally:
                 self.count_lock.release()
+            self.explored_count += 1
+            explored_count = self.explored_count
+        finally:
+            self.explored_lock.release()
+
+        if self.export_mode == 'log':
+            self.export_queue.put((node, followers, following))
+
+        if notify:
+            self._notify_progress(explored_count)
+        return explored_count
+
+    def on_progress(self, callback, every=1000):
+        """
+        call callback(traverser) every time another `every` nodes have been
+        explored, e.g. for exporting the data as it grows. Callbacks run in
+        the crawler thread that explored the node
+        """
+        self.callback_lock.acquire()
+        try:
+            self.progress_callbacks.append(
+                [callback, every, self.explored_count + every])
+        finally:
+            self.callback_lock.release()
+
+    def _notify_progress(self, explored_count):
+        due = []
+        self.callback_lock.acquire()
+        try:
+            for entry in self.progress_callbacks:
+                callback, every, threshold = entry
+                if explored_count >= threshold:
+                    entry[2] = explored_count - explored_count % every + every
+                    due.append(callback)
+        finally:
+            self.callback_lock.release()
+
+        # a failing callback must not terminate the crawler that called it
+        for callback in due:
+            try:
+                callback(self)
+            except Exception:
+                self.logger.exception('progress callback %r failed' %
+                                      callback)
+
+    def _write_log(self):
+        """
+        append the relations of every explored node to the export log
+        """
+        with open(self.export_name, 'a') as log:
+            while True:
+                node, followers, following = self.export_queue.get(True)
+                try:
+                    log.write(json.dumps({'id': node,
+                                          'followers': followers,
+                                          'following': following}) + '\n')
+                    if self.export_queue.empty():
+                        log.flush()
+                finally:
+                    self.export_queue.task_done()
 
     def export_data(self):
         """
-        save relations in json format
+        save relations in json format. Nodes that are being explored are
+        left out. In 'log' export mode relations are written continuously
+        and the method only waits for the pending records to be written
+        """
+        started = time()
+        if self.export_mode == 'log':
+            self.export_queue.join()
+        else:
+            # nodes that are being explored have no relations yet. The
+            # relations of explored nodes are not modified any more, so they
+            # are written without holding the lock
+            self.explored_lock.acquire()
+            try:
+                explored = dict((node, relations) for node, relations
+                                in self.explored_nodes.iteritems()
+                                if node not in self.in_progress)
+            finally:
+                self.explored_lock.release()
+            with open(self.export_name, 'w') as exported_data:
+                json.dump(explored, exported_data, default=_to_json)
+
+        self.exports += 1
+        self.export_duration_last = time() - started
+        self.export_duration_total += self.export_duration_last
+
+    def metrics(self):
+        """
+        return a dict with the metrics of the crawler: total and per token
+        requests and rate limit sleep time, queue depth, explored nodes,
+        duplicate dequeues, lock wait time and export durations. Times are
+        in seconds
         """
+        elapsed = time() - self.started if self.started else 0
         self.explored_lock.acquire()
         try:
-            with open(self.export_name, 'w') as exported_data:
-                json.dump(self.explored_nodes, exported_data)
+            explored = len(self.explored_nodes) - len(self.in_progress)
+            in_progress = len(self.in_progress)
+            dequeued = self.dequeued
+            duplicates = self.duplicate_dequeues
         finally:
             self.explored_lock.release()
 
+        tokens = []
+        for schedulers in self.schedulers:
+            endpoints = {}
+            for endpoint, scheduler in schedulers.items():
+                endpoints[endpoint] = {'requests': scheduler.requests,
+                                       'sleep_time': scheduler.sleep_time}
+            requests = sum(value['requests'] for value in endpoints.values())
+            tokens.append({
+                'requests': requests,
+                'sleep_time': sum(value['sleep_time']
+                                  for value in endpoints.values()),
+                'endpoints': endpoints})
+
+        return {'elapsed': elapsed,
+                'queue_depth': self.new_nodes.qsize(),
+                'explored_nodes': explored,
+                'in_progress': in_progress,
+                'collected_size': self.get_size(),
+                'dequeued': dequeued,
+                'duplicate_dequeues': duplicates,
+                'duplicate_dequeue_ratio':
+                    duplicates / float(dequeued) if dequeued else 0.0,
+                'lock_wait_time': self.explored_lock.wait_time,
+                'exports': self.exports,
+                'export_duration_total': self.export_duration_total,
+                'export_duration_last': self.export_duration_last,
+                'requests': sum(token['requests'] for token in tokens),
+                'tokens': tokens}
+
+    def checkpoint(self):
+        """
+        atomically save the frontier, the explored nodes and the counters so
+        that crawling can be continued with resume. Nodes that are being
+        explored are saved as part of the frontier
+        """
+        # the state is copied under the lock and written without it, so that
+        # crawlers are not blocked while it is serialized. The relations of
+        # explored nodes are not modified any more and are not copied
+        self.explored_lock.acquire()
+        try:
+            self.new_nodes.mutex.acquire()
+            try:
+                frontier = list(self.in_progress) + list(self.new_nodes.queue)
+            finally:
+                self.new_nodes.mutex.release()
+
+            explored = [node for node in self.explored_nodes
+                        if node not in self.in_progress]
+            if self.export_mode != 'log':
+                explored = {node: self.explored_nodes[node]
+                            for node in explored}
+            nodes_count = self.get_size()
+        finally:
+            self.explored_lock.release()
+
+        self.checkpoint_lock.acquire()
+        try:
+            state = {'frontier': frontier,
+                     'explored': explored,
+                     'nodes_count': nodes_count,
+                     'seed_count': self.seed_count,
+                     'config': self._config()}
+
+            # write to a temporary file and rename for atomicity
+            with open(self.checkpoint_name + '.tmp', 'w') as checkpoint:
+                json.dump(state, checkpoint, default=_to_json)
+            os.rename(self.checkpoint_name + '.tmp', self.checkpoint_name)
+        finally:
+            self.checkpoint_lock.release()
+
+    def _config(self):
+        """
+        return the constructor options, apart from the starting ids and the
+        credentials, that are saved by checkpoint and restored by resume
+        """
+        return {'graph_size': self.graph_size,
+                'directions': self.directions,
+                'breadth': self.breadth,
+                'traverse': self.traverse,
+                'export_name': self.export_name,
+                'export_mode': self.export_mode,
+                'checkpoint_interval': self.checkpoint_interval,
+                'storage': self.storage,
+                'seen_filter': self.seen_filter,
+                'bloom_capacity': self.bloom_capacity,
+                'bloom_error_rate': self.bloom_error_rate,
+                'prefilter': self.prefilter,
+                'max_followers': self.max_followers,
+                'max_following': self.max_following,
+                'concurrency': self.concurrency,
+                'metrics_port': self.metrics_port}
+
+    def _try_checkpoint(self):
+        """
+        take a checkpoint, logging errors instead of raising them
+        """
+        try:
+            self.checkpoint()
+        except Exception:
+            self.logger.exception('checkpoint %s failed' %
+                                  self.checkpoint_name)
+
+    def _checkpoint_periodically(self):
+        """
+        take a checkpoint every checkpoint_interval seconds until crawling
+        has finished or has been stopped. The last checkpoint is taken by
+        _finish, once the crawlers have put their nodes back in the frontier
+        """
+        while not self.stopped.wait(self.checkpoint_interval):
+            if self.finished.is_set():
+                return
+            self._try_checkpoint()
+
+    def _finish(self):
+        """
+        take a last checkpoint, if checkpoints are enabled, and mark the
+        crawling finished
+        """
+        if self.checkpoint_interval:
+            self._try_checkpoint()
+        self.finished.set()
+
+    @classmethod
+    def resume(cls, checkpoint, credentials, **kwargs):
+        """
+        create a traverser that continues crawling from the state saved in
+        the checkpoint file. Keyword arguments override the configuration
+        saved in the checkpoint. In 'log' export mode the relations are
+        reloaded from the export log; nodes found in the log after the
+        checkpoint are not explored again and nodes missing from the log are
+        put back in the frontier
+        """
+        with open(checkpoint) as checkpoint_file:
+            state = json.load(checkpoint_file)
+
+        config = state['config']
+        config.update(kwargs)
+        config.setdefault('checkpoint_name', checkpoint)
+        traverser = cls(starting_ids=[], credentials=credentials, **config)
+
+        frontier = state['frontier']
+        if traverser.export_mode == 'log':
+            relations = {}
+            if os.path.exists(traverser.export_name):
+                relations = get_relations_from_log(traverser.export_name)
+            explored = set(state['explored'])
+            for node in relations:
+                if int(node) not in explored and traverser.traverse:
+                    frontier.extend(relations[node]['followers'])
+                    frontier.extend(relations[node]['following'])
+            frontier.extend(node for node in explored
+                            if str(node) not in relations)
+        else:
+            relations = state['explored']
+
+        traverser.nodes_count = state['seed_count']
+        traverser.seed_count = state['seed_count']
+        for node, value in relations.items():
+            traverser.explored_nodes[int(node)]['followers'] = \
+                value['followers']
+            traverser.explored_nodes[int(node)]['following'] = \
+                value['following']
+            traverser.seen_nodes.add(int(node))
+            traverser.nodes_count += len(value['followers']) + \
+                len(value['following'])
+
+        for node in frontier:
+            traverser._enqueue(node)
+
+        return traverser
+
     def get_size(self):
         """
         return the number of collected nodes
@@ -252,6 +1025,89 @@ class TwitterGraphTraverser(object):
         """
         initiate graph traversing
         """
-        # start as many crawlers as api keys
+        self._start_services()
+
+        # start concurrency crawlers per api key. Their sleeps are cut short
+        # by stop
+        self.active_workers = len(self.credentials) * self.concurrency
+        if not self.active_workers:
+            self.finished.set()
         for tokens in self.credentials:
-            Thread(target=self._explore_graph, kwargs={'api': tokens}).start()
+            schedulers = {'followers': RateLimitScheduler(
+                              interrupt=self.stopped),
+                          'following': RateLimitScheduler(
+                              interrupt=self.stopped),
+                          'lookup': RateLimitScheduler(
+                              interrupt=self.stopped)}
+            self.schedulers.append(schedulers)
+            for _ in range(self.concurrency):
+                worker = Thread(target=self._run_worker,
+                                kwargs={'api': tokens,
+                                        'schedulers': schedulers})
+                self.workers.append(worker)
+                worker.start()
+
+    def _run_worker(self, **kwargs):
+        """
+        run a crawler and mark the crawling finished when the last one exits
+        """
+        try:
+            self._explore_graph(**kwargs)
+        finally:
+            self.count_lock.acquire()
+            try:
+                self.active_workers -= 1
+                last = self.active_workers <= 0
+            finally:
+                self.count_lock.release()
+            if last:
+                self._finish()
+
+    def wait(self, timeout=None):
+        """
+        block until crawling has finished, because graph_size has been
+        reached, the frontier is exhausted or stop has been called, or until
+        timeout seconds have passed. Returns True if crawling has finished
+        """
+        if timeout is not None:
+            self.finished.wait(timeout)
+        else:
+            # waiting in steps keeps the main thread responsive to ctrl-c
+            while not self.finished.is_set():
+                self.finished.wait(1)
+        return self.finished.is_set()
+
+    def join(self):
+        """
+        block until crawling has finished
+        """
+        self.wait()
+
+    def stop(self, timeout=None):
+        """
+        stop crawling. Crawlers exit after their current request, rate limit
+        sleeps are cut short and the nodes being explored are kept in the
+        frontier. Blocks until the crawlers have exited or timeout seconds
+        have passed and returns True if they have exited
+        """
+        self.stopped.set()
+        return self.wait(timeout)
+
+    def _start_services(self):
+        """
+        start the metrics server, the log writer and the periodic checkpoints
+        if they are enabled
+        """
+        self.started = time()
+        if self.metrics_port:
+            self.metrics_server = start_metrics_server(self, self.metrics_port)
+
+        if self.export_mode == 'log':
+            writer = Thread(target=self._write_log)
+            writer.daemon = True
+            writer.start()
+
+        if self.checkpoint_interval:
+            checkpointer = Thread(target=self._checkpoint_periodically)
+            checkpointer.daemon = True
+            checkpointer.start()